@@ -2,9 +2,13 @@ import ctypes
 import re
 import os
 import sys
+import time
 import queue
 import threading
 import collections
+import hashlib
+import struct
+from array import array
 from usb_interp import USBInterpreter
 
 _lpath = (os.path.dirname(__file__))
@@ -65,14 +69,155 @@ FTDIDevice_ReadStream.argtypes = [
         ]
 FTDIDevice_ReadStream.restype = ctypes.c_int
 
-# void ChandlePacket(unsigned int ts, unsigned int flags, unsigned char *buf, unsigned int len)
-ChandlePacket = libov.ChandlePacket
-ChandlePacket.argtypes = [
-    ctypes.c_ulonglong, # ts
-    ctypes.c_int, # flags
-    ctypes.c_char_p, # buf
-    ctypes.c_int, # len
-]
+FTDIDevice_ReadStreamBatched = libov.FTDIDevice_ReadStreamBatched
+FTDIDevice_ReadStreamBatched.argtypes = [
+        pFTDI_Device,    # dev
+        ctypes.c_int,    # interface
+        p_cb_StreamCallback, # callback
+        ctypes.c_void_p, # userdata
+        ctypes.c_int, # packetsPerTransfer
+        ctypes.c_int, # numTransfers
+        ctypes.c_int, # batchSize
+        ctypes.c_int, # latencyMs
+        ]
+FTDIDevice_ReadStreamBatched.restype = ctypes.c_int
+
+# FTDIStream *FTDIStream_New(FTDIDevice *dev, FTDIInterface interface,
+#                            FTDIStreamCallback *callback, void *userdata,
+#                            int packetsPerTransfer, int numTransfers,
+#                            int batchSize, int latencyMs)
+FTDIStream_New = libov.FTDIStream_New
+FTDIStream_New.argtypes = [
+        pFTDI_Device,    # dev
+        ctypes.c_int,    # interface
+        p_cb_StreamCallback, # callback
+        ctypes.c_void_p, # userdata
+        ctypes.c_int, # packetsPerTransfer
+        ctypes.c_int, # numTransfers
+        ctypes.c_int, # batchSize
+        ctypes.c_int, # latencyMs
+        ]
+FTDIStream_New.restype = ctypes.c_void_p
+
+FTDIStream_Free = libov.FTDIStream_Free
+FTDIStream_Free.argtypes = [ctypes.c_void_p]
+
+FTDIStream_Run = libov.FTDIStream_Run
+FTDIStream_Run.argtypes = [ctypes.c_void_p]
+FTDIStream_Run.restype = ctypes.c_int
+
+FTDIStream_Stop = libov.FTDIStream_Stop
+FTDIStream_Stop.argtypes = [ctypes.c_void_p]
+
+FTDIStream_Reset = libov.FTDIStream_Reset
+FTDIStream_Reset.argtypes = [ctypes.c_void_p]
+
+p_cb_PacketBatchCallback = ctypes.CFUNCTYPE(
+        ctypes.c_int,    # retval
+        ctypes.POINTER(ctypes.c_uint8), # records
+        ctypes.c_int, # length
+        ctypes.c_int, # count
+        ctypes.c_void_p) # userdata
+
+p_cb_FrameCallback = ctypes.CFUNCTYPE(
+        ctypes.c_int,    # retval
+        ctypes.POINTER(ctypes.c_uint8), # frame
+        ctypes.c_int, # length
+        ctypes.c_void_p) # userdata
+
+class OVStreamStats(ctypes.Structure):
+    _fields_ = [
+                ('packets', ctypes.c_uint64),
+                ('batches', ctypes.c_uint64),
+                ('frames', ctypes.c_uint64),
+                ('discarded', ctypes.c_uint64),
+                ]
+
+# OVStreamParser *OVStreamParser_New(OVPacketBatchCallback *packetCb, OVFrameCallback *frameCb,
+#                                    void *userdata, int batchMaxCount, int batchSize)
+OVStreamParser_New = libov.OVStreamParser_New
+OVStreamParser_New.argtypes = [
+        p_cb_PacketBatchCallback, # packetCb
+        p_cb_FrameCallback, # frameCb
+        ctypes.c_void_p, # userdata
+        ctypes.c_int, # batchMaxCount
+        ctypes.c_int, # batchSize
+        ]
+OVStreamParser_New.restype = ctypes.c_void_p
+
+OVStreamParser_Free = libov.OVStreamParser_Free
+OVStreamParser_Free.argtypes = [ctypes.c_void_p]
+
+OVStreamParser_Stop = libov.OVStreamParser_Stop
+OVStreamParser_Stop.argtypes = [ctypes.c_void_p]
+
+OVStreamParser_GetStats = libov.OVStreamParser_GetStats
+OVStreamParser_GetStats.argtypes = [ctypes.c_void_p, ctypes.POINTER(OVStreamStats)]
+
+OVStreamParser_Feed = libov.OVStreamParser_Feed
+OVStreamParser_Feed.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int]
+OVStreamParser_Feed.restype = ctypes.c_int
+
+OVStreamParser_Flush = libov.OVStreamParser_Flush
+OVStreamParser_Flush.argtypes = [ctypes.c_void_p]
+OVStreamParser_Flush.restype = ctypes.c_int
+
+# Passed to FTDIStream_New as-is, so the stream never enters Python
+# until a batch is ready
+OVStreamParser_Callback = ctypes.cast(libov.OVStreamParser_Callback, p_cb_StreamCallback)
+
+# int OVRecords_Scan(const uint8_t *buf, size_t length, int64_t *offsets,
+#                    int maxCount, size_t *used)
+OVRecords_Scan = libov.OVRecords_Scan
+OVRecords_Scan.argtypes = [
+        ctypes.c_void_p, # buf
+        ctypes.c_size_t, # length
+        ctypes.c_void_p, # offsets
+        ctypes.c_int,    # maxCount
+        ctypes.POINTER(ctypes.c_size_t), # used
+        ]
+OVRecords_Scan.restype = ctypes.c_int
+
+# uint16_t OVCrc16(const uint8_t *buf, size_t length)
+OVCrc16 = libov.OVCrc16
+OVCrc16.argtypes = [
+        ctypes.c_void_p, # buf
+        ctypes.c_size_t, # length
+        ]
+OVCrc16.restype = ctypes.c_uint16
+
+# int OVRecords_CheckCRC(uint8_t *buf, size_t length, int count, int mark)
+OVRecords_CheckCRC = libov.OVRecords_CheckCRC
+OVRecords_CheckCRC.argtypes = [
+        ctypes.c_void_p, # buf
+        ctypes.c_size_t, # length
+        ctypes.c_int,    # count
+        ctypes.c_int,    # mark
+        ]
+OVRecords_CheckCRC.restype = ctypes.c_int
+
+# void OVRecords_ClearFlags(uint8_t *buf, size_t length, int count, uint16_t mask)
+OVRecords_ClearFlags = libov.OVRecords_ClearFlags
+OVRecords_ClearFlags.argtypes = [
+        ctypes.c_void_p, # buf
+        ctypes.c_size_t, # length
+        ctypes.c_int,    # count
+        ctypes.c_uint16, # mask
+        ]
+OVRecords_ClearFlags.restype = None
+
+# int OVRecords_FindFlags(const uint8_t *buf, size_t length, int count,
+#                         uint16_t mask, int64_t *offsets, int maxCount)
+OVRecords_FindFlags = libov.OVRecords_FindFlags
+OVRecords_FindFlags.argtypes = [
+        ctypes.c_void_p, # buf
+        ctypes.c_size_t, # length
+        ctypes.c_int,    # count
+        ctypes.c_uint16, # mask
+        ctypes.c_void_p, # offsets
+        ctypes.c_int,    # maxCount
+        ]
+OVRecords_FindFlags.restype = ctypes.c_int
 
 # int FTDIEEP_Erase(FTDIDevice *dev)
 FTDIEEP_Erase = libov.FTDIEEP_Erase
@@ -101,8 +246,14 @@ FTDIEEP_SanityCheck.restype = ctypes.c_int
 FTDI_INTERFACE_A = 1
 FTDI_INTERFACE_B = 2
 
-# hack
-keeper = []
+def _stream_buffer(buf, ll, copy):
+    if not ll:
+        return b''
+    elif copy:
+        return ctypes.string_at(buf, ll)
+    else:
+        return memoryview(ctypes.cast(buf,
+                ctypes.POINTER(ctypes.c_uint8 * ll)).contents).cast('B')
 
 class FTDIDevice:
     def __init__(self):
@@ -141,24 +292,23 @@ class FTDIDevice:
 
         return buf
 
-    def read_async(self, intf, callback, packetsPerTransfer, numTransfers):
+    def read_async(self, intf, callback, packetsPerTransfer, numTransfers, copy=True,
+                   batch_size=0, latency_ms=0):
+        # With copy=False the callback is handed a memoryview directly over
+        # the libusb transfer buffer. It is only valid for the duration of
+        # the callback, so the callee must copy out whatever it keeps.
+        #
+        # A nonzero batch_size gathers completed transfers into a buffer of
+        # that many bytes and calls back once per batch, or once the oldest
+        # data in it is latency_ms old.
         def callback_wrapper(buf, ll, prog, user):
-            if ll:
-                b = ctypes.string_at(buf, ll)
-            else:
-                b = b''
-            return callback(b, prog)
+            return callback(_stream_buffer(buf, ll, copy), prog)
 
+        # cb must stay referenced until the call returns
         cb = p_cb_StreamCallback(callback_wrapper)
 
-        # HACK
-        keeper.append(cb)
-
-        return FTDIDevice_ReadStream(self._dev, intf, cb, 
-                None, packetsPerTransfer, numTransfers)
-        # uncomment next lines to use C code to parse packets
-        #return FTDIDevice_ReadStream(self._dev, intf, p_cb_StreamCallback(libov.CStreamCallback), 
-        #        cb, packetsPerTransfer, numTransfers)
+        return FTDIDevice_ReadStreamBatched(self._dev, intf, cb,
+                None, packetsPerTransfer, numTransfers, batch_size, latency_ms)
 
     def eeprom_erase(self):
         return FTDIEEP_Erase(self._dev)
@@ -169,6 +319,192 @@ class FTDIDevice:
     def eeprom_sanitycheck(self, verbose=False):
         return FTDIEEP_SanityCheck(self._dev, verbose)
 
+class StreamParser:
+    """Native framer for the device stream.
+
+    Capture records (0xA0, including those unwrapped from 0xD0 SDRAM
+    bursts) are gated on HF0_FIRST/HF0_LAST and delivered to
+    on_packets(records, count) as a bytes object holding count records
+    back to back. Any other frame is delivered to on_frame(frame).
+
+    An exception raised by a callback stops the stream; it is kept in
+    self.exc for the caller to re-raise.
+    """
+
+    def __init__(self, on_packets, on_frame, batch_count=256, batch_size=65536):
+        self.exc = None
+
+        def packet_wrapper(buf, length, count, user):
+            try:
+                on_packets(ctypes.string_at(buf, length), count)
+                return 0
+            except Exception as e:
+                self.exc = e
+                return 1
+
+        def frame_wrapper(buf, length, user):
+            try:
+                on_frame(ctypes.string_at(buf, length))
+                return 0
+            except Exception as e:
+                self.exc = e
+                return 1
+
+        self.__packet_cb = p_cb_PacketBatchCallback(packet_wrapper)
+        self.__frame_cb = p_cb_FrameCallback(frame_wrapper)
+
+        self._parser = OVStreamParser_New(self.__packet_cb, self.__frame_cb,
+                None, batch_count, batch_size)
+        if not self._parser:
+            raise MemoryError("Unable to allocate stream parser")
+
+    def __del__(self):
+        if self._parser:
+            OVStreamParser_Free(self._parser)
+            self._parser = None
+
+    def feed(self, data):
+        return OVStreamParser_Feed(self._parser, data, len(data))
+
+    def flush(self):
+        return OVStreamParser_Flush(self._parser)
+
+    def stop(self):
+        OVStreamParser_Stop(self._parser)
+
+    def stats(self):
+        st = OVStreamStats()
+        OVStreamParser_GetStats(self._parser, ctypes.byref(st))
+        return st
+
+LIBUSB_ERROR_NO_DEVICE = -4
+
+class StreamSession:
+    """A long-lived read stream on one FTDI interface.
+
+    The libusb transfers, batch buffer and callback are allocated once and
+    kept until close(). start() streams on a background thread until
+    stop(); the stream is only resubmitted if libusb reports an error,
+    after a growing delay, and the session gives up after max_errors
+    errors in a row.
+
+    The stream is handled either by a Python callback(b, prog), with the
+    same conventions as FTDIDevice.read_async, or by a native
+    StreamParser. A nonzero return or an exception from the callback ends
+    the session. An exception that ends the session is kept in self.exc
+    and raised again by stop() and close().
+    """
+
+    RETRY_DELAY = 0.01          # seconds, doubled after every error
+    RETRY_DELAY_MAX = 1.0
+
+    def __init__(self, dev, intf, callback=None, parser=None,
+                 packetsPerTransfer=8, numTransfers=16, copy=True,
+                 batch_size=0, latency_ms=0, max_errors=10):
+        self.exc = None
+        self.max_errors = max_errors
+        self.__dev = dev
+        self.__parser = parser
+        self.__ended = False
+        self.__stopping = threading.Event()
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+        if parser is not None:
+            cb = OVStreamParser_Callback
+            userdata = parser._parser
+        else:
+            def callback_wrapper(buf, ll, prog, user):
+                try:
+                    ret = callback(_stream_buffer(buf, ll, copy), prog)
+                except Exception as e:
+                    self.exc = e
+                    ret = 1
+
+                if ret:
+                    self.__ended = True
+                return ret
+
+            cb = p_cb_StreamCallback(callback_wrapper)
+            userdata = None
+
+        self.__cb = cb
+        self._stream = FTDIStream_New(dev._dev, intf, cb, userdata,
+                packetsPerTransfer, numTransfers, batch_size, latency_ms)
+        if not self._stream:
+            raise MemoryError("Unable to allocate stream transfers")
+
+    def __del__(self):
+        self.close()
+
+    def __run(self):
+        errors = 0
+
+        while not (self.__stopping.is_set() or self.__ended):
+            started = time.monotonic()
+            err = FTDIStream_Run(self._stream)
+
+            if self.__parser is not None and self.__parser.exc:
+                self.exc = self.__parser.exc
+                self.__ended = True
+
+            if self.exc:
+                return
+
+            if err == LIBUSB_ERROR_NO_DEVICE:
+                self.exc = IOError("USB: device went away while streaming")
+                return
+
+            if not err:
+                continue
+
+            # Errors are only counted while they follow each other closely
+            if time.monotonic() - started > self.RETRY_DELAY_MAX:
+                errors = 0
+            errors += 1
+            if errors >= self.max_errors:
+                self.exc = IOError("USB: streaming failed %d times in a row (error %d)"
+                        % (errors, err))
+                return
+
+            self.__stopping.wait(min(self.RETRY_DELAY * 2 ** (errors - 1),
+                                     self.RETRY_DELAY_MAX))
+
+    def start(self):
+        with self.__lock:
+            if self.__thread is not None:
+                raise ValueError("StreamSession already started")
+
+            self.exc = None
+            self.__ended = False
+            self.__stopping.clear()
+            FTDIStream_Reset(self._stream)
+            self.__thread = threading.Thread(target=self.__run, daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        with self.__lock:
+            if self.__thread is None:
+                return
+
+            self.__stopping.set()
+            FTDIStream_Stop(self._stream)
+            self.__thread.join()
+            self.__thread = None
+
+            exc, self.exc = self.exc, None
+
+        if exc is not None:
+            raise exc
+
+    def close(self):
+        if self._stream:
+            try:
+                self.stop()
+            finally:
+                FTDIStream_Free(self._stream)
+                self._stream = None
+
 _FPGA_GetConfigStatus = libov.FPGA_GetConfigStatus
 _FPGA_GetConfigStatus.restype = ctypes.c_int
 _FPGA_GetConfigStatus.argtypes = [pFTDI_Device]
@@ -286,11 +622,238 @@ SMSC_334x_MAP = {
 }
 
 
+class _RxRing:
+    """Receive buffer for a framed byte stream.
+
+    Data is copied into a preallocated bytearray at the write cursor
+    (by _demux, only once part of a frame is waiting for the rest);
+    complete frames are handed out as memoryview slices and retired by
+    advancing the read cursor. Only the tail of a partial frame is ever
+    moved, so the cost per byte stays constant no matter how much data is
+    pending.
+
+    Views returned by view() must be dropped before the next write().
+    """
+
+    def __init__(self, size=65536):
+        self.__buf = bytearray(size)
+        self.__rd = 0
+        self.__wr = 0
+
+    def __len__(self):
+        return self.__wr - self.__rd
+
+    def write(self, data):
+        n = len(data)
+        if self.__wr + n > len(self.__buf):
+            self.__make_room(n)
+
+        self.__buf[self.__wr:self.__wr + n] = data
+        self.__wr += n
+
+    def __make_room(self, n):
+        pending = self.__wr - self.__rd
+
+        if pending + n > len(self.__buf):
+            size = len(self.__buf)
+            while size < pending + n:
+                size *= 2
+            buf = bytearray(size)
+            buf[:pending] = self.__buf[self.__rd:self.__wr]
+            self.__buf = buf
+        else:
+            self.__buf[:pending] = self.__buf[self.__rd:self.__wr]
+
+        self.__rd = 0
+        self.__wr = pending
+
+    def view(self):
+        return memoryview(self.__buf)[self.__rd:self.__wr]
+
+    def consume(self, n):
+        self.__rd += n
+        if self.__rd == self.__wr:
+            self.__rd = self.__wr = 0
+
+
+StageStats = collections.namedtuple('StageStats',
+        ['name', 'depth', 'maxsize', 'max_depth', 'puts', 'stalls', 'stall_time'])
+
+class StageQueue:
+    """Bounded queue feeding a pipeline stage.
+
+    put() blocks while the queue is full, which is what pushes back on the
+    producer; every time that happens it is counted as a stall, along with
+    the time spent waiting.
+    """
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self.__q = queue.Queue(maxsize)
+
+        self.puts = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.max_depth = 0
+
+    def put(self, item):
+        try:
+            self.__q.put_nowait(item)
+        except queue.Full:
+            self.stalls += 1
+            start = time.monotonic()
+            self.__q.put(item)
+            self.stall_time += time.monotonic() - start
+
+        self.puts += 1
+
+        depth = self.__q.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def get(self, timeout=None):
+        return self.__q.get(True, timeout)
+
+    def task_done(self):
+        self.__q.task_done()
+
+    def join(self):
+        self.__q.join()
+
+    def depth(self):
+        return self.__q.qsize()
+
+    def stats(self):
+        return StageStats(self.name, self.depth(), self.maxsize, self.max_depth,
+                          self.puts, self.stalls, self.stall_time)
+
+class Stage:
+    """A thread running handler(item) for every item put on self.queue.
+
+    If the handler raises, the exception is kept in self.exc and the
+    remaining items are discarded, so producers never block on a dead
+    stage.
+    """
+
+    __STOP = object()
+
+    def __init__(self, name, handler, maxsize):
+        self.queue = StageQueue(name, maxsize)
+        self.exc = None
+        self.__handler = handler
+        self.__thread = None
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is Stage.__STOP:
+                    return
+
+                if self.exc is None:
+                    self.__handler(item)
+            except Exception as e:
+                self.exc = e
+                print("Pipeline stage %s failed: %r" % (self.queue.name, e),
+                      file=sys.stderr)
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def drain(self):
+        """Wait until everything queued so far has been handled."""
+        self.queue.join()
+
+    def stop(self):
+        if self.__thread is not None:
+            self.queue.put(Stage.__STOP)
+            self.__thread.join()
+            self.__thread = None
+
+
 INCOMPLETE = -1
 UNMATCHED = 0
+
+class ServiceTable:
+    """Maps the first (magic) byte of a frame straight to its service.
+
+    Each of the 256 slots holds the number of bytes needed before the frame
+    can be sized, plus the service's getPacketSize and consume functions,
+    so dispatching a frame costs the same however many services exist.
+    """
+
+    def __init__(self, services=()):
+        self.entries = [None] * 256
+
+        for service in services:
+            self.register(service)
+
+    def register(self, service):
+        for magic in service.getMagics():
+            if self.entries[magic] is not None:
+                raise ValueError("Magic %02x already registered" % magic)
+
+        for magic in service.getMagics():
+            self.entries[magic] = (service.getNeededSizeForMagic(magic),
+                                   service.getPacketSize, service.consume)
+
+def _demux(ring, table, data):
+    """Frame 'data', after whatever is left in ring from earlier calls,
+    feeding it to the services in table.
+
+    Each frame is handed over as a memoryview, valid only for the duration
+    of the service's consume(). While nothing is pending in ring, frames are
+    cut straight from 'data'; only a trailing partial frame is copied into
+    the ring to wait for the rest of it.
+    """
+    direct = not len(ring)
+    if direct:
+        buf = memoryview(data)
+    else:
+        ring.write(data)
+        buf = ring.view()
+
+    entries = table.entries
+    pos = 0
+    end = len(buf)
+
+    try:
+        while pos < end:
+            entry = entries[buf[pos]]
+            if entry is None:
+                print("Unmatched byte %02x - discarding" % buf[pos])
+                pos += 1
+                continue
+
+            needed, getPacketSize, consume = entry
+            if end - pos < needed:
+                return
+
+            frame = buf[pos:]
+            size = getPacketSize(frame)
+            if end - pos < size:
+                return
+
+            consume(frame[:size])
+            pos += size
+    finally:
+        if direct:
+            if pos < end:
+                ring.write(buf[pos:])
+        else:
+            ring.consume(pos)
+        buf.release()
+
 class baseService:
+    def getMagics(self):
+        return (self.MAGIC,)
+
     def matchMagic(self, byt):
-        return byt == self.MAGIC
+        return byt in self.getMagics()
 
     def getNeededSizeForMagic(self, byt):
         return self.NEEDED_FOR_SIZE
@@ -424,6 +987,12 @@ HF0_TRUNC = 0x08
 HF0_FIRST = 0x10
 # Last packet of capture session; IE, when the cap hardware was disabled
 HF0_LAST = 0x20
+# Set by the host, not the device: the packet's CRC is wrong (see usb_crc)
+HF_CRC_BAD = 0x8000
+
+# Flags reported as device errors: everything but the capture start/end
+# markers and the host's own CRC flag
+PERR_MASK = 0xFFFF & ~(HF0_FIRST | HF0_LAST | HF_CRC_BAD)
 
 def decode_flags(flags):
     ret = ""
@@ -433,13 +1002,143 @@ def decode_flags(flags):
     ret += "Truncated " if flags & HF0_TRUNC else ""
     ret += "First " if flags & HF0_FIRST else ""
     ret += "Last " if flags & HF0_LAST else ""
+    ret += "BadCRC " if flags & HF_CRC_BAD else ""
     return ret.rstrip()
 
+class Packet:
+    """One packet of a PacketBatch. Cheap to create; the payload is only
+    copied out when 'data' is read."""
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    @property
+    def ts(self):
+        return self.batch.ts[self.index]
+
+    @property
+    def flags(self):
+        return self.batch.flags[self.index]
+
+    @property
+    def payload(self):
+        return self.batch.payload(self.index)
+
+    @property
+    def data(self):
+        return bytes(self.payload)
+
+    def __len__(self):
+        return self.batch.lengths[self.index]
+
+    def __repr__(self):
+        return "<Packet ts=%d flags=%04x len=%d>" % (self.ts, self.flags, len(self))
+
+
+class PacketBatch:
+    """A batch of captured packets as parallel arrays: payload offsets into
+    'buf', payload lengths, flags and 64-bit timestamps (60 MHz clock
+    counts, with the device's 24-bit wraps undone)."""
+    __slots__ = ('buf', 'offsets', 'lengths', 'flags', 'ts', 'last_ts', 'ts_base')
+
+    def __init__(self, records, count, last_ts=0, ts_base=0):
+        """Index 'count' back-to-back 0xA0 records in 'records', without
+        copying payloads. 'last_ts' and 'ts_base' are the raw timestamp and
+        wrap offset of the packet before the batch; the batch's own end
+        state is left in the attributes of the same name."""
+        self.buf = records
+        self.offsets = offsets = array('I', [0]) * count
+        self.lengths = lengths = array('H', [0]) * count
+        self.flags = flags = array('H', [0]) * count
+        self.ts = tss = array('q', [0]) * count
+
+        for i, (pos, flag, length, ts) in enumerate(iter_records(records, count)):
+            if ts < last_ts:
+                ts_base += 1 << 24
+            last_ts = ts
+
+            offsets[i] = pos + 8
+            lengths[i] = length
+            flags[i] = flag
+            tss[i] = ts_base + ts
+
+        self.last_ts = last_ts
+        self.ts_base = ts_base
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError("packet index out of range")
+        return Packet(self, i % len(self))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Packet(self, i)
+
+    def payload(self, i):
+        start = self.offsets[i]
+        return memoryview(self.buf)[start:start + self.lengths[i]]
+
+
+# Header of a 0xA0 record after the 0xA0: flags, payload length, and the
+# 24-bit timestamp as its low 16 and high 8 bits
+_record_header = struct.Struct("<HHHB")
+
+def iter_records(records, count, pos=0):
+    """Yield (pos, flags, length, ts) for 'count' back-to-back 0xA0 records
+    in 'records' from offset 'pos': the offset of each 8-byte record header,
+    its flags, the payload length and the raw 24-bit timestamp."""
+    unpack_from = _record_header.unpack_from
+    for i in range(count):
+        flags, length, ts_lo, ts_hi = unpack_from(records, pos + 1)
+        yield pos, flags, length, ts_lo | ts_hi << 16
+        pos += length + 8
+
+def check_records_crc(records, count):
+    """Check the CRCs of 'count' 0xA0 records in 'records' and set
+    HF_CRC_BAD on the bad ones. A bytearray is marked in place; anything
+    else is only read, and copied into a bytearray if there is a bad CRC
+    to mark. Returns the records."""
+    if not count:
+        return records
+
+    if not isinstance(records, bytearray):
+        if not isinstance(records, bytes):
+            records = bytes(records)
+        if not OVRecords_CheckCRC(records, len(records), count, 0):
+            return records
+        records = bytearray(records)
+
+    OVRecords_CheckCRC((ctypes.c_uint8 * len(records)).from_buffer(records),
+                       len(records), count, 1)
+    return records
+
+def find_records_flags(records, count, mask, offsets):
+    """Find the 0xA0 records among the first 'count' in 'records' with any
+    flag bit in 'mask' set. The offsets of the first len(offsets) of them
+    go into 'offsets' (a ctypes int64 array). Returns how many there are."""
+    if not count:
+        return 0
+    if isinstance(records, bytearray):
+        buf = (ctypes.c_uint8 * len(records)).from_buffer(records)
+    else:
+        buf = records if isinstance(records, bytes) else bytes(records)
+    return OVRecords_FindFlags(buf, len(records), count, mask,
+                               offsets, len(offsets))
+
+def clear_records_flags(buf, start, count, mask):
+    """Clear the flag bits in 'mask' in the 'count' 0xA0 records at offset
+    'start' of bytearray 'buf'."""
+    n = len(buf) - start
+    if count and n:
+        OVRecords_ClearFlags((ctypes.c_uint8 * n).from_buffer(buf, start), n, count, mask)
+
 class RXCSniff:
     class __RXCSniffService(baseService):
-        import crcmod
-        data_crc = staticmethod(crcmod.mkCrcFun(0x18005))
-
         def getNeededSizeForMagic(self, b):
             if b == 0xA0:
                 return 5
@@ -458,9 +1157,29 @@ class RXCSniff:
 
             self.got_start = False
 
+            # Called with (records, count) for every batch of raw 0xA0
+            # records, for consumers that do their own decoding
+            self.record_handlers = []
 
-        def matchMagic(self, byt):
-            return byt == 0xAC or byt == 0xAD or byt == 0xA0
+            # Called with a PacketBatch for every batch of records
+            self.batch_handlers = []
+            self.__batch_last_ts = 0
+            self.__batch_ts_base = 0
+
+            # When set, captured records are queued to this StageQueue in
+            # batches and the handlers run on the stage's thread via deliver()
+            self.sink = None
+            self.__pending = bytearray()
+            self.__pending_count = 0
+
+            # Check token and data CRCs before delivering, setting
+            # HF_CRC_BAD on the packets that fail
+            self.check_crc = True
+            self.__perr_offsets = (ctypes.c_int64 * 16)()
+
+
+        def getMagics(self):
+            return (0xA0, 0xAC, 0xAD)
 
         def getPacketSize(self, buf):
             if buf[0] != 0xA0:
@@ -474,26 +1193,82 @@ class RXCSniff:
             if buf[0] == 0xA0:
                 flags = buf[1] | buf[2] << 8
 
-                ts = buf[5] | buf[6] << 8 | buf[7] << 16
-
-                if flags != 0 and flags != HF0_FIRST and flags != HF0_LAST:
-                    print("PERR: %04X (%s)" % (flags, decode_flags(flags)))
-               
                 if flags & HF0_FIRST:
                     self.got_start = True
 
                 if self.got_start:
-                    self.handle_usb(ts, buf[8:], flags)
+                    if self.sink is not None:
+                        # Decoded later, on the sink stage
+                        self.__pending += buf
+                        self.__pending_count += 1
+                    else:
+                        self.deliver((bytes(buf), 1))
 
                 if flags & HF0_LAST:
                     self.got_start = False
 
+        def consume_records(self, buf, count):
+            # count back-to-back 0xA0 records from the native parser, which
+            # has already applied the HF0_FIRST/HF0_LAST gating
+            if self.sink is not None:
+                self.sink.put((buf, count))
+                return
+
+            self.deliver((buf, count))
+
+        def report_errors(self, buf, count):
+            # Every batch is checked, whichever handlers it goes to. Only
+            # the device's error flags count; bad CRCs are flagged per packet
+            n = find_records_flags(buf, count, PERR_MASK, self.__perr_offsets)
+            for pos in self.__perr_offsets[:min(n, len(self.__perr_offsets))]:
+                flags = buf[pos + 1] | buf[pos + 2] << 8
+                print("PERR: %04X (%s)" % (flags, decode_flags(flags)), file=sys.stderr)
+            if n > len(self.__perr_offsets):
+                print("PERR: %d more in this batch" % (n - len(self.__perr_offsets)),
+                      file=sys.stderr)
+
+        def handle_records(self, buf, count):
+            for pos, flags, length, ts in iter_records(buf, count):
+                self.handle_usb(ts, bytes(buf[pos + 8:pos + 8 + length]), flags)
+
         def handle_usb(self, ts, buf, flags):
             for handler in self.handlers:
                 handler(ts, buf, flags)
 
+        def flush(self):
+            # Hand the records collected since the last flush to the sink.
+            # The buffer itself is handed over, and never touched here again
+            if self.__pending_count:
+                item = (self.__pending, self.__pending_count)
+                self.__pending = bytearray()
+                self.__pending_count = 0
+                self.sink.put(item)
+
+        def deliver(self, item):
+            # Runs on the sink stage: item is (records, count) as above
+            records, count = item
+
+            if self.check_crc:
+                records = check_records_crc(records, count)
+
+            self.report_errors(records, count)
+
+            for handler in self.record_handlers:
+                handler(records, count)
+
+            if self.batch_handlers:
+                batch = PacketBatch(records, count,
+                        self.__batch_last_ts, self.__batch_ts_base)
+                self.__batch_last_ts = batch.last_ts
+                self.__batch_ts_base = batch.ts_base
+
+                for handler in self.batch_handlers:
+                    handler(batch)
+
+            if self.handlers:
+                self.handle_records(records, count)
+
         def handle_usb_verbose(self, ts, buf, flags):
-#                ChandlePacket(ts, flags, buf, len(buf))
                 self.ui.handlePacket(ts, buf, flags)
 
             
@@ -507,12 +1282,15 @@ class SDRAMRead:
             return 2
 
         def __init__(self, verbose, services):
-            self.__buf = b""
-            self.__services = services
+            self.__ring = _RxRing()
+            self.__table = ServiceTable(services)
             self.__verbose = verbose
 
-        def matchMagic(self, byt):
-            return byt == 0xD0
+        def getMagics(self):
+            return (0xD0,)
+
+        def register(self, service):
+            self.__table.register(service)
 
         def getPacketSize(self, buf):
             return (buf[1] + 1) * 2 + 2
@@ -523,24 +1301,8 @@ class SDRAMRead:
             if self.__verbose and b:
                 print("SD> %s" % " ".join("%02x" % i for i in b))
 
-            self.__buf += b
-
-            incomplete = False
-
-            while self.__buf and not incomplete:
-                for service in self.__services:
-                    code = service.presentBytes(self.__buf)
-                    if code == INCOMPLETE:
-                        incomplete = True
-                        break
-                    elif code:
-                        self.__buf = self.__buf[code:]
-                        break
-                else:
-                    print("Unmatched byte %02x - discarding" % self.__buf[0])
-                    self.__buf = self.__buf[1:]
-            pass
-        
+            _demux(self.__ring, self.__table, b)
+
     def __init__(self, verbose, services):
         self.service = SDRAMRead.__SDRAMReadService(verbose, services)
 
@@ -550,8 +1312,8 @@ class Dummy:
             return 1
         def __init__(self):
             pass
-        def matchMagic(self, byt):
-            return byt == 0xE0 or byt == 0xe8
+        def getMagics(self):
+            return (0xE0, 0xE8)
         def getPacketSize(self, buf):
             return 3
         def consume(self, buf):
@@ -561,14 +1323,27 @@ class Dummy:
         self.service = Dummy.__DummyService()
 
 class OVDevice:
-    def __init__(self, mapfile=None, verbose=False):
+    def __init__(self, mapfile=None, verbose=False, native=False,
+                 batch_size=0, batch_latency_ms=10):
         self.__is_open = False
 
         self.dev = FTDIDevice()
         self.verbose = verbose
 
+        # Trade latency for throughput on busy buses; see read_async
+        self.batch_size = batch_size
+        self.batch_latency_ms = batch_latency_ms
+
+        # Frame the stream in C (see StreamParser) rather than in Python.
+        # Only the built-in stream types are understood by the native parser.
+        self.native = native
+        self.__parser = None
+
         self.__addrmap = {}
 
+        # SHA-1 of the register map, identifying the firmware build
+        self.map_hash = None
+
         if mapfile:
             self.__parse_mapfile(mapfile)
 
@@ -587,55 +1362,76 @@ class OVDevice:
         self.sdram_read = SDRAMRead(False, [self.rxcsniff.service])
         self.dummy = Dummy()
 
-        self.__services = [self.io.service, self.lfsrtest.service, self.rxcsniff.service, self.sdram_read.service, self.dummy.service]
+        self.__services = ServiceTable()
+
+        # Stream pipeline: USB chunks -> framing stage -> sink stage, which
+        # runs the rxcsniff handlers
+        self.__ring = _RxRing()
+        self.__framing = Stage("framing", self.__frame, 4096)
+        self.__sink = Stage("sink", self.rxcsniff.service.deliver, 1024)
+        self.rxcsniff.service.sink = self.__sink.queue
+
+        for service in [self.io.service, self.lfsrtest.service, self.rxcsniff.service, self.sdram_read.service, self.dummy.service]:
+            self.register_service(service)
 
-        # Inject a write function to the services
-        for service in self.__services:
-            def write(msg):
-                if self.verbose:
-                    print("< %s" % " ".join("%02x" % i for i in msg))
+    def register_service(self, service):
+        """Route frames starting with any of service.getMagics() to service,
+        and give it a write function for sending requests to the device.
+        """
+        self.__services.register(service)
 
-                self.dev.write(FTDI_INTERFACE_A, msg, async_=False)
+        # Inject a write function to the service
+        def write(msg):
+            if self.verbose:
+                print("< %s" % " ".join("%02x" % i for i in msg))
 
-            service.write = write
+            self.dev.write(FTDI_INTERFACE_A, msg, async_=False)
+
+        service.write = write
     
-    def __comms(self):
-        self.__buf = b""
+    def __make_session(self):
+        if self.native:
+            self.__parser = StreamParser(self.rxcsniff.service.consume_records,
+                    self.__native_frame)
+            return StreamSession(self.dev, FTDI_INTERFACE_A, parser=self.__parser)
+
+        # The libusb thread only queues raw chunks; framing happens on the
+        # framing stage so that it can never hold up USB reads directly
+        ingest = self.__framing.queue
 
         def callback(b, prog):
-            try:
-                if self.verbose and b:
-                    print("> %s" % " ".join("%02x" % i for i in b))
-
-                self.__buf += b
-
-                incomplete = False
-
-                while self.__buf and not incomplete:
-                    for service in self.__services:
-                        code = service.presentBytes(self.__buf)
-                        if code == INCOMPLETE:
-                            incomplete = True
-                            break
-                        elif code:
-                            self.__buf = self.__buf[code:]
-                            break
-                    else:
-                        print("Unmatched byte %02x - discarding" % self.__buf[0])
-                        self.__buf = self.__buf[1:]
+            if b:
+                ingest.put(b)
 
-                return int(self.__comm_term) 
-            except Exception as e:
-                self.__comm_term = True
-                self.__comm_exc = e
-                return 1
+            return 0
 
-        while not self.__comm_term:
-            self.dev.read_async(FTDI_INTERFACE_A, callback, 8, 16)
+        return StreamSession(self.dev, FTDI_INTERFACE_A, callback,
+                batch_size=self.batch_size, latency_ms=self.batch_latency_ms)
+
+    def __frame(self, b):
+        if self.verbose:
+            print("> %s" % " ".join("%02x" % i for i in b))
+
+        _demux(self.__ring, self.__services, b)
+        self.rxcsniff.service.flush()
+
+    def __native_frame(self, frame):
+        if self.verbose:
+            print("> %s" % " ".join("%02x" % i for i in frame))
+
+        entry = self.__services.entries[frame[0]]
+        if entry is not None:
+            entry[2](frame)
+
+    def drain(self):
+        """Wait until all data received so far has passed through the
+        pipeline and reached the rxcsniff handlers."""
+        self.__framing.drain()
+        self.__sink.drain()
+
+    def pipeline_stats(self):
+        return [self.__framing.queue.stats(), self.__sink.queue.stats()]
 
-        if self.__comm_exc:
-            raise self.__comm_exc
-            
     def __build_map(self, addrmap, readfn, writefn):
         d = {}
         for name, (addr, size) in addrmap.items():
@@ -654,8 +1450,10 @@ class OVDevice:
 
 
     def __parse_mapfile(self, mapfile):
+        lines = mapfile.readlines()
+        self.map_hash = hashlib.sha1(b"".join(lines)).digest()
 
-        for line in mapfile.readlines():
+        for line in lines:
             line = line.strip().decode('utf-8')
 
             line = re.sub('#.*', '', line)
@@ -743,25 +1541,31 @@ class OVDevice:
             raise TypeError("bitstream must be bytes or file-like")
         
     
-        self.commthread = threading.Thread(target=self.__comms, daemon=True)
-        self.__comm_term = False
-        self.__comm_exc = None
+        # The stream session lives as long as the device is open
+        self.__framing.start()
+        self.__sink.start()
+        self.__session = self.__make_session()
+        self.__session.start()
 
-        self.commthread.start()
-
-        self.__comm_term = False
         self.__is_open = True
 
     def close(self):
         if not self.__is_open:
             raise ValueError("OVDevice doubly closed")
 
-        self.__comm_term = True
-        self.commthread.join()
+        # Whatever ended the stream is raised once everything is shut down
+        try:
+            self.__session.close()
+        finally:
+            self.__session = None
+            self.__parser = None
 
-        self.dev.close()
+            self.__framing.stop()
+            self.__sink.stop()
 
-        self.__is_open = False
+            self.dev.close()
+
+            self.__is_open = False
 
 
     def ulpiread(self, addr):
@@ -0,0 +1,381 @@
+#
+# Sidecar index of raw and pcap capture files
+#
+# The index cuts the capture into blocks of about a millisecond (and at
+# most a few thousand packets). For each block it stores the clock count,
+# file offset and number of its first packet. For every (address,
+# endpoint, PID) seen it also stores a posting list: the numbers of the
+# blocks holding such packets. Data packets and handshakes count for the
+# endpoint of the token before them, and blocks only start where no
+# transaction is open, so every block can be decoded on its own.
+#
+# An index is built while capturing (IndexedOutput) or from a finished
+# file (build_index), and is kept in memory until it is written out at
+# the end. CaptureIndex answers time and endpoint queries with a binary
+# search and a few block reads, without scanning the capture.
+#
+# Times are 60 MHz clock counts as decode_file sees them: since the start
+# of capture for raw files, since the start of the second of the first
+# packet for pcap files.
+#
+
+import bisect
+import collections
+import mmap
+import os
+import struct
+import sys
+
+from array import array
+
+import LibOV
+import outputs
+from outputs import CLOCK_HZ, StreamClock, TS_WRAP
+from parallel_decode import open_capture
+
+INDEX_MAGIC = b"OVINDEX\0"
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".idx"
+
+KINDS = ["raw", "pcap"]
+
+# magic, version, capture kind, block length in clocks, indexed size of
+# the capture file, packets, blocks, posting lists
+_index_header = struct.Struct("<8sHBxIQQQI")
+# addr, endp, PID, length of the posting list
+_posting_header = struct.Struct("<BBBxI")
+
+_pcap_record = {e: struct.Struct(e + "IIII") for e in "<>"}
+
+TOKEN_PIDS = (0x1, 0x9, 0xD, 0x4)           # OUT, IN, SETUP, PING
+HANDSHAKE_PIDS = (0x2, 0xA, 0xE, 0x6)       # ACK, NAK, STALL, NYET
+PID_SOF = 0x5
+PID_SPLIT = 0x8
+
+# A packet read back through the index: absolute clock count, file offset
+# of its record and the packet itself, starting with the PID
+IndexedPacket = collections.namedtuple('IndexedPacket', ['clks', 'offset', 'pkt'])
+
+def index_path(capture_path):
+    return capture_path + INDEX_SUFFIX
+
+
+class IndexBuilder:
+    """Collects the index of a capture file, fed packets in file order.
+    A new block is started every 'block_clks' clocks or 'block_packets'
+    packets, at the next token or SOF."""
+
+    def __init__(self, kind, block_clks=CLOCK_HZ // 1000, block_packets=4096):
+        self.kind = kind
+        self.block_clks = block_clks
+        self.block_packets = block_packets
+
+        self.block_start = array('q')
+        self.block_offset = array('Q')
+        self.block_packet = array('Q')
+        self.postings = {}                  # (addr, endp, pid) -> array of blocks
+
+        self.packets = 0
+        self.size = 0                       # end of the last indexed record
+        self.in_block = 0
+        self.endpoint = None                # (addr, endp) of the open transaction
+
+    def packet(self, clks, offset, size, pkt):
+        """Index packet 'pkt' at clock count 'clks', whose record of 'size'
+        bytes starts at file offset 'offset'."""
+        self.size = offset + size
+        if not pkt:
+            return
+
+        pid = pkt[0] & 0xF
+        bad = (pkt[0] >> 4) ^ 0xF != pid
+        boundary = pid in TOKEN_PIDS or pid == PID_SOF or self.endpoint is None
+
+        if boundary and (not self.block_start or self.in_block >= self.block_packets or
+                         clks - self.block_start[-1] >= self.block_clks):
+            self.block_start.append(clks)
+            self.block_offset.append(offset)
+            self.block_packet.append(self.packets)
+            self.in_block = 0
+
+        self.packets += 1
+        self.in_block += 1
+
+        if pid in TOKEN_PIDS:
+            self.endpoint = None
+            if bad or len(pkt) < 3:
+                return
+            self.endpoint = (pkt[1] & 0x7F, (pkt[2] & 0x7) << 1 | pkt[1] >> 7)
+        elif pid == PID_SOF:
+            self.endpoint = None
+            return
+        elif self.endpoint is None or pid == PID_SPLIT:
+            return
+
+        key = self.endpoint + (pid,)
+        blocks = self.postings.get(key)
+        if blocks is None:
+            blocks = self.postings[key] = array('I')
+        block = len(self.block_start) - 1
+        if not blocks or blocks[-1] != block:
+            blocks.append(block)
+
+        # A handshake ends the transaction
+        if pid in HANDSHAKE_PIDS:
+            self.endpoint = None
+
+    def write(self, path):
+        """Write the index to 'path', replacing any older one at once."""
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(_index_header.pack(INDEX_MAGIC, INDEX_VERSION, KINDS.index(self.kind),
+                    self.block_clks, self.size, self.packets, len(self.block_start),
+                    len(self.postings)))
+            for arr in (self.block_start, self.block_offset, self.block_packet):
+                f.write(_little_endian(arr))
+            for key in sorted(self.postings):
+                f.write(_posting_header.pack(*key, len(self.postings[key])))
+            for key in sorted(self.postings):
+                f.write(_little_endian(self.postings[key]))
+        os.replace(tmp, path)
+
+def _little_endian(arr):
+    if sys.byteorder != "little":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+def _read_array(typecode, data, pos, count):
+    arr = array(typecode)
+    end = pos + arr.itemsize * count
+    arr.frombytes(data[pos:end])
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr, end
+
+
+class IndexedOutput:
+    """Record handler wrapping the OutputRaw or OutputPcap ('kind') that
+    writes the file 'path', and writing that file's index next to it when
+    finished. The wrapped output must start at the beginning of the file,
+    and be its only writer."""
+
+    def __init__(self, output, kind, path):
+        self.output = output
+        self.kind = kind
+        self.path = path
+        self.builder = IndexBuilder(kind)
+        self.clock = StreamClock()
+        self.pos = outputs.RAW_HEADER_SIZE if kind == "raw" else 24
+        self.origin = None
+
+    def handle_records(self, records, count):
+        builder = self.builder
+        clock = self.clock
+        raw = self.kind == "raw"
+
+        for pos, flags, length, ts in LibOV.iter_records(records, count):
+            clks = clock(ts)
+
+            if raw:
+                builder.packet(clks, self.pos, length + 8, records[pos + 8:pos + 8 + length])
+                self.pos += length + 8
+            elif length:
+                # The pcap's time origin is the second of its first packet
+                if self.origin is None:
+                    self.origin = clks - clks % CLOCK_HZ
+                builder.packet(clks - self.origin, self.pos, length + 16,
+                               records[pos + 8:pos + 8 + length])
+                self.pos += length + 16
+
+        self.output.handle_records(records, count)
+
+    def flush(self):
+        self.output.flush()
+
+    def finish(self):
+        getattr(self.output, "finish", self.output.flush)()
+        self.builder.write(index_path(self.path))
+
+
+def _packets(cap, buf, pos, end, clks=None):
+    """Yield (clks, offset, size, pkt) for the records of capture 'cap' in
+    buf[pos:end]. 'clks' is the clock count of the first record, needed
+    for raw files when not starting at the beginning."""
+    if cap.kind == "raw":
+        if clks is None:
+            clock = StreamClock(0, cap.ts_base)
+        else:
+            clock = StreamClock(clks % TS_WRAP, clks - clks % TS_WRAP)
+        while pos + 8 <= end and buf[pos] == 0xA0:
+            size = (buf[pos + 4] << 8 | buf[pos + 3]) + 8
+            if pos + size > end:
+                break
+            ts = buf[pos + 5] | buf[pos + 6] << 8 | buf[pos + 7] << 16
+            yield clock(ts), pos, size, bytes(buf[pos + 8:pos + size])
+            pos += size
+    else:
+        record = _pcap_record[cap.pcap_endian]
+        while pos + 16 <= end:
+            sec, frac, incl, orig = record.unpack_from(buf, pos)
+            size = incl + 16
+            if pos + size > end:
+                break
+            frac = (frac * 3 + 25) // 50 if cap.pcap_nano else frac * 60
+            yield ((sec - cap.utc_start) * CLOCK_HZ + frac, pos, size,
+                   bytes(buf[pos + 16:pos + size]))
+            pos += size
+
+def build_index(path):
+    """Index the capture file at 'path' and write the index next to it.
+    Returns the IndexBuilder."""
+    cap = open_capture(path)
+    if cap.kind not in KINDS:
+        raise ValueError("can't index %s captures" % cap.kind)
+
+    builder = IndexBuilder(cap.kind)
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for clks, offset, size, pkt in _packets(cap, buf, cap.data_offset, len(buf)):
+                builder.packet(clks, offset, size, pkt)
+        finally:
+            buf.close()
+
+    if builder.size < os.path.getsize(path):
+        print("Stopping at bad or truncated record at offset %d" % builder.size, file=sys.stderr)
+
+    builder.write(index_path(path))
+    return builder
+
+
+class CaptureIndex:
+    """Read access to a capture file through its index ('path' plus
+    INDEX_SUFFIX unless given). Raises ValueError if the index is missing
+    parts, or was written for another kind of file or a longer one."""
+
+    def __init__(self, path, index=None):
+        self.cap = open_capture(path)
+
+        with open(index or index_path(path), "rb") as f:
+            data = f.read()
+
+        if len(data) < _index_header.size:
+            raise ValueError("index of %s is truncated" % path)
+        (magic, version, kind, self.block_clks, self.size, self.packet_count,
+         nblocks, nkeys) = _index_header.unpack_from(data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("%s is not an index this version can read" % (index or index_path(path)))
+        if KINDS[kind] != self.cap.kind or self.size > os.path.getsize(path):
+            raise ValueError("index does not match %s" % path)
+
+        pos = _index_header.size
+        self.block_start, pos = _read_array('q', data, pos, nblocks)
+        self.block_offset, pos = _read_array('Q', data, pos, nblocks)
+        self.block_packet, pos = _read_array('Q', data, pos, nblocks)
+
+        keys = []
+        for i in range(nkeys):
+            addr, endp, pid, length = _posting_header.unpack_from(data, pos)
+            keys.append(((addr, endp, pid), length))
+            pos += _posting_header.size
+
+        self.postings = {}
+        for key, length in keys:
+            self.postings[key], pos = _read_array('I', data, pos, length)
+
+        if len(self.block_packet) != nblocks or pos > len(data):
+            raise ValueError("index of %s is truncated" % path)
+
+        self.file = open(path, "rb")
+        self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def block_at(self, clks):
+        """Number of the block holding clock count 'clks'."""
+        return max(bisect.bisect_right(self.block_start, clks) - 1, 0)
+
+    def offset_at(self, clks):
+        """File offset to start reading at for the packets from 'clks' on."""
+        if not self.block_offset:
+            return self.size
+        return self.block_offset[self.block_at(clks)]
+
+    def __block_packets(self, block):
+        end = self.block_offset[block + 1] if block + 1 < len(self.block_offset) else self.size
+        return _packets(self.cap, self.buf, self.block_offset[block], end,
+                        self.block_start[block])
+
+    def packets(self, start, end):
+        """IndexedPackets with start <= clks < end."""
+        if not self.block_offset:
+            return
+        block = self.block_at(start)
+        for clks, offset, size, pkt in _packets(self.cap, self.buf, self.block_offset[block],
+                                                self.size, self.block_start[block]):
+            if clks >= end:
+                break
+            if clks >= start and pkt:
+                yield IndexedPacket(clks, offset, pkt)
+
+    def endpoints(self):
+        """The (addr, endp, pid) keys with posting lists."""
+        return sorted(self.postings)
+
+    def blocks(self, addr, endp, pid=None):
+        """Sorted numbers of the blocks with packets of endpoint addr.endp,
+        all PIDs or only 'pid' (4-bit PID)."""
+        if pid is not None:
+            return list(self.postings.get((addr, endp, pid), ()))
+        found = set()
+        for key, blocks in self.postings.items():
+            if key[:2] == (addr, endp):
+                found.update(blocks)
+        return sorted(found)
+
+    def find(self, addr, endp, pid=None, start=None, end=None):
+        """IndexedPackets of endpoint addr.endp (of PID 'pid' if given),
+        optionally only those with start <= clks < end. Only the blocks in
+        the posting lists are read."""
+        for block in self.blocks(addr, endp, pid):
+            if end is not None and self.block_start[block] >= end:
+                break
+            if start is not None and block + 1 < len(self.block_start) and \
+                    self.block_start[block + 1] <= start:
+                continue
+
+            endpoint = None
+            for clks, offset, size, pkt in self.__block_packets(block):
+                if not pkt:
+                    continue
+                p = pkt[0] & 0xF
+                if p in TOKEN_PIDS:
+                    endpoint = None
+                    if (pkt[0] >> 4) ^ 0xF == p and len(pkt) >= 3:
+                        endpoint = (pkt[1] & 0x7F, (pkt[2] & 0x7) << 1 | pkt[1] >> 7)
+                elif p == PID_SOF:
+                    endpoint = None
+                    continue
+                elif p == PID_SPLIT:
+                    continue
+
+                if endpoint == (addr, endp) and (pid is None or p == pid) and \
+                        (start is None or clks >= start) and (end is None or clks < end):
+                    yield IndexedPacket(clks, offset, pkt)
+
+                if p in HANDSHAKE_PIDS:
+                    endpoint = None
+
+    def around(self, clks, span=CLOCK_HZ // 100):
+        """IndexedPackets in the 'span' clocks (default 10 ms) centred on
+        'clks'."""
+        return self.packets(clks - span // 2, clks + span // 2)
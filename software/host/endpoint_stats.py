@@ -0,0 +1,218 @@
+#
+# Per-endpoint traffic statistics over rolling windows
+#
+# EndpointStats is fed batches of captured packets (see
+# RXCSniff.batch_handlers) and counts transactions, packets, payload
+# bytes, handshakes and errors for every (address, endpoint) in 100 ms
+# slots of capture time. Each endpoint's slots live in one preallocated
+# array that is used as a ring. Memory therefore does not grow with the
+# length of the capture, and any window up to the ring's length is the
+# sum of its last few slots.
+#
+
+import collections
+import json
+import threading
+import time
+
+from array import array
+
+from outputs import CLOCK_HZ
+
+SLOT_CLKS = CLOCK_HZ // 10
+SLOTS = 640                 # a little over the longest window
+WINDOWS = (1, 10, 60)       # seconds
+
+COUNTERS = ['transactions', 'packets', 'bytes', 'acks', 'naks', 'stalls',
+            'nyets', 'errors']
+TRANSACTIONS, PACKETS, BYTES, ACKS, NAKS, STALLS, NYETS, ERRORS = range(len(COUNTERS))
+
+TOKEN_PIDS = (0x1, 0x9, 0xD, 0x4)           # OUT, IN, SETUP, PING
+DATA_PIDS = (0x3, 0xB, 0x7, 0xF)
+HANDSHAKES = {0x2: ACKS, 0xA: NAKS, 0xE: STALLS, 0x6: NYETS}
+PID_SOF = 0x5
+
+# Device error flags (HF0_ERR..HF0_TRUNC) and HF_CRC_BAD
+ERROR_FLAGS = 0x800F
+
+# Totals for one endpoint over the last 'seconds' of capture time, which
+# is 'window' unless the capture is younger than that. 'bytes' counts
+# DATA payloads without PID and CRC.
+EndpointWindow = collections.namedtuple('EndpointWindow',
+        ['addr', 'endp', 'window', 'seconds'] + COUNTERS)
+
+
+class EndpointStats:
+    """Rolling per-endpoint counters. Pass handle_batch to
+    RXCSniff.batch_handlers; snapshot() may be called from any thread.
+
+    Data packets and handshakes are counted against the endpoint of the
+    token before them. Tokens received with errors are not attributed
+    (their address cannot be trusted), and at most 'max_endpoints'
+    endpoints are tracked, each taking SLOTS * len(COUNTERS) counters.
+    """
+
+    def __init__(self, max_endpoints=128):
+        self.max_endpoints = max_endpoints
+        self.endpoints = {}         # (addr, endp) -> array of counters
+        self.untracked = 0          # tokens for endpoints over the limit
+        self.lock = threading.Lock()
+
+        # Current and first 100 ms slot, in capture time
+        self.slot = None
+        self.first_slot = None
+
+        # Counters of the endpoint of the last token, until its handshake
+        self.current = None
+
+        self.zero = array('I', [0]) * len(COUNTERS)
+
+    def handle_batch(self, batch):
+        buf, offsets, lengths, flags, tss = batch.buf, batch.offsets, batch.lengths, batch.flags, batch.ts
+        ncounters = len(COUNTERS)
+
+        with self.lock:
+            counts = self.current
+            slot = self.slot
+            base = 0 if slot is None else slot % SLOTS * ncounters
+
+            for i in range(len(offsets)):
+                n = lengths[i]
+                if not n:
+                    continue
+
+                s = tss[i] // SLOT_CLKS
+                if slot is None or s > slot:
+                    self.__advance(s)
+                    slot = s
+                    base = s % SLOTS * ncounters
+
+                pos = offsets[i]
+                pid = buf[pos] & 0xF
+                bad = flags[i] & ERROR_FLAGS or (buf[pos] >> 4) ^ 0xF != pid
+
+                if pid in TOKEN_PIDS:
+                    if bad or n < 3:
+                        counts = None
+                        continue
+                    key = (buf[pos + 1] & 0x7F, (buf[pos + 2] & 0x7) << 1 | buf[pos + 1] >> 7)
+                    counts = self.endpoints.get(key)
+                    if counts is None:
+                        counts = self.__add(key)
+                        if counts is None:
+                            continue
+                    counts[base + TRANSACTIONS] += 1
+                    counts[base + PACKETS] += 1
+                elif counts is None:
+                    continue
+                elif pid in DATA_PIDS:
+                    counts[base + PACKETS] += 1
+                    if n >= 3:
+                        counts[base + BYTES] += n - 3
+                    if bad:
+                        counts[base + ERRORS] += 1
+                elif pid in HANDSHAKES:
+                    counts[base + PACKETS] += 1
+                    counts[base + HANDSHAKES[pid]] += 1
+                    if bad:
+                        counts[base + ERRORS] += 1
+                    counts = None
+                elif pid == PID_SOF:
+                    counts = None
+
+            self.current = counts
+
+    def __add(self, key):
+        if len(self.endpoints) >= self.max_endpoints:
+            self.untracked += 1
+            return None
+        counts = self.endpoints[key] = array('I', [0]) * (SLOTS * len(COUNTERS))
+        return counts
+
+    def __advance(self, slot):
+        # Clear the slots between the current one and 'slot'
+        if self.slot is None:
+            self.slot = self.first_slot = slot
+            return
+
+        ncounters = len(COUNTERS)
+        for s in range(self.slot + 1, self.slot + 1 + min(slot - self.slot, SLOTS)):
+            start = s % SLOTS * ncounters
+            for counts in self.endpoints.values():
+                counts[start:start + ncounters] = self.zero
+        self.slot = slot
+
+    def snapshot(self, windows=WINDOWS):
+        """EndpointWindow totals for every endpoint and each window in
+        'windows' (seconds, up to SLOTS / 10), over the most recent
+        complete slots."""
+        ncounters = len(COUNTERS)
+        result = []
+
+        with self.lock:
+            if self.slot is None:
+                return result
+
+            for (addr, endp), counts in sorted(self.endpoints.items()):
+                for window in windows:
+                    nslots = min(window * 10, self.slot - self.first_slot, SLOTS - 1)
+                    totals = [0] * ncounters
+                    for s in range(self.slot - nslots, self.slot):
+                        start = s % SLOTS * ncounters
+                        for c in range(ncounters):
+                            totals[c] += counts[start + c]
+                    result.append(EndpointWindow(addr, endp, window, nslots / 10, *totals))
+
+        return result
+
+
+def rates(w):
+    """Per-second rates and handshake ratios of EndpointWindow 'w'."""
+    per_s = 1 / w.seconds if w.seconds else 0
+    per_t = 1 / w.transactions if w.transactions else 0
+    return {
+        "bytes_per_s": w.bytes * per_s,
+        "packets_per_s": w.packets * per_s,
+        "transactions_per_s": w.transactions * per_s,
+        "nak_ratio": w.naks * per_t,
+        "stall_ratio": w.stalls * per_t,
+        "nyet_ratio": w.nyets * per_t,
+        "errors": w.errors,
+    }
+
+def _by_endpoint(snapshot):
+    # Endpoints with traffic in any window, in order, with their windows
+    endpoints = collections.OrderedDict()
+    for w in snapshot:
+        endpoints.setdefault((w.addr, w.endp), []).append(w)
+    return [(key, ws) for key, ws in endpoints.items()
+            if any(w.packets for w in ws)]
+
+def format_stats(snapshot):
+    """Report lines for 'snapshot' (see EndpointStats.snapshot), one per
+    endpoint that has seen traffic."""
+    lines = []
+    for (addr, endp), ws in _by_endpoint(snapshot):
+        parts = []
+        for w in ws:
+            r = rates(w)
+            parts.append("%2ds %9.1f kB/s %7.0f pkt/s NAK %5.1f%% NYET %5.1f%% STALL %d ERR %d" %
+                (w.window, r["bytes_per_s"] / 1000, r["packets_per_s"],
+                 r["nak_ratio"] * 100, r["nyet_ratio"] * 100, w.stalls, w.errors))
+        lines.append("%3d.%-2d %s" % (addr, endp, " | ".join(parts)))
+    return lines
+
+def stats_json(snapshot):
+    """One JSON line for 'snapshot': the wall clock time and, for each
+    endpoint that has seen traffic, the counters and rates per window."""
+    endpoints = []
+    for (addr, endp), ws in _by_endpoint(snapshot):
+        windows = {}
+        for w in ws:
+            entry = {name: getattr(w, name) for name in COUNTERS}
+            entry.update(rates(w))
+            entry["seconds"] = w.seconds
+            windows[str(w.window)] = entry
+        endpoints.append({"addr": addr, "endp": endp, "windows": windows})
+
+    return json.dumps({"time": time.time(), "endpoints": endpoints})
@@ -36,12 +36,27 @@
 #endif
 #include "fastftdi.h"
 
-typedef struct {
+struct FTDIStream {
+   FTDIDevice *dev;
    FTDIStreamCallback *callback;
    void *userdata;
    int result;
+   volatile int stop;
+   int cancelling;      // transfers are being reaped; don't resubmit
    FTDIProgressInfo progress;
-} FTDIStreamState;
+
+   struct libusb_transfer **transfers;
+   int numTransfers;
+   long pollUsec;
+
+   // Batching; batch == NULL means every packet is delivered on its own
+   uint8_t *batch;
+   int batchSize;
+   int batchLen;
+   double batchLatency;
+   struct timeval batchStart;
+};
+
 
 static int
 DeviceInit(FTDIDevice *dev)
@@ -284,51 +299,92 @@ FTDIDevice_ReadByteSync(FTDIDevice *dev, FTDIInterface interface, uint8_t *byte)
 
 
 /*
- * Internal callback for one transfer's worth of stream data.
- * Split it into packets and invoke the callbacks.
+ * Hand the accumulated batch to the callback, if there is one. After an
+ * error the callback is not called any more, and the batch is kept.
  */
 
-static void LIBUSB_CALL
-ReadStreamCallback(struct libusb_transfer *transfer)
+static void
+ReadStreamFlushBatch(FTDIStream *state)
 {
-   FTDIStreamState *state = transfer->user_data;
-   int err;
+   if (state->batchLen && state->result == 0) {
+      state->result = state->callback(state->batch, state->batchLen,
+                                      NULL, state->userdata);
+      state->batchLen = 0;
+   }
+}
 
-   if (state->result == 0) {
-      if (transfer->status == LIBUSB_TRANSFER_COMPLETED) {
 
-         int i;
-         uint8_t *ptr = transfer->buffer;
-         int length = transfer->actual_length;
-         int numPackets = (length + FTDI_PACKET_SIZE - 1) >> FTDI_LOG_PACKET_SIZE;
+/*
+ * Split one transfer's worth of stream data into packets and invoke the
+ * callback, or append the payloads to the current batch. Once the stream
+ * has failed, payloads still go into the batch as long as they fit.
+ */
 
-         for (i = 0; i < numPackets; i++) {
-            int payloadLen;
-            int packetLen = length;
+static void
+ReadStreamData(FTDIStream *state, uint8_t *ptr, int length)
+{
+   int i;
+   int numPackets = (length + FTDI_PACKET_SIZE - 1) >> FTDI_LOG_PACKET_SIZE;
+
+   if (state->batch && state->batchLen + length > state->batchSize)
+      ReadStreamFlushBatch(state);
+
+   for (i = 0; i < numPackets; i++) {
+      int payloadLen;
+      int packetLen = length;
+
+      if (packetLen > FTDI_PACKET_SIZE)
+         packetLen = FTDI_PACKET_SIZE;
+
+      payloadLen = packetLen - FTDI_HEADER_SIZE;
+      if (payloadLen < 0)
+         break;
+
+      if (state->batch) {
+         if (state->batchLen + payloadLen > state->batchSize)
+            break;
+         if (state->batchLen == 0)
+            gettimeofday(&state->batchStart, NULL);
+
+         memcpy(state->batch + state->batchLen, ptr + FTDI_HEADER_SIZE,
+                payloadLen);
+         state->batchLen += payloadLen;
+      } else if (state->result == 0) {
+         state->result = state->callback(ptr + FTDI_HEADER_SIZE, payloadLen,
+                                         NULL, state->userdata);
+      } else {
+         break;
+      }
+      state->progress.current.totalBytes += payloadLen;
 
-            if (packetLen > FTDI_PACKET_SIZE)
-               packetLen = FTDI_PACKET_SIZE;
+      ptr += packetLen;
+      length -= packetLen;
+   }
+}
 
-            payloadLen = packetLen - FTDI_HEADER_SIZE;
-            state->progress.current.totalBytes += payloadLen;
 
-            state->result = state->callback(ptr + FTDI_HEADER_SIZE, payloadLen,
-                                            NULL, state->userdata);
-            if (state->result)
-               break;
+/*
+ * Internal callback for one transfer's worth of stream data. Transfers
+ * cancelled while the stream is being stopped may still carry data.
+ */
 
-            ptr += packetLen;
-            length -= packetLen;
-         }
+static void LIBUSB_CALL
+ReadStreamCallback(struct libusb_transfer *transfer)
+{
+   FTDIStream *state = transfer->user_data;
 
-      } else {
-         state->result = LIBUSB_ERROR_IO;
-      }
+   if (transfer->status == LIBUSB_TRANSFER_COMPLETED ||
+       (transfer->status == LIBUSB_TRANSFER_CANCELLED && state->cancelling)) {
+      ReadStreamData(state, transfer->buffer, transfer->actual_length);
+   } else if (state->result == 0) {
+      state->result = LIBUSB_ERROR_IO;
    }
 
-   if (state->result == 0) {
+   if (state->result == 0 && !state->cancelling) {
       transfer->status = -1;
       state->result = libusb_submit_transfer(transfer);
+      if (state->result)
+         transfer->status = LIBUSB_TRANSFER_ERROR;
    }
 }
 
@@ -356,66 +412,229 @@ FTDIDevice_ReadStream(FTDIDevice *dev, FTDIInterface interface,
                       FTDIStreamCallback *callback, void *userdata,
                       int packetsPerTransfer, int numTransfers)
 {
-   struct libusb_transfer **transfers;
-   FTDIStreamState state = { callback, userdata };
+   return FTDIDevice_ReadStreamBatched(dev, interface, callback, userdata,
+                                       packetsPerTransfer, numTransfers, 0, 0);
+}
+
+
+/*
+ * Like FTDIDevice_ReadStream, but the payloads of completed transfers
+ * are gathered into a preallocated buffer of 'batchSize' bytes and the
+ * callback is invoked once per batch. A batch is delivered when the next
+ * transfer would not fit, or once its oldest data is 'latencyMs' old.
+ *
+ * A batchSize of 0 disables batching.
+ */
+
+int
+FTDIDevice_ReadStreamBatched(FTDIDevice *dev, FTDIInterface interface,
+                             FTDIStreamCallback *callback, void *userdata,
+                             int packetsPerTransfer, int numTransfers,
+                             int batchSize, int latencyMs)
+{
+   FTDIStream *stream;
+   int err;
+
+   stream = FTDIStream_New(dev, interface, callback, userdata,
+                           packetsPerTransfer, numTransfers,
+                           batchSize, latencyMs);
+   if (!stream)
+      return LIBUSB_ERROR_NO_MEM;
+
+   err = FTDIStream_Run(stream);
+   FTDIStream_Free(stream);
+
+   return err;
+}
+
+
+/*
+ * A stream session owns its transfers and batch buffer across any number
+ * of FTDIStream_Run calls, so a long-running capture never has to tear
+ * them down and reallocate them.
+ */
+
+FTDIStream *
+FTDIStream_New(FTDIDevice *dev, FTDIInterface interface,
+               FTDIStreamCallback *callback, void *userdata,
+               int packetsPerTransfer, int numTransfers,
+               int batchSize, int latencyMs)
+{
+   FTDIStream *stream;
    int bufferSize = packetsPerTransfer * FTDI_PACKET_SIZE;
    int xferIndex;
-   int err = 0;
+
+   stream = calloc(1, sizeof *stream);
+   if (!stream)
+      return NULL;
+
+   stream->dev = dev;
+   stream->callback = callback;
+   stream->userdata = userdata;
+   stream->pollUsec = 10000;
+
+   if (batchSize) {
+      if (batchSize < bufferSize)
+         batchSize = bufferSize;
+
+      stream->batch = malloc(batchSize);
+      if (!stream->batch)
+         goto fail;
+      stream->batchSize = batchSize;
+      stream->batchLatency = latencyMs * 1e-3;
+
+      if (latencyMs * 1000L < stream->pollUsec)
+         stream->pollUsec = latencyMs > 0 ? latencyMs * 1000L : 1000;
+   }
 
    /*
     * Set up all transfers
     */
 
-   transfers = calloc(numTransfers, sizeof *transfers);
-   if (!transfers) {
-      err = LIBUSB_ERROR_NO_MEM;
-      goto cleanup;
-   }
+   stream->transfers = calloc(numTransfers, sizeof *stream->transfers);
+   if (!stream->transfers)
+      goto fail;
+   stream->numTransfers = numTransfers;
 
    for (xferIndex = 0; xferIndex < numTransfers; xferIndex++) {
       struct libusb_transfer *transfer;
 
       transfer = libusb_alloc_transfer(0);
-      transfers[xferIndex] = transfer;
-      if (!transfer) {
-         err = LIBUSB_ERROR_NO_MEM;
-         goto cleanup;
-      }
+      stream->transfers[xferIndex] = transfer;
+      if (!transfer)
+         goto fail;
 
       libusb_fill_bulk_transfer(transfer, dev->handle, FTDI_EP_IN(interface),
                                 malloc(bufferSize), bufferSize, ReadStreamCallback,
-                                &state, 0);
+                                stream, 0);
 
-      if (!transfer->buffer) {
-         err = LIBUSB_ERROR_NO_MEM;
-         goto cleanup;
+      if (!transfer->buffer)
+         goto fail;
+
+      transfer->status = LIBUSB_TRANSFER_CANCELLED;
+   }
+
+   return stream;
+
+ fail:
+   FTDIStream_Free(stream);
+   return NULL;
+}
+
+
+void
+FTDIStream_Free(FTDIStream *stream)
+{
+   int xferIndex;
+
+   if (!stream)
+      return;
+
+   if (stream->transfers) {
+      for (xferIndex = 0; xferIndex < stream->numTransfers; xferIndex++) {
+         struct libusb_transfer *transfer = stream->transfers[xferIndex];
+
+         if (transfer) {
+            free(transfer->buffer);
+            libusb_free_transfer(transfer);
+         }
       }
+      free(stream->transfers);
+   }
+
+   free(stream->batch);
+   free(stream);
+}
+
+
+/*
+ * Ask a running FTDIStream_Run to return. Safe to call from another
+ * thread; the request is noticed within one poll interval.
+ */
+
+void
+FTDIStream_Stop(FTDIStream *stream)
+{
+   stream->stop = 1;
+}
+
+
+/*
+ * Clear a stop request, so that the next FTDIStream_Run streams again.
+ * FTDIStream_Run leaves the request alone, so a stop that arrives before
+ * the run has started is not lost.
+ */
+
+void
+FTDIStream_Reset(FTDIStream *stream)
+{
+   stream->stop = 0;
+}
+
+
+/*
+ * Submit all transfers and stream until FTDIStream_Stop is called, an
+ * error occurs or the callback returns a nonzero value. Outstanding
+ * transfers are cancelled and reaped before returning, so the stream can
+ * be run again; once stopped, only after FTDIStream_Reset. Returns 0 when
+ * stopped, otherwise a libusb error code or the callback's return value.
+ */
+
+int
+FTDIStream_Run(FTDIStream *stream)
+{
+   FTDIDevice *dev = stream->dev;
+   int xferIndex;
+   int err = 0;
+
+   stream->result = 0;
+   stream->cancelling = 0;
+   memset(&stream->progress, 0, sizeof stream->progress);
+
+   if (stream->stop) {
+      ReadStreamFlushBatch(stream);
+      return stream->result;
+   }
+
+   for (xferIndex = 0; xferIndex < stream->numTransfers; xferIndex++) {
+      struct libusb_transfer *transfer = stream->transfers[xferIndex];
 
       transfer->status = -1;
       err = libusb_submit_transfer(transfer);
-      if (err)
+      if (err) {
+         transfer->status = LIBUSB_TRANSFER_ERROR;
          goto cleanup;
+      }
    }
 
    /*
     * Run the transfers, and periodically assess progress.
     */
 
-   gettimeofday(&state.progress.first.time, NULL);
+   gettimeofday(&stream->progress.first.time, NULL);
 
    do {
-      FTDIProgressInfo  *progress = &state.progress;
+      FTDIProgressInfo  *progress = &stream->progress;
       const double progressInterval = 0.1;
-      struct timeval timeout = { 0, 10000 };
+      struct timeval timeout = { 0, stream->pollUsec };
       struct timeval now;
 
-      int err = libusb_handle_events_timeout(dev->libusb, &timeout);
-      if (!state.result) {
-         state.result = err;
+      int ret = libusb_handle_events_timeout(dev->libusb, &timeout);
+      if (!stream->result) {
+         stream->result = ret;
       }
 
-      // If enough time has elapsed, update the progress
       gettimeofday(&now, NULL);
+
+      // Don't let a partial batch sit around longer than requested
+      if (stream->batchLen &&
+          TimevalDiff(&now, &stream->batchStart) >= stream->batchLatency) {
+         ReadStreamFlushBatch(stream);
+         if (stream->result)
+            break;
+      }
+
+      // If enough time has elapsed, update the progress
       if (TimevalDiff(&now, &progress->current.time) >= progressInterval) {
 
          progress->current.time = now;
@@ -435,54 +654,52 @@ FTDIDevice_ReadStream(FTDIDevice *dev, FTDIInterface interface,
                                      progress->prev.totalBytes) / currentTime;
          }
 
-         state.result = state.callback(NULL, 0, progress, state.userdata);
+         stream->result = stream->callback(NULL, 0, progress, stream->userdata);
          progress->prev = progress->current;
       }
-   } while (!state.result);
+   } while (!stream->result && !stream->stop);
 
    /*
-    * Cancel any outstanding transfers, and free memory.
+    * Cancel any outstanding transfers and wait for them to come back.
     */
 
  cleanup:
-   if (transfers) {
-      bool done_cleanup = false;
-      while (!done_cleanup)
-      {
-          struct timeval timeout = { 0, 10000 };
-          done_cleanup = true;
-
-          for (xferIndex = 0; xferIndex < numTransfers; xferIndex++) {
-             struct libusb_transfer *transfer = transfers[xferIndex];
-
-             if (transfer) {
-                // If a transfer is in progress, cancel it
-                if (transfer->status == -1) {
-                   libusb_cancel_transfer(transfer);
-
-                   // And we need to wait until we get a clean sweep
-                   done_cleanup = false;
-
-                // If a transfer is complete or cancelled, nuke it
-                } else if (transfer->status == 0 ||
-                        transfer->status == LIBUSB_TRANSFER_CANCELLED) {
-                    free(transfer->buffer);
-                    libusb_free_transfer(transfer);
-                    transfers[xferIndex] = NULL;
-                }
-             }
-          }
-
-          // pump events
-          libusb_handle_events_timeout(dev->libusb, &timeout);
+   for (;;) {
+      struct timeval timeout = { 0, 10000 };
+      bool done_cleanup = true;
+
+      for (xferIndex = 0; xferIndex < stream->numTransfers; xferIndex++) {
+         struct libusb_transfer *transfer = stream->transfers[xferIndex];
+
+         // If a transfer is in progress, cancel it, and wait until we get
+         // a clean sweep
+         if (transfer->status == -1) {
+            libusb_cancel_transfer(transfer);
+            done_cleanup = false;
+         }
       }
-      free(transfers);
+
+      if (done_cleanup)
+         break;
+
+      // pump events; stop the callback from resubmitting
+      stream->cancelling = 1;
+      libusb_handle_events_timeout(dev->libusb, &timeout);
    }
+   stream->cancelling = 0;
+
+   /*
+    * Hand over the rest of the batch, including what the cancelled
+    * transfers brought in. If the run failed it is kept instead, and goes
+    * out first on the next run.
+    */
+
+   ReadStreamFlushBatch(stream);
 
    if (err)
       return err;
    else
-      return state.result;
+      return stream->result;
 }
 
 /* MPSSE mode support -- see
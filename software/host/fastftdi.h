@@ -113,6 +113,8 @@ typedef struct {
 typedef int (FTDIStreamCallback)(uint8_t *buffer, int length,
                                  FTDIProgressInfo *progress, void *userdata);
 
+typedef struct FTDIStream FTDIStream;
+
 
 /*
  * Public Functions
@@ -135,6 +137,19 @@ OV_API int FTDIDevice_ReadByteSync(FTDIDevice *dev, FTDIInterface interface, uin
 OV_API int FTDIDevice_ReadStream(FTDIDevice *dev, FTDIInterface interface,
                           FTDIStreamCallback *callback, void *userdata,
                           int packetsPerTransfer, int numTransfers);
+OV_API int FTDIDevice_ReadStreamBatched(FTDIDevice *dev, FTDIInterface interface,
+                                 FTDIStreamCallback *callback, void *userdata,
+                                 int packetsPerTransfer, int numTransfers,
+                                 int batchSize, int latencyMs);
+
+OV_API FTDIStream *FTDIStream_New(FTDIDevice *dev, FTDIInterface interface,
+                           FTDIStreamCallback *callback, void *userdata,
+                           int packetsPerTransfer, int numTransfers,
+                           int batchSize, int latencyMs);
+OV_API void FTDIStream_Free(FTDIStream *stream);
+OV_API int FTDIStream_Run(FTDIStream *stream);
+OV_API void FTDIStream_Stop(FTDIStream *stream);
+OV_API void FTDIStream_Reset(FTDIStream *stream);
 
 OV_API int FTDIDevice_MPSSE_Enable(FTDIDevice *dev, FTDIInterface interface);
 OV_API int FTDIDevice_MPSSE_SetDivisor(FTDIDevice *dev, FTDIInterface interface,
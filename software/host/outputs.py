@@ -0,0 +1,1532 @@
+#
+# Capture output formats for ovctl sniff
+#
+# Each output is fed packets through handle_usb(ts, pkt, flags), where ts
+# is the raw 24-bit 60 MHz device timestamp, and writes bytes to 'output'.
+# Outputs can also be started partway into a capture with resume(), which
+# is what lets several processes decode independent chunks of one stream.
+# Outputs may buffer, so call flush() before closing 'output'; those that
+# can take whole batches of raw records also have handle_records(), and
+# those that can show a summary of idle traffic have handle_run() (see
+# Collapser).
+#
+
+import collections
+import concurrent.futures
+import gzip
+import lzma
+import os
+import string
+import struct
+import sys
+import threading
+import time
+
+import LibOV
+from usb_interp import USBInterpreter
+from usb_transfers import TransferTracker
+
+# Optional: batch encoding for some of the outputs
+try:
+    import numpy as np
+    import record_scan
+except ImportError:
+    record_scan = None
+
+CLOCK_HZ = 60000000
+TS_WRAP = 1 << 24
+
+# Where decoding of a chunk of records starts: the last raw timestamp seen
+# before it and the accumulated wrap offset, the absolute times of the last
+# displayed packet and of the last non-SOF data packet (None if there was
+# none yet), and the SOF frame/subframe tracking of the verbose decoder.
+DecodeState = collections.namedtuple('DecodeState',
+        ['last_ts', 'ts_base', 'last_print_ts', 'last_data_ts',
+         'frameno', 'subframe', 'last_ts_frame'])
+
+INITIAL_STATE = DecodeState(0, 0, 0, None, None, 0, 0)
+
+# Records rebuilt from a file with absolute times (a pcap) can be further
+# apart than one timestamp wrap. Such records are listed as "jumps", pairs
+# of (record index, absolute clock count), and the wrap tracking is set
+# again from the absolute time at each of them.
+
+def seed_state(state, clks):
+    """Return 'state' with its timestamp tracking set so that a record at
+    absolute clock count 'clks' comes out at 'clks'."""
+    ts = clks & (TS_WRAP - 1)
+    return state._replace(last_ts=ts, ts_base=clks - ts)
+
+def advance_state(state, records, count, jumps=()):
+    """Return the DecodeState after 'count' back-to-back 0xA0 records, with
+    the given jumps."""
+    last_ts, ts_base, last_print_ts, last_data_ts = state[:4]
+    jumps = dict(jumps)
+
+    # Only SOFs are fed through, which keeps this cheap next to decoding
+    frames = USBInterpreter(True)
+    frames.frameno, frames.subframe, frames.last_ts_frame = state[4:]
+
+    for i, (pos, flags, length, ts) in enumerate(LibOV.iter_records(records, count)):
+        if i in jumps:
+            ts_base = jumps[i] - ts
+        elif ts < last_ts:
+            ts_base += TS_WRAP
+        last_ts = ts
+
+        pid = records[pos + 8] if length else None
+        if pid == 0xa5 and length >= 3:
+            frames.trackFrame(ts_base + ts, records[pos + 9] | records[pos + 10] << 8 & 0x7)
+        else:
+            last_print_ts = ts_base + ts
+            if pid is not None and pid != 0xa5:
+                last_data_ts = ts_base + ts
+
+    return DecodeState(last_ts, ts_base, last_print_ts, last_data_ts,
+                       frames.frameno, frames.subframe, frames.last_ts_frame)
+
+
+# Summary of a chunk of records that does not depend on where the chunk
+# starts, so that the chunks of a capture file can be summarised in
+# parallel and the DecodeState at each boundary worked out afterwards (see
+# apply_summary). Absolute times are relative to the chunk's own wrap base,
+# unless the chunk starts with a jump: then 'first_clks' is the absolute
+# time of its first record, and so are all of its times.
+# SOF tracking is only replayed over the first SOF_PREFIX SOFs; after that
+# it has normally converged to what a cold start gives.
+ChunkSummary = collections.namedtuple('ChunkSummary',
+        ['first_ts', 'last_ts', 'wraps', 'last_print_ts', 'last_data_ts',
+         'sofs', 'sof_count', 'prefix_frame', 'end_frame', 'first_clks'])
+
+SOF_PREFIX = 32
+
+def summarize(records, count, jumps=()):
+    """Return the ChunkSummary of 'count' back-to-back 0xA0 records, with
+    the given jumps."""
+    jumps = dict(jumps)
+    first_ts = None
+    last_ts = 0
+    ts_base = 0
+    last_print_ts = None
+    last_data_ts = None
+
+    frames = USBInterpreter(True)
+    sofs = []
+    sof_count = 0
+    prefix_frame = None
+
+    for i, (pos, flags, length, ts) in enumerate(LibOV.iter_records(records, count)):
+        if i in jumps:
+            ts_base = jumps[i] - ts
+        elif first_ts is not None and ts < last_ts:
+            ts_base += TS_WRAP
+        if first_ts is None:
+            first_ts = ts
+        last_ts = ts
+
+        pid = records[pos + 8] if length else None
+        if pid == 0xa5 and length >= 3:
+            frameno = records[pos + 9] | records[pos + 10] << 8 & 0x7
+            if sof_count < SOF_PREFIX:
+                sofs.append((ts_base + ts, frameno))
+
+            frames.trackFrame(ts_base + ts, frameno)
+            sof_count += 1
+            if sof_count == SOF_PREFIX:
+                prefix_frame = (frames.frameno, frames.subframe)
+        else:
+            last_print_ts = ts_base + ts
+            if pid is not None and pid != 0xa5:
+                last_data_ts = ts_base + ts
+
+    return ChunkSummary(first_ts, last_ts, ts_base // TS_WRAP, last_print_ts,
+            last_data_ts, sofs, sof_count, prefix_frame,
+            (frames.frameno, frames.subframe, frames.last_ts_frame), jumps.get(0))
+
+def apply_summary(state, summary):
+    """Return the DecodeState after a chunk starting at 'state', or None if
+    the SOF tracking did not converge and advance_state() is needed."""
+    if summary.first_ts is None:
+        return state
+
+    if summary.first_clks is not None:
+        base = 0
+    else:
+        base = state.ts_base
+        if summary.first_ts < state.last_ts:
+            base += TS_WRAP
+
+    last_print_ts = state.last_print_ts
+    if summary.last_print_ts is not None:
+        last_print_ts = base + summary.last_print_ts
+
+    last_data_ts = state.last_data_ts
+    if summary.last_data_ts is not None:
+        last_data_ts = base + summary.last_data_ts
+
+    frames = USBInterpreter(True)
+    frames.frameno, frames.subframe, frames.last_ts_frame = state[4:]
+    for ts, frameno in summary.sofs:
+        frames.trackFrame(base + ts, frameno)
+
+    if summary.sof_count > len(summary.sofs):
+        if (frames.frameno, frames.subframe) != summary.prefix_frame:
+            return None
+        frameno, subframe, last_ts_frame = summary.end_frame
+        frames.frameno, frames.subframe = frameno, subframe
+        frames.last_ts_frame = base + last_ts_frame
+
+    return DecodeState(summary.last_ts, base + summary.wraps * TS_WRAP,
+            last_print_ts, last_data_ts,
+            frames.frameno, frames.subframe, frames.last_ts_frame)
+
+
+class StreamClock:
+    """Turns the device's wrapping 24-bit timestamps into 64-bit clock
+    counts, assuming no more than one wrap between consecutive packets."""
+
+    __slots__ = ('last_ts', 'base')
+
+    def __init__(self, last_ts=0, base=0):
+        self.last_ts = last_ts
+        self.base = base
+
+    def __call__(self, ts):
+        if ts < self.last_ts:
+            self.base += TS_WRAP
+        self.last_ts = ts
+        return self.base + ts
+
+
+# Idle traffic folded by Collapser: SOFs, and IN or PING tokens answered
+# with NAK
+PID_SOF = 0xa5
+PID_NAK = 0x5a
+POLL_TOKENS = (0x69, 0xb4)
+
+# A stretch of collapsed packets. 'start' and 'end' are the absolute clock
+# counts of its first and last packet and 'start_ts' / 'end_ts' their raw
+# 24-bit timestamps, for outputs keeping their own clock. 'frames' is a
+# list of (clks, frameno) for each SOF; 'naks' counts the token/NAK pairs
+# by (token pid, addr, endp).
+Run = collections.namedtuple('Run',
+        ['start', 'end', 'start_ts', 'end_ts', 'frames', 'naks'])
+
+def format_run(run):
+    """One-line description of 'run', e.g.
+    "800 SOF (frame 12-112), 1600 IN/NAK 3.1, 2.000 ms"."""
+    parts = []
+    if run.frames:
+        parts.append("%d SOF (frame %d-%d)" % (len(run.frames), run.frames[0][1], run.frames[-1][1]))
+    for (pid, addr, endp), n in sorted(run.naks.items()):
+        parts.append("%d %s/NAK %d.%d" % (n, PID_NAMES[pid & 0xF], addr, endp))
+    parts.append("%.3f ms" % ((run.end - run.start) * 1000 / CLOCK_HZ))
+    return ", ".join(parts)
+
+
+class Collapser:
+    """Output wrapper folding idle bus traffic into Runs for 'output',
+    which must have handle_run(run) and renders each Run its own way.
+    Everything else is passed through unchanged and in order.
+
+    Only packets without flags are collapsed. Stretches of fewer than
+    'min_packets' packets are passed through as they are, and a Run is
+    closed once it spans 'max_span' clocks, so that outputs still see a
+    timestamp at least that often (it must be under one timestamp wrap).
+    """
+
+    def __init__(self, output, min_packets=16, max_span=CLOCK_HZ // 10):
+        assert max_span < TS_WRAP
+
+        self.output = output
+        self.min_packets = min_packets
+        self.max_span = max_span
+        self.clock = StreamClock()
+
+        # Token waiting to see whether a NAK follows: (clks, ts, pkt)
+        self.held = None
+
+        # The open run, and its packets as long as it is too short to
+        # collapse: list of (ts, pkt)
+        self.start = None
+        self.start_ts = None
+        self.end = None
+        self.end_ts = None
+        self.frames = []
+        self.naks = collections.Counter()
+        self.count = 0
+        self.packets = []
+
+    def resume(self, state):
+        self.clock = StreamClock(state.last_ts, state.ts_base)
+        self.output.resume(state)
+
+    def __add(self, clks, ts, pkt):
+        if self.count and clks - self.start >= self.max_span:
+            self.__end_run()
+
+        if not self.count:
+            self.start, self.start_ts = clks, ts
+        self.end, self.end_ts = clks, ts
+        self.count += 1
+
+        if self.count <= self.min_packets:
+            self.packets.append((ts, pkt))
+            if self.count == self.min_packets:
+                self.packets = []
+
+    def __end_run(self):
+        if not self.count:
+            return
+
+        if self.count < self.min_packets:
+            for ts, pkt in self.packets:
+                self.output.handle_usb(ts, pkt, 0)
+        else:
+            self.output.handle_run(Run(self.start, self.end, self.start_ts, self.end_ts,
+                                       self.frames, self.naks))
+
+        self.frames = []
+        self.naks = collections.Counter()
+        self.count = 0
+        self.packets = []
+
+    def __release(self):
+        # Pass on a held token that turned out not to be polling
+        clks, ts, pkt = self.held
+        self.held = None
+        self.__end_run()
+        self.output.handle_usb(ts, pkt, 0)
+
+    def handle_usb(self, ts, pkt, flags):
+        clks = self.clock(ts)
+
+        if self.held is not None:
+            if len(pkt) == 1 and pkt[0] == PID_NAK and not flags:
+                tclks, tts, tpkt = self.held
+                self.held = None
+                self.__add(tclks, tts, tpkt)
+                self.__add(clks, ts, pkt)
+                self.naks[tpkt[0], tpkt[1] & 0x7F, (tpkt[2] & 0x7) << 1 | tpkt[1] >> 7] += 1
+                return
+            self.__release()
+
+        if not flags and len(pkt) == 3:
+            if pkt[0] == PID_SOF:
+                self.__add(clks, ts, pkt)
+                self.frames.append((clks, pkt[1] | (pkt[2] << 8) & 0x7))
+                return
+            if pkt[0] in POLL_TOKENS:
+                self.held = (clks, ts, pkt)
+                return
+
+        self.__end_run()
+        self.output.handle_usb(ts, pkt, flags)
+
+    def handle_records(self, records, count):
+        """Record handler (see RXCSniff.record_handlers)."""
+        for pos, flags, length, ts in LibOV.iter_records(records, count):
+            self.handle_usb(ts, records[pos + 8:pos + 8 + length], flags)
+
+    def flush(self):
+        if self.held is not None:
+            self.__release()
+        self.__end_run()
+        self.output.flush()
+
+    def finish(self):
+        if self.held is not None:
+            self.__release()
+        self.__end_run()
+        getattr(self.output, "finish", self.output.flush)()
+
+
+def _verbose_run(ui, run):
+    # Advance 'ui' over a Run as if it had seen all of it, and return the
+    # line showing it
+    last_print = ui.last_ts_print
+    ui.skipPacket(run.start_ts, b"")
+    for clks, frameno in run.frames:
+        ui.trackFrame(clks, frameno)
+    ui.skipPacket(run.end_ts, b"")
+
+    return "[        ] %10.6f d=%10.6f idle: %s" % (
+            run.start / CLOCK_HZ, (run.start - last_print) / CLOCK_HZ, format_run(run))
+
+class OutputVerbose:
+    def __init__(self, output, speed):
+        self.output = output
+        self.ui = USBInterpreter(speed == "hs")
+
+    def resume(self, state):
+        self.ui.last_ts_pkt = state.last_ts
+        self.ui.ts_base = state.ts_base
+        self.ui.last_ts_print = state.last_print_ts
+        self.ui.frameno = state.frameno
+        self.ui.subframe = state.subframe
+        self.ui.last_ts_frame = state.last_ts_frame
+
+    def handle_usb(self, ts, pkt, flags):
+        line = self.ui.formatPacket(ts, pkt, flags)
+        if line is not None:
+            self.output.write(line.encode("ascii") + b"\n")
+
+    def handle_run(self, run):
+        self.output.write(_verbose_run(self.ui, run).encode("ascii") + b"\n")
+
+    def flush(self):
+        pass
+
+
+class OutputConsole:
+    """Verbose output for a terminal that never holds up the capture.
+
+    Lines are gathered in memory and written by a separate thread every
+    'interval' seconds. If the terminal falls behind and 'max_pending'
+    lines pile up, only one packet in 'sample' is formatted and shown, and
+    a summary line with the number of lines left out and per-PID packet
+    rates is written in each interval, until the terminal catches up.
+    """
+
+    def __init__(self, output, speed, interval=0.1, max_pending=20000, sample=64):
+        self.output = output
+        self.ui = USBInterpreter(speed == "hs")
+        self.interval = interval
+        self.max_pending = max_pending
+        self.sample = sample
+
+        self.lock = threading.Lock()
+        self.lines = []
+        self.overloaded = False
+        self.seen = 0
+        self.elided = 0
+        self.total_elided = 0
+        self.pid_counts = collections.Counter()
+        self.since = time.monotonic()
+
+        self.done = threading.Event()
+        self.writer = threading.Thread(target=self.__write_loop, daemon=True)
+        self.writer.start()
+
+    def resume(self, state):
+        OutputVerbose.resume(self, state)
+
+    def handle_usb(self, ts, pkt, flags):
+        self.pid_counts[pkt[0] & 0xF if pkt else None] += 1
+
+        if self.overloaded:
+            self.seen += 1
+            if self.seen % self.sample:
+                if self.ui.skipPacket(ts, pkt):
+                    self.elided += 1
+                return
+
+        line = self.ui.formatPacket(ts, pkt, flags)
+        if line is None:
+            return
+
+        with self.lock:
+            self.lines.append(line)
+            if len(self.lines) >= self.max_pending:
+                self.overloaded = True
+
+    def handle_records(self, records, count):
+        """Record handler (see RXCSniff.record_handlers)."""
+        for pos, flags, length, ts in LibOV.iter_records(records, count):
+            self.handle_usb(ts, records[pos + 8:pos + 8 + length], flags)
+
+    def handle_run(self, run):
+        self.pid_counts[PID_SOF & 0xF] += len(run.frames)
+        for (pid, addr, endp), n in run.naks.items():
+            self.pid_counts[pid & 0xF] += n
+            self.pid_counts[PID_NAK & 0xF] += n
+
+        line = _verbose_run(self.ui, run)
+        with self.lock:
+            self.lines.append(line)
+
+    def __summary(self, elided, counts, elapsed):
+        rates = " ".join("%s %d/s" % (PID_NAMES.get(pid, "empty"), n / elapsed)
+                         for pid, n in counts.most_common())
+        return "--- %d lines elided (1 in %d shown); %s ---" % (elided, self.sample, rates)
+
+    def __write(self):
+        now = time.monotonic()
+        with self.lock:
+            lines, self.lines = self.lines, []
+            overloaded = self.overloaded
+            elided, self.elided = self.elided, 0
+            counts, self.pid_counts = self.pid_counts, collections.Counter()
+            elapsed, self.since = now - self.since, now
+
+        if overloaded or elided:
+            self.total_elided += elided
+            lines.append(self.__summary(elided, counts, max(elapsed, 1e-6)))
+
+        if lines:
+            lines.append("")
+            self.output.write("\n".join(lines).encode("ascii", "replace"))
+            self.output.flush()
+
+        # Back to showing everything once a write fits well in the interval
+        if overloaded and time.monotonic() - now < self.interval / 2:
+            with self.lock:
+                if len(self.lines) < self.max_pending // 2:
+                    self.overloaded = False
+
+    def __write_loop(self):
+        while not self.done.wait(self.interval):
+            self.__write()
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        """Write out what is left and stop the writer thread."""
+        self.done.set()
+        self.writer.join()
+        self.__write()
+
+        if self.total_elided:
+            print("%d lines were elided to keep up with the capture" % self.total_elided,
+                  file=sys.stderr)
+
+
+class OutputTransfers:
+    """One text line per USB transfer (see usb_transfers.TransferTracker):
+    start time, duration, kind, addr.endp, direction, length, status, the
+    SETUP packet of control transfers and the first bytes of data."""
+
+    PREVIEW = 16
+
+    def __init__(self, output, speed):
+        self.output = output
+        self.clock = StreamClock()
+        self.lines = []
+        self.tracker = TransferTracker(self.handle_transfer, speed)
+
+    def resume(self, state):
+        self.clock = StreamClock(state.last_ts, state.ts_base)
+
+    def handle_usb(self, ts, pkt, flags):
+        self.tracker.packet(self.clock(ts), pkt, flags)
+
+    def handle_records(self, records, count):
+        """Record handler (see RXCSniff.record_handlers)."""
+        packet = self.tracker.packet
+        clock = self.clock
+
+        for pos, flags, length, ts in LibOV.iter_records(records, count):
+            packet(clock(ts), records[pos + 8:pos + 8 + length], flags)
+
+        self.flush()
+
+    def handle_transfer(self, xfer):
+        line = "%12.6f %9.3f ms %-11s %3d.%-2d %-3s %7d B %-10s" % (
+                xfer.start / CLOCK_HZ, (xfer.end - xfer.start) * 1000 / CLOCK_HZ,
+                xfer.kind, xfer.addr, xfer.endp, xfer.direction, xfer.length, xfer.status)
+        if xfer.setup is not None:
+            line += " setup %s" % xfer.setup.hex(" ")
+        if xfer.data:
+            line += " : %s%s" % (xfer.data[:self.PREVIEW].hex(" "),
+                                 " ..." if xfer.length > self.PREVIEW else "")
+        self.lines.append(line + "\n")
+
+    def flush(self):
+        if self.lines:
+            self.output.write("".join(self.lines).encode("ascii"))
+            self.lines = []
+
+    def finish(self):
+        """Write out the transfers still open, marked incomplete."""
+        self.tracker.finish()
+        self.flush()
+
+
+# Custom text output templates use str.format fields, e.g.
+# "{time:.9f} {pidname:5s} {data}\n". Old templates with three % fields
+# (payload hex, speed, time) and no str.format fields are still accepted.
+# A template is one line: the first line of its file.
+DEFAULT_TEMPLATE = "data={data} speed={speed} time={time:f}\n"
+
+PID_NAMES = {0x1: "OUT", 0x9: "IN", 0x5: "SOF", 0xD: "SETUP",
+             0x3: "DATA0", 0xB: "DATA1", 0x7: "DATA2", 0xF: "MDATA",
+             0x2: "ACK", 0xA: "NAK", 0xE: "STALL", 0x6: "NYET",
+             0xC: "PRE", 0x8: "SPLIT", 0x4: "PING", 0x0: "EXT"}
+
+def _token(pkt):
+    # (addr, endp) of a token packet, else (-1, -1)
+    if len(pkt) >= 3 and pkt[0] & 0xF in (0x1, 0x9, 0xD, 0x4):
+        return pkt[1] & 0x7F, (pkt[2] & 0x7) << 1 | pkt[1] >> 7
+    return -1, -1
+
+# Template fields, as expressions over (clks, ts, flags, pkt). 'clks' is
+# the 64-bit clock count, 'ts' the raw 24-bit device timestamp.
+TEMPLATE_FIELDS = {
+    "data":    'pkt.hex(" ")',
+    "speed":   'speed',
+    "time":    'clks / CLOCK_HZ',
+    "clks":    'clks',
+    "ts":      'ts',
+    "flags":   'flags',
+    "len":     'len(pkt)',
+    "pid":     '(pkt[0] & 0xF if pkt else -1)',
+    "pidname": '(PID_NAMES[pkt[0] & 0xF] if pkt else "")',
+    "addr":    '_token(pkt)[0]',
+    "endp":    '_token(pkt)[1]',
+}
+
+def load_template(path=None):
+    """Template from the first line of 'path', else of template_custom.txt
+    in the current directory if there is one, else DEFAULT_TEMPLATE."""
+    if path is not None:
+        with open(path) as f:
+            return f.readline()
+
+    try:
+        with open("template_custom.txt") as f:
+            return f.readline()
+    except OSError:
+        return DEFAULT_TEMPLATE
+
+# Packet a template is tried on when compiled: an IN token
+_SAMPLE_PKT = b"\x69\x81\x58"
+
+def compile_template(template, speed):
+    """Compile 'template' into render(clks, ts, flags, pkt) -> str. Only
+    the fields the template uses are computed. Raises ValueError for
+    unknown fields, and for templates that do not render."""
+    speed = speed.upper()
+
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError as e:
+        raise ValueError("Bad template %r: %s" % (template, e)) from None
+
+    if "%" in template and all(name is None for text, name, spec, conv in parsed):
+        # Old style: payload hex, speed, time
+        render = lambda clks, ts, flags, pkt: template % (pkt.hex(" "), speed, clks / CLOCK_HZ)
+    else:
+        # Turn named fields, including those nested in format specs, into
+        # positional ones and build a single function computing just the
+        # fields used, from the expressions above
+        args = []
+
+        def field(name):
+            if name not in TEMPLATE_FIELDS:
+                raise ValueError("Unknown template field {%s}; known fields are %s" %
+                        (name, ", ".join(sorted(TEMPLATE_FIELDS))))
+            args.append(TEMPLATE_FIELDS[name])
+            return len(args) - 1
+
+        fmt = []
+        for text, name, spec, conv in parsed:
+            fmt.append(text.replace("{", "{{").replace("}", "}}"))
+            if name is None:
+                continue
+
+            index = field(name)
+            if spec:
+                spec = "".join(t + ("{%d}" % field(n) if n is not None else "")
+                               for t, n, s, c in string.Formatter().parse(spec))
+            fmt.append("{%d%s%s}" % (index, "!" + conv if conv else "", ":" + spec if spec else ""))
+
+        namespace = {"fmt": "".join(fmt).format, "speed": speed, "CLOCK_HZ": CLOCK_HZ,
+                     "PID_NAMES": PID_NAMES, "_token": _token}
+        render = eval("lambda clks, ts, flags, pkt: fmt(%s)" % ", ".join(args), namespace)
+
+    # Fail here rather than on every packet
+    try:
+        render(0, 0, 0, _SAMPLE_PKT)
+    except (ValueError, TypeError, KeyError, IndexError) as e:
+        raise ValueError("Template %r does not render: %s" % (template, e)) from None
+    return render
+
+
+class OutputCustom:
+    def __init__(self, output, speed, template=None, block_size=1 << 20):
+        self.output = output
+        self.speed = speed
+        self.clock = StreamClock()
+        self.block_size = block_size
+        self.lines = []
+        self.pending = 0
+
+        if template is None:
+            template = load_template()
+        self.render = compile_template(template, speed)
+
+    def resume(self, state):
+        self.clock = StreamClock(state.last_ts, state.ts_base)
+
+    def handle_usb(self, ts, pkt, flags):
+        line = self.render(self.clock(ts), ts, flags, pkt)
+        self.lines.append(line)
+        self.pending += len(line)
+        if self.pending >= self.block_size:
+            self.flush()
+
+    def handle_records(self, records, count):
+        """Record handler (see RXCSniff.record_handlers): render a batch of
+        records and write it as one block."""
+        render = self.render
+        append = self.lines.append
+        last_ts = self.clock.last_ts
+        base = self.clock.base
+
+        for pos, flags, length, ts in LibOV.iter_records(records, count):
+            if ts < last_ts:
+                base += TS_WRAP
+            last_ts = ts
+
+            append(render(base + ts, ts, flags, records[pos + 8:pos + 8 + length]))
+
+        self.clock.last_ts = last_ts
+        self.clock.base = base
+        self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.output.write("".join(self.lines).encode("ascii"))
+            self.lines = []
+            self.pending = 0
+
+
+class OutputITI1480A:
+    # Largest delta a single time record holds (28 bits); longer gaps are
+    # written as several time records in a row
+    MAX_DELTA = 0x0FFFFFFF
+
+    def __init__(self, output, speed):
+        self.output = output
+        self.speed = speed
+        self.clock = StreamClock()
+        self.ts_last = None
+
+    def resume(self, state):
+        self.clock = StreamClock(state.last_ts, state.ts_base)
+        self.ts_last = state.last_data_ts
+
+    @classmethod
+    def time_records(cls, ts_delta):
+        buf = bytearray()
+
+        while True:
+            d = min(ts_delta, cls.MAX_DELTA)
+            buf += bytes([
+                (d & 0x0000ff0) >> 4,
+                (d & 0x000000f) | 0x30,
+                (d & 0xff00000) >> 20,
+                (d & 0x00ff000) >> 12])
+
+            ts_delta -= d
+            if not ts_delta:
+                return buf
+
+    def handle_usb(self, ts, pkt, flags):
+        # Every packet counts for spotting timestamp wraps
+        ts = self.clock(ts)
+
+        # Skip SOF and empty packets
+        if (len(pkt) == 0) or (pkt[0] == 0xa5):
+            return
+
+        # Get delta vs prev packet
+        if self.ts_last is None:
+            self.ts_last = ts
+
+        ts_delta = ts - self.ts_last
+
+        self.ts_last = ts
+
+        # Timestamp delta
+        buf = self.time_records(ts_delta)
+
+        # Packet start, data, packet end
+        data = bytearray(2 + 2*len(pkt) + 2)
+        data[0] = 0x40
+        data[1] = 0xc0
+        data[2:-2:2] = pkt
+        data[3:-2:2] = b'\x80' * len(pkt)
+        data[-2] = 0x00
+        data[-1] = 0xc0
+        buf += data
+
+        # To file
+        self.output.write(buf)
+
+    def handle_records(self, records, count):
+        """Record handler (see RXCSniff.record_handlers): encode 'count'
+        back-to-back 0xA0 records at once with NumPy."""
+        if record_scan is None or not count:
+            for pos, flags, length, ts in LibOV.iter_records(records, count):
+                self.handle_usb(ts, records[pos + 8:pos + 8 + length], 0)
+            return
+
+        data = np.frombuffer(records, dtype=np.uint8)
+        scan = record_scan.scan_records(records, max_records=count)
+        clks = record_scan.unwrap_ts(scan.ts, self.clock.last_ts, self.clock.base)
+
+        self.clock.last_ts = int(scan.ts[-1])
+        self.clock.base = int(clks[-1]) - self.clock.last_ts
+
+        # Skip SOF and empty packets
+        pid = data[np.minimum(scan.offset + 8, len(data) - 1)]
+        keep = (scan.length > 0) & (pid != 0xa5)
+        offset = scan.offset[keep] + 8
+        length = scan.length[keep].astype(np.int64)
+        clks = clks[keep]
+
+        if not len(clks):
+            return
+
+        if self.ts_last is None:
+            self.ts_last = int(clks[0])
+
+        delta = np.diff(clks, prepend=self.ts_last)
+        self.ts_last = int(clks[-1])
+
+        # Extra time records for deltas that do not fit in one
+        extra = np.maximum(delta - 1, 0) // self.MAX_DELTA
+        delta -= extra * self.MAX_DELTA
+
+        size = 4 * (extra + 1) + 2 + 2 * length + 2
+        end = np.cumsum(size)
+        start = end - size
+
+        out = np.empty(int(end[-1]), dtype=np.uint8)
+
+        for i in np.flatnonzero(extra):
+            out[start[i]:start[i] + 4 * extra[i]] = np.frombuffer(
+                    self.time_records(int(extra[i]) * self.MAX_DELTA), dtype=np.uint8)
+
+        # Last (or only) time record, then packet start
+        t = start + 4 * extra
+        out[t] = (delta & 0x0000ff0) >> 4
+        out[t + 1] = (delta & 0x000000f) | 0x30
+        out[t + 2] = (delta & 0xff00000) >> 20
+        out[t + 3] = (delta & 0x00ff000) >> 12
+        out[t + 4] = 0x40
+        out[t + 5] = 0xc0
+
+        # Data bytes, each followed by 0x80
+        first = np.cumsum(length) - length
+        within = np.arange(int(length.sum())) - np.repeat(first, length)
+        dst = np.repeat(t + 6, length) + 2 * within
+        out[dst] = data[np.repeat(offset, length) + within]
+        out[dst + 1] = 0x80
+
+        # Packet end
+        out[end - 2] = 0x00
+        out[end - 1] = 0xc0
+
+        self.output.write(out.tobytes())
+
+    def flush(self):
+        pass
+
+
+class OutputPcap:
+    LINKTYPE_USB_2_0 = 288
+
+    # Host endian, nanosecond resolution
+    _header = struct.Struct("IHHIIII")
+    _record = struct.Struct("IIII")
+
+    def __init__(self, output, utc_start=None, header=True, block_size=1 << 20):
+        self.output = output
+        self.block_size = block_size
+        self.buf = bytearray()
+        if header:
+            self.output.write(self._header.pack(0xa1b23c4d, 2, 4, 0, 0, 65535, self.LINKTYPE_USB_2_0))
+        # Assume that capture started at the same time this object was created. This is not a proper time
+        # synchronization but should be good enough. Record time is advanced based on the FPGA clock.
+        self.utc_start = int(time.time()) if utc_start is None else utc_start
+        self.clock = StreamClock()
+
+    def resume(self, state):
+        self.clock = StreamClock(state.last_ts, state.ts_base)
+
+    def handle_usb(self, ts, pkt, flags):
+        clks = self.clock(ts)
+        if len(pkt) == 0:
+            return
+        self.handle_packet(clks, pkt)
+
+    def handle_packet(self, clks, pkt):
+        """Add a packet at 'clks' 60 MHz clocks since the start of capture."""
+        # 1 clk = 1 / 60 MHz = 50/3 ns; integer math only
+        secs, clks = divmod(clks, CLOCK_HZ)
+        # TODO: FPGA does not provide us with the untruncated packet length thus incl_len is set to orig_len
+        # When (and if) FPGA does indicate the length of truncated packets, change the record header to
+        # contain different incl_len (len(pkt)) and orig_len (untruncated packet size)
+        self.buf += self._record.pack(self.utc_start + secs, clks * 50 // 3, len(pkt), len(pkt))
+        # USB packet, beginning with a PID as it appeared on the bus
+        self.buf += pkt
+
+        if len(self.buf) >= self.block_size:
+            self.flush()
+
+    def handle_records(self, records, count):
+        """Record handler (see RXCSniff.record_handlers): add 'count'
+        back-to-back 0xA0 records without a call per packet."""
+        pack = self._record.pack
+        buf = self.buf
+        utc_start = self.utc_start
+        last_ts = self.clock.last_ts
+        base = self.clock.base
+
+        for pos, flags, length, ts in LibOV.iter_records(records, count):
+            if ts < last_ts:
+                base += TS_WRAP
+            last_ts = ts
+
+            if length:
+                secs, clks = divmod(base + ts, CLOCK_HZ)
+                buf += pack(utc_start + secs, clks * 50 // 3, length, length)
+                buf += records[pos + 8:pos + 8 + length]
+
+        self.clock.last_ts = last_ts
+        self.clock.base = base
+
+        if len(buf) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.output.write(self.buf)
+            self.buf.clear()
+
+
+class OutputPcapng:
+    """pcapng writer: one USB 2.0 interface with nanosecond timestamps.
+
+    Packets with any HF0_* flags set carry them as an opt_comment of the
+    form "ov_flags=0x0003 Error Overflow"; HF0_ERR is also reported as a
+    symbol error in epb_flags, and HF_CRC_BAD as a CRC error. No PEN is registered for OpenVizsla, so
+    custom options are not used; for the same reason collapsed idle
+    traffic (see handle_run) goes in comments rather than custom blocks.
+
+    Every 'stats_interval' clocks of capture time an Interface Statistics
+    Block is written. When the capture is finished, a last ISB lists the
+    capture time, file offset and packet count of every earlier one in
+    opt_comments starting with "ov_index"; readers find it by walking
+    back from the block length at the end of the file. Outputs resumed
+    partway into a stream (header=False) write neither, since they do not
+    know their file offset.
+    """
+    LINKTYPE_USB_2_0 = 288
+
+    BT_SHB = 0x0A0D0D0A
+    BT_IDB = 0x00000001
+    BT_ISB = 0x00000005
+    BT_EPB = 0x00000006
+
+    OPT_COMMENT = 1
+    SHB_USERAPPL = 4
+    IF_NAME = 2
+    IF_TSRESOL = 9
+    EPB_FLAGS = 2
+    ISB_STARTTIME = 2
+    ISB_ENDTIME = 3
+    ISB_IFRECV = 4
+
+    EPB_FLAG_SYMBOL_ERROR = 1 << 31
+    EPB_FLAG_CRC_ERROR = 1 << 24
+
+    _block = struct.Struct("=II")
+    _epb = struct.Struct("=IIIII")
+    _option = struct.Struct("=HH")
+
+    FLAG_NAMES = [(0x01, "Error"), (0x02, "Overflow"), (0x04, "Clipped"),
+                  (0x08, "Truncated"), (0x10, "First"), (0x20, "Last"),
+                  (LibOV.HF_CRC_BAD, "BadCRC")]
+
+    def __init__(self, output, utc_start=None, header=True, block_size=1 << 20,
+                 stats_interval=CLOCK_HZ):
+        self.output = output
+        self.block_size = block_size
+        self.buf = bytearray()
+        self.utc_start_ns = (int(time.time()) if utc_start is None else utc_start) * 1000000000
+        self.clock = StreamClock()
+
+        # Bytes emitted so far, packets written and ISB index
+        self.offset = 0
+        self.packets = 0
+        self.stats_interval = stats_interval if header else None
+        self.first_ns = None
+        self.next_stats = stats_interval
+        self.index = []
+
+        if header:
+            self.emit_block(self.BT_SHB, struct.pack("=IHHq", 0x1A2B3C4D, 1, 0, -1) +
+                    self.options([(self.SHB_USERAPPL, b"ovctl")]))
+            self.emit_block(self.BT_IDB, struct.pack("=HHI", self.LINKTYPE_USB_2_0, 0, 65535) +
+                    self.options([(self.IF_NAME, b"openvizsla"), (self.IF_TSRESOL, b"\x09")]))
+            self.flush()
+
+    def options(self, opts):
+        out = bytearray()
+        for code, value in opts:
+            out += self._option.pack(code, len(value))
+            out += value
+            out += bytes(-len(value) % 4)
+        if out:
+            out += self._option.pack(0, 0)
+        return bytes(out)
+
+    def emit_block(self, block_type, body):
+        length = 12 + len(body)
+        self.buf += self._block.pack(block_type, length)
+        self.buf += body
+        self.buf += struct.pack("=I", length)
+        self.offset += length
+
+    def resume(self, state):
+        self.clock = StreamClock(state.last_ts, state.ts_base)
+
+    def handle_usb(self, ts, pkt, flags):
+        clks = self.clock(ts)
+        if len(pkt) == 0:
+            return
+        self.handle_packet(clks, pkt, flags)
+
+    def handle_packet(self, clks, pkt, flags=0, comment=None):
+        """Add a packet at 'clks' 60 MHz clocks since the start of capture,
+        with an optional opt_comment (bytes)."""
+        ns = self.utc_start_ns + clks * 50 // 3
+
+        if self.stats_interval is not None:
+            if self.first_ns is None:
+                self.first_ns = ns
+            if clks >= self.next_stats:
+                self.write_stats(ns)
+                self.next_stats = clks - clks % self.stats_interval + self.stats_interval
+
+        opts = []
+        if flags:
+            epb_flags = ((self.EPB_FLAG_SYMBOL_ERROR if flags & 0x01 else 0) |
+                         (self.EPB_FLAG_CRC_ERROR if flags & LibOV.HF_CRC_BAD else 0))
+            if epb_flags:
+                opts.append((self.EPB_FLAGS, struct.pack("=I", epb_flags)))
+            names = " ".join(name for bit, name in self.FLAG_NAMES if flags & bit)
+            opts.append((self.OPT_COMMENT, ("ov_flags=0x%04x %s" % (flags, names)).encode("ascii")))
+        if comment is not None:
+            opts.append((self.OPT_COMMENT, comment))
+
+        n = len(pkt)
+        body = self._epb.pack(0, ns >> 32, ns & 0xFFFFFFFF, n, n) + bytes(pkt) + bytes(-n % 4)
+        if opts:
+            body += self.options(opts)
+        self.emit_block(self.BT_EPB, body)
+        self.packets += 1
+
+        if len(self.buf) >= self.block_size:
+            self.flush()
+
+    def handle_records(self, records, count):
+        """Record handler (see RXCSniff.record_handlers)."""
+        clock = self.clock
+        for pos, flags, length, ts in LibOV.iter_records(records, count):
+            clks = clock(ts)
+            if length:
+                self.handle_packet(clks, records[pos + 8:pos + 8 + length], flags)
+
+    def handle_run(self, run):
+        """Write a Run as an empty packet at its start, with an opt_comment
+        of the form "ov_run 800 SOF (frame 12-112), ..., 2.000 ms"."""
+        clks = self.clock(run.start_ts)
+        self.handle_packet(clks, b"", comment=("ov_run " + format_run(run)).encode("ascii"))
+        self.clock(run.end_ts)
+
+    def write_stats(self, ns, comments=()):
+        if self.stats_interval is None:
+            return
+
+        self.index.append((ns, self.offset, self.packets))
+
+        opts = [(self.ISB_STARTTIME, struct.pack("=II", self.first_ns >> 32, self.first_ns & 0xFFFFFFFF)),
+                (self.ISB_ENDTIME, struct.pack("=II", ns >> 32, ns & 0xFFFFFFFF)),
+                (self.ISB_IFRECV, struct.pack("=Q", self.packets))]
+        opts += [(self.OPT_COMMENT, c) for c in comments]
+
+        self.emit_block(self.BT_ISB,
+                struct.pack("=III", 0, ns >> 32, ns & 0xFFFFFFFF) + self.options(opts))
+
+    def flush(self):
+        if self.buf:
+            self.output.write(self.buf)
+            self.buf.clear()
+
+    def finish(self):
+        """Write the closing ISB with the index, then flush."""
+        if self.stats_interval is not None and self.first_ns is not None:
+            ns = self.utc_start_ns + (self.clock.base + self.clock.last_ts) * 50 // 3
+
+            # "ov_index" then one "ns offset packets" line per earlier ISB,
+            # split over as many comments as the 16-bit option length needs
+            comments = []
+            comment = "ov_index"
+            for entry in self.index:
+                line = "\n%d %d %d" % entry
+                if len(comment) + len(line) > 60000:
+                    comments.append(comment.encode("ascii"))
+                    comment = "ov_index"
+                comment += line
+            comments.append(comment.encode("ascii"))
+
+            self.write_stats(ns, comments)
+        self.flush()
+
+
+# Raw capture files: a fixed-size header followed by the device's 0xA0
+# capture records exactly as they came off the SDRAM stream.
+RAW_MAGIC = b"OVRAW\r\n\x1a"
+RAW_VERSION = 1
+RAW_SPEEDS = ["hs", "fs", "ls"]
+
+# magic, version, header size, speed, start time (ns since the epoch),
+# SHA-1 of the firmware register map, clock count of the wrap base at the
+# first record (nonzero for files after the first of a rotated capture);
+# padded to RAW_HEADER_SIZE
+_raw_header = struct.Struct("<8sHHB3xQ20sQ")
+RAW_HEADER_SIZE = 64
+
+RawHeader = collections.namedtuple('RawHeader',
+        ['version', 'size', 'speed', 'utc_start_ns', 'map_hash', 'ts_base'])
+
+def read_raw_header(buf):
+    """Parse the header at the start of 'buf' (bytes-like, at least
+    RAW_HEADER_SIZE long). Raises ValueError if it is not a raw capture."""
+    if len(buf) < _raw_header.size:
+        raise ValueError("Raw capture header truncated")
+
+    magic, version, size, speed, utc_start_ns, map_hash, ts_base = _raw_header.unpack_from(buf)
+    if magic != RAW_MAGIC:
+        raise ValueError("Not a raw capture file")
+    if version != RAW_VERSION:
+        raise ValueError("Unsupported raw capture version %d" % version)
+    if speed >= len(RAW_SPEEDS):
+        raise ValueError("Bad speed %d in raw capture header" % speed)
+
+    if map_hash == bytes(20):
+        map_hash = None
+
+    return RawHeader(version, size, RAW_SPEEDS[speed], utc_start_ns, map_hash, ts_base)
+
+
+class OutputRaw:
+    """Record handler (see RXCSniff.record_handlers) writing the undecoded
+    capture records to 'output'. Records are gathered into blocks of
+    'block_size' bytes so the file sees few, large writes. HF_CRC_BAD is
+    cleared again on the way, so the file holds exactly what the device
+    sent."""
+
+    def __init__(self, output, speed, utc_start_ns=None, map_hash=None,
+                 block_size=4 << 20, ts_base=0):
+        self.output = output
+        self.block_size = block_size
+        self.buf = bytearray()
+
+        if utc_start_ns is None:
+            utc_start_ns = time.time_ns()
+
+        header = _raw_header.pack(RAW_MAGIC, RAW_VERSION, RAW_HEADER_SIZE,
+                RAW_SPEEDS.index(speed), utc_start_ns, map_hash or bytes(20), ts_base)
+        self.output.write(header.ljust(RAW_HEADER_SIZE, b"\0"))
+
+    def handle_records(self, records, count):
+        start = len(self.buf)
+        self.buf += records
+        LibOV.clear_records_flags(self.buf, start, count, LibOV.HF_CRC_BAD)
+        if len(self.buf) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.output.write(self.buf)
+            self.buf = bytearray()
+        self.output.flush()
+
+
+COMPRESSORS = {
+    "gzip": lambda block, level: gzip.compress(block, 6 if level is None else level),
+    "xz": lambda block, level: lzma.compress(block, lzma.FORMAT_XZ, preset=level),
+}
+
+class CompressedFile:
+    """Binary file wrapper compressing everything written through it.
+
+    Data is cut into blocks of 'block_size' bytes, and each block is
+    compressed on its own by a pool of 'workers' threads (zlib and lzma
+    release the GIL while they work), so the writer only ever copies and
+    queues data. Every block becomes a complete gzip member or xz stream;
+    both formats allow them to be concatenated, and gunzip / unxz read the
+    result as one file.
+
+    flush() only writes blocks that have finished compressing; the last,
+    partial block is compressed when the file is closed.
+    """
+
+    def __init__(self, output, method="gzip", level=None, workers=None,
+                 block_size=4 << 20):
+        self.output = output
+        self.compress = COMPRESSORS[method]
+        self.level = level
+        self.block_size = block_size
+
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self.pending = collections.deque()
+        self.buf = bytearray()
+
+    def write(self, b):
+        self.buf += b
+        if len(self.buf) >= self.block_size:
+            self.__submit()
+        return len(b)
+
+    def __submit(self):
+        block = bytes(self.buf)
+        self.buf = bytearray()
+        self.pending.append(self.pool.submit(self.compress, block, self.level))
+
+        # Bound the memory held by blocks waiting on a busy pool
+        while len(self.pending) > 2 * self.workers:
+            self.output.write(self.pending.popleft().result())
+
+    def __write_done(self):
+        while self.pending and self.pending[0].done():
+            self.output.write(self.pending.popleft().result())
+
+    def flush(self):
+        self.__write_done()
+        self.output.flush()
+
+    def close(self):
+        if self.buf:
+            self.__submit()
+        while self.pending:
+            self.output.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.output.close()
+
+
+class _CountingFile:
+    # Binary file that keeps count of the bytes written to it
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.size = 0
+
+    def write(self, b):
+        self.size += len(b)
+        return self.file.write(b)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def _batch_clock(records, count, last_ts, ts_base):
+    """Wrap base at the first of 'count' records, and (last_ts, ts_base)
+    after the last one, continuing from 'last_ts' and 'ts_base'."""
+    if record_scan is not None:
+        ts = record_scan.scan_records(records, max_records=count).ts
+        clks = record_scan.unwrap_ts(ts, last_ts, ts_base)
+        return int(clks[0] - ts[0]), int(ts[-1]), int(clks[-1] - ts[-1])
+
+    first_base = None
+    for pos, flags, length, ts in LibOV.iter_records(records, count):
+        if ts < last_ts:
+            ts_base += TS_WRAP
+        last_ts = ts
+        if first_base is None:
+            first_base = ts_base
+
+    return first_base, last_ts, ts_base
+
+
+class RotatingOutput:
+    """Record handler (see RXCSniff.record_handlers) writing 'format' to a
+    series of files instead of a single one.
+
+    A new file is started once the current one holds 'max_bytes' or has
+    been open for 'max_seconds', and only the newest 'keep' files are kept
+    (0 keeps them all). Files are named after 'path' with a sequence
+    number before the extension. Every file has its own header and can be
+    decoded on its own; timestamps carry on across files.
+
+    Writing, rollover and removing old files all happen on a background
+    thread, behind a bounded queue.
+    """
+
+    FORMATS = ["raw", "pcap", "pcapng", "iti1480a"]
+
+    def __init__(self, path, format, speed, max_bytes=None, max_seconds=None,
+                 keep=0, map_hash=None, compress=None, maxsize=256):
+        if format not in self.FORMATS:
+            raise ValueError("Can't rotate %s output" % format)
+
+        self.stem, self.ext = os.path.splitext(path)
+        if compress is not None:
+            # cap.pcap.gz -> cap-00001.pcap.gz
+            self.stem, ext = os.path.splitext(self.stem)
+            self.ext = ext + self.ext
+        self.compress = compress
+        self.format = format
+        self.speed = speed
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.keep = keep
+        self.map_hash = map_hash
+
+        self.utc_start_ns = time.time_ns()
+        self.last_ts = 0
+        self.ts_base = 0
+
+        self.seq = 0
+        self.paths = collections.deque()
+        self.counter = None
+        self.file = None
+        self.handler = None
+        self.opened = None
+
+        self.stage = LibOV.Stage("rotate", self.__write, maxsize)
+        self.stage.start()
+
+    def handle_records(self, records, count):
+        if count:
+            self.stage.queue.put((records, count))
+
+    def __due(self):
+        if self.file is None:
+            return True
+        if self.max_bytes is not None and self.counter.size >= self.max_bytes:
+            return True
+        if self.max_seconds is not None and time.monotonic() - self.opened >= self.max_seconds:
+            return True
+        return False
+
+    def __close(self):
+        if self.handler is not None:
+            getattr(self.handler, "finish", self.handler.flush)()
+            self.file.close()
+            self.handler = self.file = self.counter = None
+
+    def __roll(self, first_base):
+        self.__close()
+
+        while self.keep and len(self.paths) >= self.keep:
+            try:
+                os.remove(self.paths.popleft())
+            except OSError as e:
+                print("Could not remove old capture file: %s" % e, file=sys.stderr)
+
+        self.seq += 1
+        path = "%s-%05d%s" % (self.stem, self.seq, self.ext)
+        self.paths.append(path)
+        self.file = self.counter = _CountingFile(path)
+        if self.compress is not None:
+            # Smaller blocks keep the size count close behind the data
+            self.file = CompressedFile(self.counter, self.compress, block_size=1 << 20)
+        self.opened = time.monotonic()
+
+        if self.format == "raw":
+            self.handler = OutputRaw(self.file, self.speed, self.utc_start_ns,
+                    self.map_hash, ts_base=first_base)
+        else:
+            self.handler = make_output(self.format, self.file, self.speed,
+                    self.utc_start_ns // 1000000000)
+            self.handler.resume(INITIAL_STATE._replace(last_ts=self.last_ts, ts_base=self.ts_base))
+
+    def __write(self, item):
+        records, count = item
+
+        first_base, last_ts, ts_base = _batch_clock(records, count, self.last_ts, self.ts_base)
+        if self.__due():
+            self.__roll(first_base)
+
+        self.handler.handle_records(records, count)
+        self.last_ts, self.ts_base = last_ts, ts_base
+
+        # Keep the size count honest for outputs that buffer
+        if self.max_bytes is not None:
+            self.handler.flush()
+
+    def flush(self):
+        self.stage.drain()
+
+    def finish(self):
+        self.stage.drain()
+        self.stage.stop()
+        self.__close()
+
+
+class LiveFlush:
+    """Output wrapper for watching a capture live through a pipe (e.g.
+    "ovctl.py sniff hs --format pcap --out - | wireshark -k -i -").
+
+    Outputs gather their writes into large blocks; on top of that, this
+    pushes everything out to 'file' after every 'packets' packets, at
+    least every 'interval' seconds while packets keep coming, and once no
+    packet has arrived for 'idle' seconds. Any of them can be None. The
+    time limits are checked by a timer thread, so they hold even when the
+    bus goes quiet.
+    """
+
+    def __init__(self, output, file, packets=None, interval=None, idle=None):
+        self.output = output
+        self.file = file
+        self.packets = packets
+        self.interval = interval
+        self.idle = idle
+
+        self.lock = threading.Lock()
+        self.count = 0
+        self.last_flush = self.last_packet = time.monotonic()
+
+        # Let the reader see the file header straight away
+        self.__flush()
+
+        self.done = threading.Event()
+        self.timer = None
+        ticks = [t for t in (interval, idle) if t is not None]
+        if ticks:
+            self.tick = min(ticks) / 2
+            self.timer = threading.Thread(target=self.__timer_loop, daemon=True)
+            self.timer.start()
+
+    def __flush(self):
+        self.output.flush()
+        self.file.flush()
+        self.count = 0
+        self.last_flush = time.monotonic()
+
+    def __after(self, n):
+        self.count += n
+        self.last_packet = time.monotonic()
+        if self.packets is not None and self.count >= self.packets:
+            self.__flush()
+
+    def handle_usb(self, ts, pkt, flags):
+        with self.lock:
+            self.output.handle_usb(ts, pkt, flags)
+            self.__after(1)
+
+    def handle_records(self, records, count):
+        with self.lock:
+            if hasattr(self.output, "handle_records"):
+                self.output.handle_records(records, count)
+            else:
+                for pos, flags, length, ts in LibOV.iter_records(records, count):
+                    self.output.handle_usb(ts, records[pos + 8:pos + 8 + length], flags)
+            self.__after(count)
+
+    def __timer_loop(self):
+        while not self.done.wait(self.tick):
+            now = time.monotonic()
+            with self.lock:
+                if not self.count:
+                    continue
+                if (self.interval is not None and now - self.last_flush >= self.interval or
+                        self.idle is not None and now - self.last_packet >= self.idle):
+                    self.__flush()
+
+    def flush(self):
+        with self.lock:
+            self.__flush()
+
+    def finish(self):
+        self.done.set()
+        if self.timer is not None:
+            self.timer.join()
+        getattr(self.output, "finish", self.output.flush)()
+        self.file.flush()
+
+
+class FanOut:
+    """Record handler (see RXCSniff.record_handlers) delivering the capture
+    to several outputs, each from a Stage thread of its own: an output
+    that falls behind only holds up the others once its own queue of
+    'maxsize' batches is full. 'names' label the stages in pipeline stats.
+
+    Outputs with handle_records() get the records as they are. For the
+    others, each batch is split into (ts, pkt, flags) packets once, and
+    the same list is handed to all of them. Records and packets are never
+    modified once handed over, so they are shared between the threads
+    rather than copied.
+    """
+
+    def __init__(self, outputs, names=None, maxsize=256):
+        self.outputs = outputs
+        self.split = not all(hasattr(o, "handle_records") for o in outputs)
+
+        if names is None:
+            names = [type(o).__name__ for o in outputs]
+
+        self.stages = []
+        for output, name in zip(outputs, names):
+            if hasattr(output, "handle_records"):
+                handler = lambda item, output=output: output.handle_records(item[0], item[1])
+            else:
+                handler = lambda item, output=output: self.__handle_packets(output, item[2])
+
+            stage = LibOV.Stage(name, handler, maxsize)
+            stage.start()
+            self.stages.append(stage)
+
+    @staticmethod
+    def __handle_packets(output, packets):
+        handle_usb = output.handle_usb
+        for ts, pkt, flags in packets:
+            handle_usb(ts, pkt, flags)
+
+    def handle_records(self, records, count):
+        packets = None
+        if self.split:
+            packets = [(ts, records[pos + 8:pos + 8 + length], flags)
+                       for pos, flags, length, ts in LibOV.iter_records(records, count)]
+
+        item = (records, count, packets)
+        for stage in self.stages:
+            stage.queue.put(item)
+
+    def stats(self):
+        return [stage.queue.stats() for stage in self.stages]
+
+    def flush(self):
+        for stage in self.stages:
+            stage.drain()
+        for output in self.outputs:
+            output.flush()
+
+    def finish(self):
+        """Let every output catch up, then finish (or flush) them all."""
+        for stage in self.stages:
+            stage.drain()
+            stage.stop()
+        for output in self.outputs:
+            getattr(output, "finish", output.flush)()
+
+
+def make_output(format, output, speed, utc_start=None, header=True, template=None):
+    """Create the output handler for 'format' writing to binary stream
+    'output'. With header=False no file header is written, for outputs
+    that continue an existing file. 'template' is the text template for
+    the custom format (see load_template)."""
+    if format == "verbose":
+        return OutputVerbose(output, speed)
+    elif format == "custom":
+        return OutputCustom(output, speed, template)
+    elif format == "pcap":
+        return OutputPcap(output, utc_start, header)
+    elif format == "pcapng":
+        return OutputPcapng(output, utc_start, header)
+    elif format == "iti1480a":
+        return OutputITI1480A(output, speed)
+    elif format == "transfers":
+        return OutputTransfers(output, speed)
+
+    raise ValueError("Unknown output format %s" % format)
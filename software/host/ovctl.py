@@ -7,11 +7,18 @@ import LibOV
 import argparse
 import time
 
+from outputs import make_output, load_template, OutputConsole, OutputRaw, RotatingOutput, \
+    CompressedFile, COMPRESSORS, Collapser, FanOut, LiveFlush
+from parallel_decode import ParallelDecoder, open_capture, decode_file
+from endpoint_stats import EndpointStats, format_stats, stats_json
+from capture_index import IndexedOutput, build_index
+
 import zipfile
 
 import sys
 import os, os.path
-import struct
+import hashlib
+import stat
 #import yappi
 
 # We check the Python version in __main__ so we don't
@@ -29,6 +36,9 @@ def as_ascii(arg):
     return arg.encode('ascii')
 
 class Command:
+    # Commands that only work on files can run without the hardware
+    needs_device = True
+
     def __subclasshook__(self):
         pass
 
@@ -135,111 +145,6 @@ def report(dev):
         print("\t... all passed")
 
 
-class OutputCustom:
-    def __init__(self, output, speed):
-        self.output = output
-        self.speed = speed
-        self.last_ts = 0
-        self.ts_offset = 0
-        try:
-            with open("template_custom.txt") as f:
-                self.template = f.readline()
-        except:
-            self.template = "data=%s speed=%s time=%f\n"
-
-    def handle_usb(self, ts, pkt, flags):
-        if ts < self.last_ts:
-            self.ts_offset += 0x1000000
-        self.last_ts = ts
-        pkthex = " ".join("%02x" % x for x in pkt)
-        self.output.write(bytes(self.template % (pkthex, self.speed.upper(), (ts + self.ts_offset) / 60e6), "ascii"))
-
-
-class OutputITI1480A:
-    def __init__(self, output, speed):
-        self.output = output
-        self.speed = speed
-        self.ts_offset = 0
-        self.ts_last = None
-
-    def handle_usb(self, ts, pkt, flags):
-        buf = []
-
-        # Skip SOF and empty packets
-        if (len(pkt) == 0) or (pkt[0] == 0xa5):
-            return
-
-        # Normalize timestamp and get delta vs prev packet
-        if self.ts_last is None:
-            self.ts_last = ts
-
-        if ts < self.ts_last:
-            self.ts_offset
-
-        ts_delta = ts - self.ts_last
-
-        self.ts_last = ts
-
-        # Prepare data
-        buf = bytearray(4 + 2 + 2*len(pkt) + 2)
-
-        # Write timestamp delta
-        buf[0] = (ts_delta & 0x0000ff0) >> 4
-        buf[1] = (ts_delta & 0x000000f) | 0x30
-        buf[2] = (ts_delta & 0xff00000) >> 20
-        buf[3] = (ts_delta & 0x00ff000) >> 12
-
-        # Write packet start
-        buf[4] = 0x40
-        buf[5] = 0xc0
-
-        # Write packet data
-        buf[6:-2:2] = pkt
-        buf[7:-2:2] = b'\x80' * len(pkt)
-
-        # Write packet end
-        buf[-2] = 0x00
-        buf[-1] = 0xc0
-
-        # To file
-        self.output.write(buf)
-
-
-class OutputPcap:
-    LINKTYPE_USB_2_0 = 288
-
-    def __init__(self, output):
-        self.output = output
-        self.output.write(struct.pack("IHHIIII", 0xa1b23c4d, 2, 4, 0, 0, 65535, self.LINKTYPE_USB_2_0))
-        # Assume that capture started at the same time this object was created. This is not a proper time
-        # synchronization but should be good enough. Record time is advanced based on the FPGA clock.
-        self.utc_ts = int(time.time())
-        self.last_ts = 0
-        self.ts_offset = 0
-
-    def handle_usb(self, ts, pkt, flags):
-        # Increment timestamp based on the 60 MHz 24-bit counter value.
-        # Convert remaining clocks to nanoseconds: 1 clk = 1 / 60 MHz = 16.(6) ns
-        if ts < self.last_ts:
-            self.ts_offset += (1 << 24)
-        self.last_ts = ts
-        clks = self.ts_offset + ts
-        if clks >= 60e6:
-            self.utc_ts += 1
-            self.ts_offset -= 60e6
-            clks -= 60e6
-        nanosec = int((clks * 17) - (clks // 3))
-        if len(pkt) == 0:
-            return
-        # Write pcap record header in host endian
-        # TODO: FPGA does not provide us with the untruncated packet length thus incl_len is set to orig_len
-        # When (and if) FPGA does indicate the length of truncated packets, change the record header to
-        # contain different incl_len (len(pkt)) and orig_len (untruncated packet size)
-        self.output.write(struct.pack("IIII", self.utc_ts, nanosec, len(pkt), len(pkt)))
-        # Write USB packet, beginning with a PID as it appeared on the bus
-        self.output.write(pkt)
-
-
 def do_sdramtests(dev, cb=None, tests = range(0, 6)):
 
     for i in tests:
@@ -272,9 +177,84 @@ def sdramtest(dev):
     dev.regs.LEDS_MUX_0.wr(0)
 
 sniff_speeds = ["hs", "fs", "ls"]
-sniff_formats = ["verbose", "custom", "pcap", "iti1480a"]
+compress_methods = sorted(COMPRESSORS)
+
+sniff_formats = ["verbose", "custom", "pcap", "pcapng", "iti1480a", "transfers", "raw"]
+
+def open_sink(dev, speed, format, out, workers=0, template=None, rotate_size=None,
+              rotate_time=None, rotate_keep=0, compress=None, collapse=False,
+              flush=(None, None, None), index=False):
+    """Create the handler writing 'format' to the file named 'out' (stdout
+    if None, or "-" for binary formats). Returns (handler, file), where
+    'file' is to be closed once the handler has finished, or None.
+    With 'index', raw and pcap files get an index written next to them
+    (see capture_index).
+
+    Output to anything but a regular file (stdout, a pipe or FIFO) is
+    pushed out according to 'flush', (packets, seconds, idle seconds) as
+    for LiveFlush, by default every 50 ms or after 10 ms without packets.
+    """
+    assert format in sniff_formats
+
+    if format in ["pcap", "pcapng", "raw"]:
+        assert out, "can't output %s to the terminal, use --out (\"-\" for stdout)" % format
+
+    rotate = rotate_size is not None or rotate_time is not None
+    if index and format in ["raw", "pcap"]:
+        assert out and out != "-" and not rotate and compress is None, \
+            "can only index uncompressed %s output to a single file" % format
+    if rotate:
+        assert out and out != "-", "can't rotate output to stdout, use --out"
+        assert format in RotatingOutput.FORMATS, "can't rotate %s output" % format
+        assert not workers, "can't rotate output decoded with --workers"
+
+        # The rotating writer opens (and removes) its files itself
+        return RotatingOutput(out, format, speed,
+                rotate_size and rotate_size * 1024 * 1024, rotate_time,
+                rotate_keep, map_hash=dev.map_hash, compress=compress), None
+
+    if out == "-":
+        # Not sys.stdout, which main() points at stderr in this case
+        file = sys.__stdout__.buffer
+    else:
+        file = out and open(out, "wb")
+    live = file and compress is None and not stat.S_ISREG(os.fstat(file.fileno()).st_mode)
+
+    if file and compress is not None:
+        file = CompressedFile(file, compress)
+
+    if format == "raw":
+        # Store the records as they are, to be decoded offline
+        handler = OutputRaw(file, speed, map_hash=dev.map_hash)
+    elif workers:
+        handler = ParallelDecoder(format, file or sys.stdout.buffer, speed, workers,
+                                  template=template)
+    elif format == "verbose" and not file:
+        # Never let a slow terminal hold up the capture
+        handler = OutputConsole(sys.stdout.buffer, speed)
+    else:
+        handler = make_output(format, file or sys.stdout.buffer, speed, template=template)
+
+    if index and format in ["raw", "pcap"]:
+        handler = IndexedOutput(handler, format, out)
+
+    if collapse and hasattr(handler, "handle_run"):
+        handler = Collapser(handler)
 
-def do_sniff(dev, speed, format, out, timeout):
+    if live and not workers:
+        if flush == (None, None, None):
+            flush = (None, 0.05, 0.01)
+        handler = LiveFlush(handler, file, *flush)
+
+    if out == "-":
+        # Flushed, but left open
+        return handler, None
+    return handler, file or None
+
+def do_sniff(dev, speed, formats, outs, timeout, workers=0, template=None,
+             rotate_size=None, rotate_time=None, rotate_keep=0, compress=None,
+             collapse=False, flush=(None, None, None), stats=None, stats_out=None,
+             index=False, check_crc=True):
     # LEDs off
     dev.regs.LEDS_MUX_2.wr(0)
     dev.regs.LEDS_OUT.wr(0)
@@ -318,21 +298,38 @@ def do_sniff(dev, speed, format, out, timeout):
     else:
         assert 0,"Invalid Speed"
 
-    assert format in sniff_formats
+    # Each --format goes to the --out given in the same position; the
+    # ones left over go to stdout
+    formats = formats or ["verbose"]
+    outs = outs or []
+    assert len(outs) <= len(formats), "more --out than --format options"
+    outs = outs + [None] * (len(formats) - len(outs))
+    assert outs.count(None) + outs.count("-") <= 1, "only one output can go to stdout"
+
+    sinks = [open_sink(dev, speed, format, out, workers, template, rotate_size,
+                       rotate_time, rotate_keep, compress, collapse, flush, index)
+             for format, out in zip(formats, outs)]
+
+    if len(sinks) == 1:
+        output_handler = sinks[0][0]
+        fanout = None
+    else:
+        output_handler = fanout = FanOut([handler for handler, file in sinks],
+                ["%s %s" % (format, out or "stdout") for format, out in zip(formats, outs)])
 
-    output_handler = None
-    out = out and open(out, "wb")
+    dev.rxcsniff.service.check_crc = check_crc
 
-    if format == "custom":
-        output_handler = OutputCustom(out or sys.stdout, speed)
-    elif format == "pcap":
-        assert out, "can't output pcap to stdout, use --out"
-        output_handler = OutputPcap(out)
-    elif format == "iti1480a":
-        output_handler = OutputITI1480A(out, speed)
+    if hasattr(output_handler, "handle_records"):
+        dev.rxcsniff.service.handlers = []
+        dev.rxcsniff.service.record_handlers = [output_handler.handle_records]
+    else:
+        dev.rxcsniff.service.handlers = [output_handler.handle_usb]
 
-    if output_handler is not None:
-      dev.rxcsniff.service.handlers = [output_handler.handle_usb]
+    # Per-endpoint statistics, reported along with the ring utilization
+    if stats:
+        ep_stats = EndpointStats()
+        dev.rxcsniff.service.batch_handlers.append(ep_stats.handle_batch)
+        stats_file = open(stats_out, "a") if stats_out else sys.stderr
 
     elapsed_time = 0
     try:
@@ -367,6 +364,17 @@ def do_sniff(dev, speed, format, out, timeout):
             dev.regs.OVF_INSERT_CTL.wr(0)
             print("%d overflow, %08x total" % (dev.regs.OVF_INSERT_NUM_OVF.rd(), dev.regs.OVF_INSERT_NUM_TOTAL.rd()), file = sys.stderr)
 
+            pipeline = dev.pipeline_stats() + (fanout.stats() if fanout is not None else [])
+            print(" | ".join("%s: %d/%d queued (max %d), %d stalls %.2fs" %
+                (st.name, st.depth, st.maxsize, st.max_depth, st.stalls, st.stall_time)
+                for st in pipeline), file = sys.stderr)
+
+            if stats == "text":
+                for line in format_stats(ep_stats.snapshot()):
+                    print(line, file = stats_file)
+            elif stats == "json":
+                print(stats_json(ep_stats.snapshot()), file = stats_file, flush = True)
+
             if False:
                 dev.regs.SDRAM_SINK_DEBUG_CTL.wr(0)
                 print("rptr = %08x i_stb=%08x i_ack=%08x d_stb=%08x d_term=%08x s0=%08x s1=%08x s2=%08x | wptr = %08x i_stb=%08x i_ack=%08x d_stb=%08x d_term=%08x s0=%08x s1=%08x s2=%08x wrap=%x" % (
@@ -399,8 +407,18 @@ def do_sniff(dev, speed, format, out, timeout):
         dev.regs.SDRAM_HOST_READ_GO.wr(0)
         dev.regs.CSTREAM_CFG.wr(0)
 
-    if out is not None:
-        out.close()
+    # Let the output handlers catch up before closing the file
+    dev.drain()
+
+    # Some outputs end with more than a flush (pcapng index, console writer)
+    getattr(output_handler, "finish", output_handler.flush)()
+
+    for handler, file in sinks:
+        if file is not None:
+            file.close()
+
+    if stats and stats_out:
+        stats_file.close()
 
 class Sniff(Command):
     name = "sniff"
@@ -411,15 +429,124 @@ class Sniff(Command):
         #@command('sniff', ('speed', str,), ('format', str, 'verbose', formats), ('out', str, None), ('timeout', int, None))
         sp.add_argument('speed', type=str, choices=sniff_speeds,
                         help='USB Speed (High Speed, Full Speed, Low Speed)')
-        sp.add_argument('--format', type=str, default='verbose', choices=sniff_formats,
-                        help='Output file format')
+        sp.add_argument('--format', type=str, action='append', choices=sniff_formats,
+                        help='Output file format (default verbose); repeat to '
+                             'write several outputs from one capture')
+        sp.add_argument('--out', type=str, action='append',
+                        help='Output file name, for the --format in the same position; '
+                             '"-" for stdout')
+        sp.add_argument('--timeout', type=int, help='Timeout in seconds')
+        sp.add_argument('--workers', type=int, default=0,
+                        help='Decode in this many worker processes')
+        sp.add_argument('--template', type=str,
+                        help='Template file for the custom format (its first line)')
+        sp.add_argument('--rotate-size', type=int,
+                        help='Start a new output file every this many MB')
+        sp.add_argument('--rotate-time', type=int,
+                        help='Start a new output file every this many seconds')
+        sp.add_argument('--rotate-keep', type=int, default=0,
+                        help='Only keep this many of the newest output files')
+        sp.add_argument('--compress', type=str, choices=compress_methods,
+                        help='Compress the output file(s)')
+        sp.add_argument('--collapse', action='store_true',
+                        help='Summarise runs of SOFs and NAKed polls (verbose and pcapng)')
+        sp.add_argument('--flush-packets', type=int,
+                        help='Output to a pipe: flush after this many packets')
+        sp.add_argument('--flush-ms', type=int,
+                        help='Output to a pipe: flush at least this often (default 50)')
+        sp.add_argument('--flush-idle-ms', type=int,
+                        help='Output to a pipe: flush after this long without packets (default 10)')
+        sp.add_argument('--stats', type=str, choices=["text", "json"],
+                        help='Report per-endpoint bandwidth, packet rates and handshake '
+                             'ratios over 1/10/60 s every second')
+        sp.add_argument('--stats-out', type=str,
+                        help='Append the --stats reports to this file instead of stderr')
+        sp.add_argument('--index', action='store_true',
+                        help='Write an index of raw and pcap output files next to them '
+                             '(FILE.idx), for time and endpoint queries')
+        sp.add_argument('--no-crc-check', dest='check_crc', action='store_false',
+                        help='Do not check token and data CRCs (packets with a bad CRC '
+                             'are not flagged)')
+
+    @staticmethod
+    def go(dev, args):
+        template = args.template and load_template(args.template)
+        do_sniff(dev, args.speed, args.format, args.out, args.timeout, args.workers, template,
+                 args.rotate_size, args.rotate_time, args.rotate_keep, args.compress,
+                 args.collapse, (args.flush_packets,
+                                 args.flush_ms and args.flush_ms / 1000,
+                                 args.flush_idle_ms and args.flush_idle_ms / 1000),
+                 args.stats, args.stats_out, args.index, args.check_crc)
+
+
+decode_formats = ["verbose", "custom", "pcap", "pcapng", "iti1480a"]
+
+def do_decode(pkg, infile, format, out, speed, workers, template=None, compress=None,
+              index=False, check_crc=True):
+    cap = open_capture(infile)
+
+    if index:
+        built = build_index(infile)
+        print("Indexed %d packets in %d blocks" % (built.packets, len(built.block_start)),
+              file=sys.stderr)
+        if format is None and out is None:
+            return
+
+    format = format or "verbose"
+
+    if cap.map_hash is not None and cap.map_hash != hashlib.sha1(pkg.read('map.txt')).digest():
+        print("Warning: %s was captured with a different firmware build" % infile, file=sys.stderr)
+
+    speed = speed or cap.speed or "hs"
+
+    if format in ["pcap", "pcapng"]:
+        assert out, "can't output %s to stdout, use --out" % format
+
+    output = open(out, "wb") if out else sys.stdout.buffer
+    if out and compress is not None:
+        output = CompressedFile(output, compress)
+    try:
+        decode_file(cap, format, output, speed, workers or os.cpu_count(),
+                    template=template, check_crc=check_crc)
+    finally:
+        if out:
+            output.close()
+        else:
+            output.flush()
+
+class Decode(Command):
+    name = "decode"
+    help = 'Convert a raw or pcap capture file'
+    needs_device = False
+
+    @staticmethod
+    def setup_args(sp):
+        sp.add_argument('input', type=str,
+                        help='Capture file written by sniff (raw or pcap)')
+        sp.add_argument('--format', type=str, choices=decode_formats,
+                        help='Output file format (default verbose)')
         sp.add_argument('--out', type=str,
                         help='Output file name')
-        sp.add_argument('--timeout', type=int, help='Timeout in seconds')
+        sp.add_argument('--speed', type=str, choices=sniff_speeds,
+                        help='USB Speed, if not recorded in the capture file')
+        sp.add_argument('--workers', type=int,
+                        help='Number of decode processes (default: one per CPU)')
+        sp.add_argument('--template', type=str,
+                        help='Template file for the custom format (its first line)')
+        sp.add_argument('--compress', type=str, choices=compress_methods,
+                        help='Compress the output file')
+        sp.add_argument('--index', action='store_true',
+                        help='Write an index of the input file next to it (INPUT.idx); '
+                             'only decode if --format or --out is given as well')
+        sp.add_argument('--no-crc-check', dest='check_crc', action='store_false',
+                        help='Do not check token and data CRCs (packets with a bad CRC '
+                             'are not flagged)')
 
     @staticmethod
     def go(dev, args):
-        do_sniff(dev, args.speed, args.format, args.out, args.timeout)
+        template = args.template and load_template(args.template)
+        do_decode(args.pkg, args.input, args.format, args.out, args.speed, args.workers,
+                  template, args.compress, args.index, args.check_crc)
 
 
 @command('debug-stream', 'Debug Stream')
@@ -566,6 +693,12 @@ def main():
     ap.add_argument("-l", "--load", action="store_true")
     ap.add_argument("--verbose", "-v", action="store_true")
     ap.add_argument("--config-only", "-C", action="store_true")
+    ap.add_argument("--native", action="store_true",
+                    help="Frame the device stream in libov instead of Python")
+    ap.add_argument("--batch-size", type=int, default=0,
+                    help="Gather this many bytes of USB transfers per stream callback")
+    ap.add_argument("--batch-latency", type=int, default=10,
+                    help="Deliver a partial batch after this many milliseconds")
 
     # Bind commands
     subparsers = ap.add_subparsers(title='subcommands',
@@ -577,8 +710,16 @@ def main():
 
     args = ap.parse_args()
 
+    if hasattr(args, 'hdlr') and not args.hdlr.needs_device:
+        return args.hdlr.go(None, args)
+
+    # With a capture going to stdout, keep all messages out of it
+    if "-" in (getattr(args, 'out', None) or []):
+        sys.stdout = sys.stderr
 
-    dev = LibOV.OVDevice(mapfile=args.pkg.open('map.txt', 'r'), verbose=args.verbose)
+    dev = LibOV.OVDevice(mapfile=args.pkg.open('map.txt', 'r'), verbose=args.verbose,
+            native=args.native, batch_size=args.batch_size,
+            batch_latency_ms=args.batch_latency)
 
     err = dev.open(bitstream=args.pkg.open('ov3.bit', 'r') if args.load else None)
 
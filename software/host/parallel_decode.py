@@ -0,0 +1,620 @@
+#
+# Multi-process decoding of capture records
+#
+# Python decoding of a busy high speed bus does not fit on one core. The
+# ParallelDecoder below copies batches of raw 0xA0 records into a ring in
+# shared memory, cut at record boundaries, and has a pool of worker
+# processes format each chunk into the requested output format. Results
+# are written out in capture order.
+#
+# decode_file() does the same for a capture file on disk (raw, or a pcap
+# written by sniff): the file is mmapped, workers find record boundaries
+# and summarise their part of it, and the summaries give each chunk its
+# starting timestamp state before the chunks are decoded in parallel.
+#
+
+import collections
+import io
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import time
+
+from multiprocessing import resource_tracker, shared_memory
+
+import LibOV
+import outputs
+
+# Optional: finds record boundaries in raw captures much faster
+try:
+    import numpy as np
+    import record_scan
+except ImportError:
+    record_scan = None
+
+# Per-process worker state, set up by _worker_init
+_worker = None
+
+def _attach(shm_name):
+    """Attach to the parent's shared ring. The parent unlinks it."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=shm_name, track=False)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    # Before 3.13 attaching registers the ring with the resource tracker,
+    # which would unlink it when this worker exits. Spawned workers share
+    # the parent's tracker though, and unregistering there would drop the
+    # parent's own registration; only a tracker of the worker's own needs it.
+    if os.name != "nt" and resource_tracker._resource_tracker._pid is not None:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+def _worker_init(shm_name, format, speed, utc_start, template):
+    global _worker
+    _worker = (_attach(shm_name), format, speed, utc_start, template)
+
+def _segments(records, count, jumps):
+    """Split 'count' records at their jumps (see outputs.seed_state).
+    Yields (records, count, clks), with the absolute time 'clks' of the
+    first record if it is a jump, else None."""
+    if not jumps:
+        yield records, count, None
+        return
+
+    starts = dict(jumps)
+    first = 0
+    first_pos = end = 0
+    for i, (pos, flags, length, ts) in enumerate(LibOV.iter_records(records, count)):
+        if i in starts and i > first:
+            yield records[first_pos:pos], i - first, starts.get(first)
+            first, first_pos = i, pos
+        end = pos + length + 8
+
+    yield records[first_pos:end], count - first, starts.get(first)
+
+def decode_records(records, count, format, speed, utc_start, state, template=None,
+                   jumps=()):
+    """Format 'count' back-to-back 0xA0 records, starting from 'state', and
+    return the output bytes (without any file header). At each of 'jumps'
+    the timestamp tracking is set again from the absolute time."""
+    out = io.BytesIO()
+    handler = outputs.make_output(format, out, speed, utc_start, header=False,
+                                  template=template)
+
+    prev = None
+    for records, count, clks in _segments(records, count, jumps):
+        if prev is not None:
+            state = outputs.advance_state(state, *prev)
+        if clks is not None:
+            state = outputs.seed_state(state, clks)
+        handler.resume(state)
+        prev = records, count
+
+        if hasattr(handler, "handle_records"):
+            handler.handle_records(records, count)
+            continue
+
+        for pos, flags, length, ts in LibOV.iter_records(records, count):
+            handler.handle_usb(ts, records[pos + 8:pos + 8 + length], flags)
+
+    handler.flush()
+    return out.getvalue()
+
+def _chunk_records(offset, length):
+    # Read-only: the ring is the parent's, and only read here
+    return _worker[0].buf[offset:offset + length].toreadonly()
+
+def _decode_chunk(offset, length, count, state):
+    shm, format, speed, utc_start, template = _worker
+    return decode_records(_chunk_records(offset, length), count, format, speed,
+                          utc_start, state, template)
+
+def _summarize_chunk(offset, length, count):
+    return outputs.summarize(_chunk_records(offset, length), count)
+
+def _advance_chunk(offset, length, count, state):
+    return outputs.advance_state(state, _chunk_records(offset, length), count)
+
+
+class _Chunk:
+    """A chunk in the shared ring, and the pool results for it"""
+
+    __slots__ = ('offset', 'length', 'count', 'summary', 'decoded', 'chained')
+
+    def __init__(self, offset, length, count, summary):
+        self.offset = offset
+        self.length = length
+        self.count = count
+        self.summary = summary
+        # Set once the chunk's starting state is known: the AsyncResult of
+        # its decoding, or False if it is not decoded after an error
+        self.decoded = None
+        # Set once the state after the chunk is known, and the chunk is no
+        # longer read for it
+        self.chained = False
+
+
+class ParallelDecoder:
+    """Record handler (see RXCSniff.record_handlers) that decodes on a pool
+    of 'workers' processes and writes the formatted result to 'output'.
+
+    Records are gathered until 'chunk_size' bytes or 'latency' seconds'
+    worth are pending, then handed off as one chunk. The workers summarise
+    each chunk (see outputs.summarize) as soon as it is handed off, and
+    the timestamp state each chunk starts from is chained from those
+    summaries on a thread of its own before the chunk is decoded. Chunks
+    are written in the order they were captured, which is timestamp order.
+
+    If a chunk fails to decode, nothing more is written. The exception is
+    kept in self.exc and raised by the next handle_records() and by
+    close().
+    """
+
+    def __init__(self, format, output, speed, workers,
+                 chunk_size=1 << 20, ring_size=64 << 20, latency=0.1,
+                 template=None):
+        self.exc = None
+
+        self.__output = output
+        self.__chunk_size = chunk_size
+        self.__latency = latency
+
+        utc_start = int(time.time())
+
+        # Read once here, so every worker uses the same template
+        if format == "custom" and template is None:
+            template = outputs.load_template()
+
+        # The file header, if the format has one, is written here once
+        header = io.BytesIO()
+        outputs.make_output(format, header, speed, utc_start)
+        output.write(header.getvalue())
+
+        self.__shm = shared_memory.SharedMemory(create=True, size=ring_size)
+        self.__ring_size = ring_size
+        self.__head = 0
+
+        ctx = multiprocessing.get_context("spawn")
+        self.__pool = ctx.Pool(workers, _worker_init,
+                               (self.__shm.name, format, speed, utc_start, template))
+
+        # Batches as handed over; only copied once, into the ring
+        self.__pending = []
+        self.__pending_len = 0
+        self.__pending_count = 0
+        self.__pending_since = None
+
+        # Chunks in the ring, oldest first, and those still waiting for
+        # their starting state
+        self.__inflight = collections.deque()
+        self.__unchained = collections.deque()
+        self.__cond = threading.Condition()
+        self.__closing = False
+
+        self.__chainer = threading.Thread(target=self.__chain_states, daemon=True)
+        self.__chainer.start()
+        self.__writer = threading.Thread(target=self.__write_results, daemon=True)
+        self.__writer.start()
+
+    def handle_records(self, records, count):
+        if self.exc is not None:
+            raise self.exc
+
+        if not self.__pending_count:
+            self.__pending_since = time.monotonic()
+
+        self.__pending.append(records)
+        self.__pending_len += len(records)
+        self.__pending_count += count
+
+        if (self.__pending_len >= self.__chunk_size or
+                time.monotonic() - self.__pending_since >= self.__latency):
+            self.__submit()
+
+    def __fits(self, n):
+        # Chunks are stored contiguously; the free space runs from __head up
+        # to the oldest chunk still being decoded
+        if not self.__inflight:
+            self.__head = 0
+            return True
+
+        tail = self.__inflight[0].offset
+        if self.__head > tail:
+            if self.__head + n <= self.__ring_size:
+                return True
+            if n < tail:
+                self.__head = 0
+                return True
+            return False
+
+        return self.__head + n < tail
+
+    def __submit(self):
+        n = self.__pending_len
+        if not n:
+            return
+
+        if n > self.__ring_size:
+            raise ValueError("Chunk of %d bytes does not fit the shared ring" % n)
+
+        with self.__cond:
+            while not self.__fits(n):
+                self.__cond.wait()
+            offset = self.__head
+            self.__head += n
+
+        pos = offset
+        for records in self.__pending:
+            self.__shm.buf[pos:pos + len(records)] = records
+            pos += len(records)
+
+        count = self.__pending_count
+        chunk = _Chunk(offset, n, count,
+                self.__pool.apply_async(_summarize_chunk, (offset, n, count)))
+
+        with self.__cond:
+            self.__inflight.append(chunk)
+            self.__unchained.append(chunk)
+            self.__cond.notify_all()
+
+        self.__pending = []
+        self.__pending_len = 0
+        self.__pending_count = 0
+
+    def __fail(self, e):
+        if self.exc is None:
+            self.exc = e
+
+    def __chain_states(self):
+        # Hands each chunk to the pool for decoding once the state it
+        # starts from is known, which is when the chunk before it has been
+        # summarised
+        state = outputs.INITIAL_STATE
+        while True:
+            with self.__cond:
+                while not self.__unchained and not self.__closing:
+                    self.__cond.wait()
+                if not self.__unchained:
+                    return
+                chunk = self.__unchained.popleft()
+
+            args = (chunk.offset, chunk.length, chunk.count)
+            decoded = False
+            if self.exc is None:
+                decoded = self.__pool.apply_async(_decode_chunk, args + (state,))
+
+            with self.__cond:
+                chunk.decoded = decoded
+                self.__cond.notify_all()
+
+            try:
+                summary = chunk.summary.get()
+                if self.exc is None:
+                    next_state = outputs.apply_summary(state, summary)
+                    if next_state is None:
+                        next_state = self.__pool.apply(_advance_chunk, args + (state,))
+                    state = next_state
+            except Exception as e:
+                self.__fail(e)
+
+            with self.__cond:
+                chunk.chained = True
+                self.__cond.notify_all()
+
+    def __write_results(self):
+        while True:
+            with self.__cond:
+                while not self.__inflight or self.__inflight[0].decoded is None:
+                    if self.__closing and not self.__inflight:
+                        return
+                    self.__cond.wait()
+                res = self.__inflight[0].decoded
+
+            if res:
+                try:
+                    data = res.get()
+                    if self.exc is None:
+                        self.__output.write(data)
+                except Exception as e:
+                    self.__fail(e)
+
+            # The ring space is free once the chainer is done with it too
+            with self.__cond:
+                while not self.__inflight[0].chained:
+                    self.__cond.wait()
+                self.__inflight.popleft()
+                self.__cond.notify_all()
+
+    def flush(self):
+        """Decode everything handed over so far and wait for it to be
+        written."""
+        self.__submit()
+
+        with self.__cond:
+            while self.__inflight:
+                self.__cond.wait()
+
+    def close(self):
+        try:
+            if self.exc is None:
+                self.flush()
+        finally:
+            with self.__cond:
+                self.__closing = True
+                self.__cond.notify_all()
+            self.__chainer.join()
+            self.__writer.join()
+
+            self.__pool.close()
+            self.__pool.join()
+
+            self.__shm.close()
+            self.__shm.unlink()
+
+        if self.exc is not None:
+            raise self.exc
+
+    def finish(self):
+        self.close()
+
+
+# Offline decoding of capture files
+
+CaptureFile = collections.namedtuple('CaptureFile',
+        ['path', 'kind', 'data_offset', 'speed', 'utc_start', 'map_hash',
+         'ts_base', 'pcap_endian', 'pcap_nano'])
+
+LINKTYPE_USB_2_0 = 288
+
+# pcap record headers by byte order
+_pcap_record = {e: struct.Struct(e + "IIII") for e in "<>"}
+
+# Consecutive records that must check out before a guessed record
+# boundary in the middle of a file is believed
+RESYNC_RECORDS = 8
+
+def open_capture(path):
+    """Identify the capture file at 'path' and return its CaptureFile.
+    Raises ValueError for anything that is not a raw capture or a USB 2.0
+    pcap file."""
+    with open(path, "rb") as f:
+        head = f.read(outputs.RAW_HEADER_SIZE)
+
+    if head.startswith(outputs.RAW_MAGIC):
+        hdr = outputs.read_raw_header(head)
+        return CaptureFile(path, "raw", hdr.size, hdr.speed,
+                hdr.utc_start_ns // 1000000000, hdr.map_hash, hdr.ts_base, None, False)
+
+    for endian in "<>":
+        if len(head) < 24:
+            break
+
+        magic, = struct.unpack_from(endian + "I", head)
+        if magic not in (0xa1b2c3d4, 0xa1b23c4d):
+            continue
+
+        linktype, = struct.unpack_from(endian + "I", head, 20)
+        if linktype != LINKTYPE_USB_2_0:
+            raise ValueError("pcap link type %d is not USB 2.0" % linktype)
+
+        pcap_record = _pcap_record[endian]
+        with open(path, "rb") as f:
+            f.seek(24)
+            first = f.read(pcap_record.size)
+        utc_start = pcap_record.unpack(first)[0] if len(first) == pcap_record.size else 0
+
+        # The pcap does not record the bus speed
+        return CaptureFile(path, "pcap", 24, None, utc_start, None, 0,
+                endian, magic == 0xa1b23c4d)
+
+    if head.startswith(b"\x1f\x8b") or head.startswith(b"\xfd7zXZ\x00"):
+        raise ValueError("%s is compressed, decompress it first" % path)
+
+    raise ValueError("%s is not a raw capture or pcap file" % path)
+
+def _record_size(cap, buf, pos):
+    """Size of the record at 'pos', or None if there is no valid record
+    there (including one running past the end of 'buf')."""
+    if cap.kind == "raw":
+        if pos + 8 > len(buf) or buf[pos] != 0xA0:
+            return None
+        size = (buf[pos + 4] << 8 | buf[pos + 3]) + 8
+    else:
+        if pos + 16 > len(buf):
+            return None
+        sec, frac, incl, orig = _pcap_record[cap.pcap_endian].unpack_from(buf, pos)
+        if incl != orig or incl > 0xFFFF or frac >= (1000000000 if cap.pcap_nano else 1000000):
+            return None
+        size = incl + 16
+
+    if pos + size > len(buf):
+        return None
+
+    return size
+
+def _resync(cap, buf, start, end):
+    """First offset in [start, end) that looks like a record boundary."""
+    for pos in range(start, min(end, len(buf))):
+        p = pos
+        for i in range(RESYNC_RECORDS):
+            size = _record_size(cap, buf, p)
+            if size is None:
+                break
+            p += size
+            if p == len(buf):
+                return pos
+        else:
+            return pos
+
+    return end
+
+def _walk(cap, buf, pos, end):
+    """Step over the records starting before 'end'. Returns the offset of
+    the first record at or past 'end', the number of records, and the
+    (offset, length) of each damaged stretch skipped on the way; after
+    one, walking picks up again at the next good record."""
+    count = 0
+    gaps = []
+    while pos < end:
+        if cap.kind == "raw" and record_scan is not None:
+            # Records start before 'end' but may run up to a maximum size past it
+            scan = record_scan.scan_records(buf, pos, min(len(buf), end + 0xFFFF + 8))
+            n = int(np.searchsorted(scan.offset, end))
+            count += n
+            if n < len(scan.offset):
+                return int(scan.offset[n]), count, gaps
+            pos += scan.used
+            if pos >= end:
+                break
+        else:
+            size = _record_size(cap, buf, pos)
+            if size is not None:
+                pos += size
+                count += 1
+                continue
+
+        if pos >= len(buf):
+            break
+
+        good = _resync(cap, buf, pos + 1, len(buf))
+        print("Skipping %d bytes of bad or truncated records at offset %d" % (good - pos, pos),
+              file=sys.stderr)
+        gaps.append((pos, good - pos))
+        pos = good
+
+    return pos, count, gaps
+
+def _records(cap, buf, start, end, count, gaps=()):
+    """The 'count' records in buf[start:end], less the damaged stretches
+    'gaps' (see _walk), as 0xA0 capture records, and their jumps (see
+    outputs.seed_state)."""
+    if cap.kind == "raw":
+        if not gaps:
+            return bytes(buf[start:end]), ()
+
+        pieces = []
+        pos = start
+        for gap, length in gaps:
+            pieces.append(buf[pos:gap])
+            pos = gap + length
+        pieces.append(buf[pos:end])
+        return b"".join(pieces), ()
+
+    # pcap: rebuild the 24-bit 60 MHz device timestamps from the record
+    # times. Times are relative to the first record of the file. The first
+    # record, and any that cannot be reached from the one before by
+    # counting wraps, carry their absolute time as a jump.
+    records = bytearray()
+    jumps = []
+    skip = dict(gaps)
+    last = None
+    pos = start
+    for i in range(count):
+        pos += skip.get(pos, 0)
+        sec, frac, incl, orig = _pcap_record[cap.pcap_endian].unpack_from(buf, pos)
+        if cap.pcap_nano:
+            clks = (frac * 3 + 25) // 50
+        else:
+            clks = frac * 60
+        clks += (sec - cap.utc_start) * outputs.CLOCK_HZ
+        ts = clks & (outputs.TS_WRAP - 1)
+
+        if last is None or not 0 <= clks - last < outputs.TS_WRAP:
+            jumps.append((i, clks))
+        last = clks
+
+        records += struct.pack("<BHHBH", 0xA0, 0, incl, ts & 0xff, ts >> 8)
+        records += buf[pos + 16:pos + 16 + incl]
+        pos += incl + 16
+
+    return bytes(records), jumps
+
+# Per-process state for offline decoding, set up by _file_worker_init
+_file_worker = None
+
+def _file_worker_init(cap, format, speed, template, check_crc):
+    global _file_worker
+    with open(cap.path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _file_worker = (cap, buf, format, speed, template, check_crc)
+
+def _scan_chunk(start, end, exact):
+    """Find the records of the chunk [start, end) and summarise them.
+    Unless 'exact', start is a guess and is moved up to the first record
+    boundary."""
+    cap, buf, format, speed, template, check_crc = _file_worker
+
+    if not exact:
+        start = _resync(cap, buf, start, end)
+
+    stop, count, gaps = _walk(cap, buf, start, end)
+    records, jumps = _records(cap, buf, start, stop, count, gaps)
+    return start, stop, count, gaps, outputs.summarize(records, count, jumps)
+
+def _decode_file_chunk(start, stop, count, gaps, state):
+    cap, buf, format, speed, template, check_crc = _file_worker
+    records, jumps = _records(cap, buf, start, stop, count, gaps)
+    if check_crc:
+        records = LibOV.check_records_crc(records, count)
+    return decode_records(records, count, format, speed, cap.utc_start, state,
+                          template, jumps)
+
+def decode_file(cap, format, output, speed, workers, chunk_size=32 << 20,
+                template=None, check_crc=True):
+    """Decode capture file 'cap' (see open_capture) into 'format' on
+    'workers' processes, writing the result to binary stream 'output'.
+    With 'check_crc', packets with a bad CRC are flagged HF_CRC_BAD."""
+    size = os.path.getsize(cap.path)
+
+    if format == "custom" and template is None:
+        template = outputs.load_template()
+
+    header = io.BytesIO()
+    outputs.make_output(format, header, speed, cap.utc_start)
+    output.write(header.getvalue())
+
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers, _file_worker_init,
+                  (cap, format, speed, template, check_crc)) as pool:
+        bounds = list(range(cap.data_offset, size, chunk_size)) + [size]
+        spans = list(zip(bounds[:-1], bounds[1:]))
+
+        scans = pool.starmap(_scan_chunk,
+                [(start, end, start == cap.data_offset) for start, end in spans])
+
+        # Each chunk has to start where the one before it stopped. Where a
+        # guessed boundary was wrong, scan the chunk again from there.
+        chunks = []
+        pos = cap.data_offset
+        for (start, end), scan in zip(spans, scans):
+            if scan[0] != pos:
+                scan = pool.apply(_scan_chunk, (pos, end, True))
+            chunks.append(scan)
+            pos = scan[1]
+
+        # Work out the timestamp state each chunk starts from
+        jobs = []
+        state = outputs.INITIAL_STATE._replace(ts_base=cap.ts_base)
+        with open(cap.path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            for start, stop, count, gaps, summary in chunks:
+                jobs.append((start, stop, count, gaps, state))
+
+                next_state = outputs.apply_summary(state, summary)
+                if next_state is None:
+                    records, jumps = _records(cap, buf, start, stop, count, gaps)
+                    next_state = outputs.advance_state(state, records, count, jumps)
+                state = next_state
+            buf.close()
+
+        # Keep only a few chunks' output waiting to be written
+        results = collections.deque()
+        for job in jobs:
+            if len(results) >= 2 * workers:
+                output.write(results.popleft().get())
+            results.append(pool.apply_async(_decode_file_chunk, job))
+        while results:
+            output.write(results.popleft().get())
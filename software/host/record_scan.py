@@ -0,0 +1,76 @@
+#
+# Vectorized scanning of capture record buffers
+#
+# Walking the chain of length-prefixed 0xA0 records is done by
+# OVRecords_Scan in libov; everything else (flags, sizes, timestamps,
+# wrap reconstruction) is done on whole NumPy arrays at once.
+#
+
+import collections
+import ctypes
+
+import numpy as np
+
+import LibOV
+
+TS_WRAP = 1 << 24
+
+# Per-record arrays for a buffer of records. 'offset' is the offset of the
+# 8-byte record header, 'length' the payload length. 'used' is the number
+# of bytes of the buffer covered by the records found.
+RecordArrays = collections.namedtuple('RecordArrays',
+        ['offset', 'length', 'flags', 'ts', 'used'])
+
+def scan_records(buf, start=0, end=None, max_records=None, step=1 << 20):
+    """Find the back-to-back 0xA0 records in buf[start:end] (any object
+    supporting the buffer protocol, e.g. bytes or an mmap). Scanning stops
+    at the first incomplete or malformed record, or after 'max_records'.
+    Offsets in the result are relative to the start of 'buf'."""
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if end is None:
+        end = len(data)
+
+    base = data.ctypes.data
+    used = ctypes.c_size_t()
+    chunk = np.empty(step, dtype=np.int64)
+
+    parts = []
+    pos = start
+    total = 0
+    while pos < end and (max_records is None or total < max_records):
+        want = step if max_records is None else min(step, max_records - total)
+
+        n = LibOV.OVRecords_Scan(base + pos, end - pos, chunk.ctypes.data,
+                                 want, ctypes.byref(used))
+        parts.append(chunk[:n] + pos)
+        pos += used.value
+        total += n
+
+        if n < want:
+            break
+
+    offset = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+    return RecordArrays(offset, *record_fields(data, offset), used=pos - start)
+
+def record_fields(data, offset):
+    """Extract (length, flags, ts) arrays for the records at 'offset' in
+    uint8 array 'data'."""
+    length = data[offset + 3].astype(np.uint32) | data[offset + 4].astype(np.uint32) << 8
+    flags = data[offset + 1].astype(np.uint32) | data[offset + 2].astype(np.uint32) << 8
+    ts = (data[offset + 5].astype(np.uint32) |
+          data[offset + 6].astype(np.uint32) << 8 |
+          data[offset + 7].astype(np.uint32) << 16)
+
+    return length, flags, ts
+
+def unwrap_ts(ts, last_ts=0, ts_base=0):
+    """Turn an array of raw 24-bit timestamps into 64-bit clock counts,
+    continuing from the raw timestamp 'last_ts' and wrap offset 'ts_base'
+    of the packet before them (see outputs.DecodeState)."""
+    ts = ts.astype(np.int64)
+    prev = np.empty_like(ts)
+    prev[:1] = last_ts
+    prev[1:] = ts[:-1]
+
+    wraps = np.cumsum(ts < prev, dtype=np.int64)
+    return ts_base + wraps * TS_WRAP + ts
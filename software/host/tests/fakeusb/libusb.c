@@ -0,0 +1,149 @@
+/*
+ * A scripted stand-in for libusb-1.0, for testing the FTDI stream reader
+ * without a device. Submitted transfers wait until the next call to
+ * libusb_handle_events_timeout, which completes them all with FTDI
+ * packets whose payloads count up byte by byte, fails, or only sleeps,
+ * as the fake_* variables below say.
+ */
+
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+#include "libusb.h"
+#include "fastftdi.h"
+
+#define MAX_PENDING 64
+
+/* Calls to libusb_handle_events_timeout so far */
+int fake_calls;
+
+/* Calls that complete the pending transfers with data: [first, last) */
+int fake_data_first = 0;
+int fake_data_last = 1;
+
+/* Call that returns fake_error instead, and the call on which
+   FTDIStream_Stop(fake_stream) is called; -1 for none */
+int fake_fail_at = -1;
+int fake_error = LIBUSB_ERROR_IO;
+int fake_stop_at = -1;
+void *fake_stream;
+
+/* Bytes (with FTDI headers) carried by a transfer that is cancelled */
+int fake_cancel_length = 0;
+
+/* Next payload byte */
+unsigned char fake_counter;
+
+static struct libusb_transfer *pending[MAX_PENDING];
+static int cancelled[MAX_PENDING];
+static int npending;
+
+static void
+fill(struct libusb_transfer *transfer, int length)
+{
+  int pos, i;
+
+  for (pos = 0; pos < length; pos += FTDI_PACKET_SIZE) {
+    transfer->buffer[pos] = 0x31;
+    transfer->buffer[pos + 1] = 0x60;
+    for (i = pos + FTDI_HEADER_SIZE; i < pos + FTDI_PACKET_SIZE && i < length; i++)
+      transfer->buffer[i] = fake_counter++;
+  }
+  transfer->actual_length = length;
+}
+
+int
+libusb_handle_events_timeout(libusb_context *ctx, struct timeval *tv)
+{
+  struct libusb_transfer *current[MAX_PENDING];
+  int was_cancelled[MAX_PENDING];
+  int i, n = npending;
+  int call = fake_calls++;
+
+  if (call == fake_stop_at)
+    FTDIStream_Stop(fake_stream);
+
+  if (call == fake_fail_at)
+    return fake_error;
+
+  memcpy(current, pending, n * sizeof *current);
+  memcpy(was_cancelled, cancelled, n * sizeof *was_cancelled);
+  npending = 0;
+
+  for (i = 0; i < n; i++) {
+    struct libusb_transfer *transfer = current[i];
+
+    if (was_cancelled[i]) {
+      fill(transfer, fake_cancel_length);
+      transfer->status = LIBUSB_TRANSFER_CANCELLED;
+    } else if (call >= fake_data_first && call < fake_data_last) {
+      fill(transfer, transfer->length);
+      transfer->status = LIBUSB_TRANSFER_COMPLETED;
+    } else {
+      cancelled[npending] = 0;
+      pending[npending++] = transfer;
+      continue;
+    }
+    transfer->callback(transfer);
+  }
+
+  if (npending == n)
+    usleep(tv->tv_sec * 1000000 + tv->tv_usec);
+  return 0;
+}
+
+int
+libusb_submit_transfer(struct libusb_transfer *transfer)
+{
+  if (npending == MAX_PENDING)
+    return LIBUSB_ERROR_NO_MEM;
+  cancelled[npending] = 0;
+  pending[npending++] = transfer;
+  return 0;
+}
+
+int
+libusb_cancel_transfer(struct libusb_transfer *transfer)
+{
+  int i;
+
+  for (i = 0; i < npending; i++)
+    if (pending[i] == transfer)
+      cancelled[i] = 1;
+  return 0;
+}
+
+struct libusb_transfer *
+libusb_alloc_transfer(int iso_packets)
+{
+  return calloc(1, sizeof(struct libusb_transfer));
+}
+
+void
+libusb_free_transfer(struct libusb_transfer *transfer)
+{
+  free(transfer);
+}
+
+/* Everything else fastftdi.c links against; never used by the tests */
+
+int libusb_init(libusb_context **ctx) { return LIBUSB_ERROR_OTHER; }
+void libusb_exit(libusb_context *ctx) { }
+int libusb_set_option(libusb_context *ctx, int option, ...) { return 0; }
+libusb_device_handle *libusb_open_device_with_vid_pid(libusb_context *ctx,
+    uint16_t vid, uint16_t pid) { return NULL; }
+void libusb_close(libusb_device_handle *handle) { }
+int libusb_kernel_driver_active(libusb_device_handle *handle, int interface) { return 0; }
+int libusb_detach_kernel_driver(libusb_device_handle *handle, int interface) { return 0; }
+int libusb_set_configuration(libusb_device_handle *handle, int configuration) { return 0; }
+int libusb_claim_interface(libusb_device_handle *handle, int interface) { return 0; }
+int libusb_release_interface(libusb_device_handle *handle, int interface) { return 0; }
+int libusb_reset_device(libusb_device_handle *handle) { return 0; }
+int libusb_control_transfer(libusb_device_handle *handle, uint8_t request_type,
+    uint8_t request, uint16_t value, uint16_t index, unsigned char *data,
+    uint16_t length, unsigned int timeout) { return LIBUSB_ERROR_IO; }
+int libusb_bulk_transfer(libusb_device_handle *handle, unsigned char endpoint,
+    unsigned char *data, int length, int *transferred,
+    unsigned int timeout) { return LIBUSB_ERROR_IO; }
+const char *libusb_error_name(int error) { return "LIBUSB_ERROR"; }
@@ -0,0 +1,99 @@
+/*
+ * The part of libusb-1.0 that fastftdi.c uses, for building it against
+ * the scripted fake in libusb.c (see tests/test_ftdistream.py).
+ */
+
+#ifndef FAKE_LIBUSB_H
+#define FAKE_LIBUSB_H
+
+#include <stdint.h>
+#include <sys/time.h>
+
+#define LIBUSB_CALL
+
+typedef struct libusb_context libusb_context;
+typedef struct libusb_device_handle libusb_device_handle;
+
+struct libusb_transfer;
+typedef void (LIBUSB_CALL *libusb_transfer_cb_fn)(struct libusb_transfer *transfer);
+
+enum libusb_transfer_status {
+  LIBUSB_TRANSFER_COMPLETED,
+  LIBUSB_TRANSFER_ERROR,
+  LIBUSB_TRANSFER_TIMED_OUT,
+  LIBUSB_TRANSFER_CANCELLED,
+};
+
+enum libusb_error {
+  LIBUSB_SUCCESS = 0,
+  LIBUSB_ERROR_IO = -1,
+  LIBUSB_ERROR_INVALID_PARAM = -2,
+  LIBUSB_ERROR_NO_DEVICE = -4,
+  LIBUSB_ERROR_INTERRUPTED = -10,
+  LIBUSB_ERROR_NO_MEM = -11,
+  LIBUSB_ERROR_OTHER = -99,
+};
+
+#define LIBUSB_REQUEST_TYPE_VENDOR  0x40
+#define LIBUSB_RECIPIENT_DEVICE     0x00
+#define LIBUSB_ENDPOINT_OUT         0x00
+#define LIBUSB_ENDPOINT_IN          0x80
+#define LIBUSB_OPTION_LOG_LEVEL     0
+
+struct libusb_transfer {
+  libusb_device_handle *dev_handle;
+  uint8_t flags;
+  unsigned char endpoint;
+  unsigned char type;
+  unsigned int timeout;
+  int status;
+  int length;
+  int actual_length;
+  libusb_transfer_cb_fn callback;
+  void *user_data;
+  unsigned char *buffer;
+  int num_iso_packets;
+};
+
+int libusb_init(libusb_context **ctx);
+void libusb_exit(libusb_context *ctx);
+int libusb_set_option(libusb_context *ctx, int option, ...);
+libusb_device_handle *libusb_open_device_with_vid_pid(libusb_context *ctx,
+                                                      uint16_t vid, uint16_t pid);
+void libusb_close(libusb_device_handle *handle);
+int libusb_kernel_driver_active(libusb_device_handle *handle, int interface);
+int libusb_detach_kernel_driver(libusb_device_handle *handle, int interface);
+int libusb_set_configuration(libusb_device_handle *handle, int configuration);
+int libusb_claim_interface(libusb_device_handle *handle, int interface);
+int libusb_release_interface(libusb_device_handle *handle, int interface);
+int libusb_reset_device(libusb_device_handle *handle);
+int libusb_control_transfer(libusb_device_handle *handle, uint8_t request_type,
+                            uint8_t request, uint16_t value, uint16_t index,
+                            unsigned char *data, uint16_t length, unsigned int timeout);
+int libusb_bulk_transfer(libusb_device_handle *handle, unsigned char endpoint,
+                         unsigned char *data, int length, int *transferred,
+                         unsigned int timeout);
+struct libusb_transfer *libusb_alloc_transfer(int iso_packets);
+void libusb_free_transfer(struct libusb_transfer *transfer);
+int libusb_submit_transfer(struct libusb_transfer *transfer);
+int libusb_cancel_transfer(struct libusb_transfer *transfer);
+int libusb_handle_events_timeout(libusb_context *ctx, struct timeval *tv);
+const char *libusb_error_name(int error);
+
+static inline void
+libusb_fill_bulk_transfer(struct libusb_transfer *transfer,
+                          libusb_device_handle *handle, unsigned char endpoint,
+                          unsigned char *buffer, int length,
+                          libusb_transfer_cb_fn callback, void *user_data,
+                          unsigned int timeout)
+{
+  transfer->dev_handle = handle;
+  transfer->endpoint = endpoint;
+  transfer->buffer = buffer;
+  transfer->length = length;
+  transfer->callback = callback;
+  transfer->user_data = user_data;
+  transfer->timeout = timeout;
+}
+
+#endif
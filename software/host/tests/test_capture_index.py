@@ -0,0 +1,153 @@
+#
+# Capture index: the index built while capturing must be the one built
+# from the finished file, and queries through it must find what a full
+# scan of the capture finds
+#
+
+import os
+import tempfile
+import unittest
+
+import capture_index
+import outputs
+
+from tests.test_outputs import UTC_START
+from tests.test_stream import record
+
+SOF = b"\xa5\x00\x00"
+IN_3_1 = b"\x69\x83\x00"
+OUT_5_2 = b"\xe1\x05\x01"
+DATA0 = b"\xc3\x00\x01\x02\x03\xef\x7a"
+DATA1 = b"\x4b\x10\x20\x76\x4f"
+ACK = b"\xd2"
+NAK = b"\x5a"
+
+PID_IN, PID_OUT, PID_DATA0, PID_DATA1, PID_ACK, PID_NAK = 0x9, 0x1, 0x3, 0xB, 0x2, 0xA
+
+def traffic(frames=2500):
+    """(clks, pkt) of 'frames' microframes, each with an IN transaction on
+    3.1 and every third one a NAKed OUT to 5.2. Wraps the clock once."""
+    packets = []
+    for i in range(frames):
+        t = i * 7500
+        packets += [(t, SOF), (t + 100, IN_3_1), (t + 140, DATA1), (t + 180, ACK)]
+        if i % 3 == 0:
+            packets += [(t + 3000, OUT_5_2), (t + 3040, DATA0), (t + 3200, NAK)]
+    return packets
+
+def endpoint_of(packets):
+    """Each (clks, pkt) with the (addr, endp) of its transaction, or None."""
+    endpoint = None
+    for clks, pkt in packets:
+        if pkt in (IN_3_1, OUT_5_2):
+            endpoint = (3, 1) if pkt == IN_3_1 else (5, 2)
+        elif pkt == SOF:
+            endpoint = None
+        yield clks, pkt, endpoint
+        if pkt in (ACK, NAK):
+            endpoint = None
+
+
+class CaptureIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.packets = traffic()
+
+    def capture(self, kind):
+        """Write the traffic as a 'kind' capture through IndexedOutput, in
+        batches of 1000 records. Returns the path and the index's contents."""
+        path = os.path.join(self.dir.name, "cap." + kind)
+        records = [record(pkt, clks & (outputs.TS_WRAP - 1)) for clks, pkt in self.packets]
+        with open(path, "wb") as f:
+            if kind == "raw":
+                output = outputs.OutputRaw(f, "hs", UTC_START * 1000000000)
+            else:
+                output = outputs.OutputPcap(f, UTC_START)
+            indexed = capture_index.IndexedOutput(output, kind, path)
+            for i in range(0, len(records), 1000):
+                batch = records[i:i + 1000]
+                indexed.handle_records(b"".join(batch), len(batch))
+            indexed.finish()
+        with open(capture_index.index_path(path), "rb") as f:
+            return path, f.read()
+
+    def test_live_and_offline(self):
+        for kind in capture_index.KINDS:
+            with self.subTest(kind=kind):
+                path, live = self.capture(kind)
+                os.remove(capture_index.index_path(path))
+
+                builder = capture_index.build_index(path)
+                with open(capture_index.index_path(path), "rb") as f:
+                    self.assertEqual(f.read(), live)
+
+                self.assertEqual(builder.packets, len(self.packets))
+                self.assertEqual(builder.size, os.path.getsize(path))
+                # Blocks of a millisecond, each starting at a token or SOF
+                self.assertEqual(len(builder.block_start), 313)
+                with capture_index.CaptureIndex(path) as index:
+                    for block, start in enumerate(index.block_start):
+                        clks, pkt = self.packets[index.block_packet[block]]
+                        self.assertEqual(clks, start)
+                        self.assertIn(pkt, (SOF, IN_3_1, OUT_5_2))
+
+    def test_queries(self):
+        for kind in capture_index.KINDS:
+            with self.subTest(kind=kind):
+                path, live = self.capture(kind)
+                with capture_index.CaptureIndex(path) as index:
+                    self.assertEqual(index.endpoints(),
+                                     [(3, 1, PID_ACK), (3, 1, PID_IN), (3, 1, PID_DATA1),
+                                      (5, 2, PID_OUT), (5, 2, PID_DATA0), (5, 2, PID_NAK)])
+                    self.check_queries(index)
+
+    def check_queries(self, index):
+        def found(addr, endp, pid=None, start=None, end=None):
+            return [(p.clks, p.pkt) for p in index.find(addr, endp, pid, start, end)]
+
+        def expect(addr, endp, pid=None, start=0, end=1 << 62):
+            return [(clks, pkt) for clks, pkt, endpoint in endpoint_of(self.packets)
+                    if endpoint == (addr, endp) and (pid is None or pkt[0] & 0xF == pid)
+                    and start <= clks < end]
+
+        self.assertEqual(found(3, 1), expect(3, 1))
+        self.assertEqual(len(found(3, 1)), 3 * 2500)
+        self.assertEqual(found(5, 2, PID_NAK), expect(5, 2, PID_NAK))
+        # Across the wrap, and bounds in the middle of a block
+        start, end = outputs.TS_WRAP - 50000, outputs.TS_WRAP + 123456
+        self.assertEqual(found(5, 2, None, start, end), expect(5, 2, None, start, end))
+        self.assertEqual(found(3, 1, PID_DATA1, start, end), expect(3, 1, PID_DATA1, start, end))
+        self.assertEqual(found(3, 1, PID_NAK), [])
+        self.assertEqual(found(7, 0), [])
+
+        # around() is every packet within 5 ms either side
+        clks = outputs.TS_WRAP + 1000
+        span = outputs.CLOCK_HZ // 100
+        got = list(index.around(clks))
+        self.assertEqual([(p.clks, p.pkt) for p in got],
+                         [(t, pkt) for t, pkt in self.packets if abs(t - clks) < span // 2
+                          or t - clks == -span // 2])
+        # The offsets lead back to the records in the file
+        for p in got[:10]:
+            if index.cap.kind == "raw":
+                self.assertEqual(index.buf[p.offset], 0xA0)
+                self.assertEqual(bytes(index.buf[p.offset + 8:p.offset + 8 + len(p.pkt)]), p.pkt)
+            else:
+                self.assertEqual(bytes(index.buf[p.offset + 16:p.offset + 16 + len(p.pkt)]), p.pkt)
+
+    def test_mismatch(self):
+        # An index of a longer file, or of another kind, is refused
+        path, live = self.capture("raw")
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 8)
+        with self.assertRaises(ValueError):
+            capture_index.CaptureIndex(path)
+
+        pcap, _ = self.capture("pcap")
+        with self.assertRaises(ValueError):
+            capture_index.CaptureIndex(pcap, capture_index.index_path(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
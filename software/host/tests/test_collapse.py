@@ -0,0 +1,103 @@
+#
+# Collapsing idle SOF and IN/NAK traffic into runs, with the counts kept
+# and everything else passed through in order
+#
+
+import unittest
+
+import outputs
+
+from tests.test_stream import record
+
+IN_3_1 = b"\x69\x83\x00"
+NAK = b"\x5a"
+DATA = b"\xc3\x00\x01\x02\x03\xef\x7a"
+ACK = b"\xd2"
+
+def sof(frame):
+    return bytes([0xa5, frame & 0xFF, frame >> 8 & 0x7])
+
+
+class _Calls:
+    def __init__(self):
+        self.calls = []
+
+    def handle_usb(self, ts, pkt, flags):
+        self.calls.append(("usb", ts, bytes(pkt), flags))
+
+    def handle_run(self, run):
+        self.calls.append(("run", run))
+
+    def resume(self, state):
+        self.calls.append(("resume", state))
+
+    def flush(self):
+        self.calls.append(("flush",))
+
+
+class CollapserTest(unittest.TestCase):
+    def feed(self, packets, **kw):
+        """Feed (ts, pkt[, flags]) through a Collapser as one batch of records."""
+        out = _Calls()
+        collapser = outputs.Collapser(out, **kw)
+        records = b"".join(record(p[1], p[0], p[2] if len(p) > 2 else 0) for p in packets)
+        collapser.handle_records(records, len(packets))
+        collapser.flush()
+        return out.calls
+
+    def test_runs(self):
+        # 40 microframes of SOF and an IN/NAK poll, then a transaction
+        packets = []
+        ts = 0
+        for i in range(40):
+            packets += [(ts, sof(100 + i // 8)), (ts + 300, IN_3_1), (ts + 340, NAK)]
+            ts += 7500
+        packets += [(ts, IN_3_1), (ts + 40, DATA), (ts + 80, ACK)]
+
+        calls = self.feed(packets)
+        self.assertEqual([c[0] for c in calls], ["run", "usb", "usb", "usb", "flush"])
+
+        run = calls[0][1]
+        self.assertEqual((run.start, run.end, run.start_ts, run.end_ts), (0, 39 * 7500 + 340,
+                                                                          0, 39 * 7500 + 340))
+        self.assertEqual(len(run.frames), 40)
+        self.assertEqual(run.frames[0], (0, 100))
+        self.assertEqual(run.frames[-1], (39 * 7500, 104))
+        self.assertEqual(dict(run.naks), {(0x69, 3, 1): 40})
+        self.assertEqual(outputs.format_run(run), "40 SOF (frame 100-104), 40 IN/NAK 3.1, 4.881 ms")
+
+        # The IN of the transaction is no poll: it is released, in order
+        self.assertEqual(calls[1:4], [("usb", ts, IN_3_1, 0), ("usb", ts + 40, DATA, 0),
+                                      ("usb", ts + 80, ACK, 0)])
+
+    def test_short_stretch(self):
+        # Fewer than min_packets: passed through as they are
+        packets = [(i * 7500, sof(i)) for i in range(5)] + [(40000, DATA)]
+        calls = self.feed(packets, min_packets=8)
+        self.assertEqual(calls[:-1], [("usb", ts, pkt, 0) for ts, pkt in packets])
+
+    def test_flags_and_span(self):
+        # Flagged packets are never collapsed, and runs are closed every
+        # max_span clocks, across timestamp wraps
+        packets = [(i * 7500 % outputs.TS_WRAP, sof(i)) for i in range(3000)]
+        packets[1500] += (outputs.LibOV.HF0_ERR,)
+        calls = self.feed(packets, min_packets=4, max_span=75000)
+
+        runs = [c[1] for c in calls if c[0] == "run"]
+        usb = [c for c in calls if c[0] == "usb"]
+        self.assertEqual(usb, [("usb", packets[1500][0], packets[1500][1], outputs.LibOV.HF0_ERR)])
+        self.assertEqual(sum(len(r.frames) for r in runs), 2999)
+        self.assertTrue(all(r.end - r.start < 75000 for r in runs))
+        self.assertEqual(runs[-1].end, 2999 * 7500)
+        # Frame numbers as USBInterpreter reads them: the low 8 bits
+        self.assertEqual([f[1] for r in runs for f in r.frames],
+                         [i & 0xFF for i in range(3000) if i != 1500])
+
+    def test_held_token_at_flush(self):
+        # A token still waiting for its NAK is passed on when flushed
+        calls = self.feed([(10, IN_3_1)])
+        self.assertEqual(calls, [("usb", 10, IN_3_1, 0), ("flush",)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+#
+# Compressed outputs: whatever is written must decompress to the same
+# bytes, however it was cut into blocks
+#
+
+import glob
+import gzip
+import io
+import lzma
+import os
+import random
+import tempfile
+import unittest
+
+import outputs
+
+from tests.test_outputs import UTC_START, session
+from tests.test_rotate import batches
+
+DECOMPRESS = {"gzip": gzip.decompress, "xz": lzma.decompress}
+
+
+class _Closing(io.BytesIO):
+    # Keeps the contents readable once the wrapper has closed it
+    def close(self):
+        self.contents = self.getvalue()
+        super().close()
+
+
+class CompressedFileTest(unittest.TestCase):
+    def test_round_trip(self):
+        rng = random.Random(3)
+        data = bytes(rng.randrange(16) for _ in range(200000))
+        for method in sorted(outputs.COMPRESSORS):
+            with self.subTest(method=method):
+                out = _Closing()
+                f = outputs.CompressedFile(out, method, workers=3, block_size=10000)
+                pos = 0
+                while pos < len(data):
+                    n = rng.choice([1, 100, 4096, 30000])
+                    f.write(data[pos:pos + n])
+                    pos += n
+                f.close()
+
+                self.assertLess(len(out.contents), len(data))
+                self.assertEqual(DECOMPRESS[method](out.contents), data)
+
+    def test_flush(self):
+        # flush() writes finished blocks only; the partial block waits
+        out = _Closing()
+        f = outputs.CompressedFile(out, "gzip", block_size=1000)
+        for n in (1000, 1000, 500):
+            f.write(b"a" * n)
+        for future in list(f.pending):
+            future.result()
+        f.flush()
+        self.assertEqual(gzip.decompress(out.getvalue()), b"a" * 2000)
+
+        f.write(b"b" * 10)
+        f.close()
+        self.assertEqual(gzip.decompress(out.contents), b"a" * 2500 + b"b" * 10)
+
+    def test_empty(self):
+        out = _Closing()
+        outputs.CompressedFile(out, "xz").close()
+        self.assertEqual(out.contents, b"")
+
+
+class CompressedRotationTest(unittest.TestCase):
+    def test_rotating(self):
+        # Every file is compressed on its own, with the extension kept
+        # last. (A new file for every batch.)
+        records, packets = session(300)
+        with tempfile.TemporaryDirectory() as d:
+            out = outputs.RotatingOutput(os.path.join(d, "cap.pcap.gz"), "pcap", "hs",
+                                         max_seconds=0, compress="gzip")
+            out.utc_start_ns = UTC_START * 1000000000
+            for batch in batches(records, len(packets), 50):
+                out.handle_records(*batch)
+            out.finish()
+
+            files = sorted(glob.glob(os.path.join(d, "*")))
+            self.assertEqual(len(files), 6)
+            self.assertEqual(os.path.basename(files[0]), "cap-00001.pcap.gz")
+
+            data = b""
+            for path in files:
+                with gzip.open(path) as f:
+                    contents = f.read()
+                self.assertEqual(contents[:4], b"\x4d\x3c\xb2\xa1")
+                data += contents[24:]
+
+        expect = io.BytesIO()
+        pcap = outputs.OutputPcap(expect, UTC_START)
+        pcap.handle_records(records, len(packets))
+        pcap.flush()
+        self.assertEqual(data, expect.getvalue()[24:])
+
+
+if __name__ == "__main__":
+    unittest.main()
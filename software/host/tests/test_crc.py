@@ -0,0 +1,113 @@
+#
+# Token and data CRC checks against known packets
+#
+
+import contextlib
+import io
+import unittest
+
+import LibOV
+import outputs
+import usb_crc
+
+from tests.test_stream import record
+
+# SETUP to address 0 endpoint 0 as sent by every host, and the examples
+# of Intel's "Cyclic Redundancy Checks in USB": tokens to 0x15.0xe and
+# 0x3a.0xa, and DATA0 packets carrying 00 01 02 03 and 23 45 67 89
+SETUP = b"\x2d\x00\x10"
+OUT = b"\xe1\x15\xef"
+IN = b"\x69\x3a\x3d"
+DATA0 = b"\xc3\x00\x01\x02\x03\xef\x7a"
+DATA0_2 = b"\xc3\x23\x45\x67\x89\x0e\x1c"
+ACK = b"\xd2"
+
+def corrupt(pkt):
+    return pkt[:1] + bytes([pkt[1] ^ 0x01]) + pkt[2:]
+
+def flags(records, count):
+    out = []
+    pos = 0
+    for i in range(count):
+        out.append(records[pos + 1] | records[pos + 2] << 8)
+        pos += (records[pos + 4] << 8 | records[pos + 3]) + 8
+    return out
+
+
+class CrcTest(unittest.TestCase):
+    def test_known_packets(self):
+        self.assertEqual(usb_crc.crc16(b"\x00\x01\x02\x03"), 0x7aef)
+        self.assertEqual(usb_crc.crc16(b"\x23\x45\x67\x89"), 0x1c0e)
+        self.assertEqual(usb_crc.crc5(0x000), 0x02)
+        self.assertEqual(usb_crc.crc5(0x715), 0x1d)
+        self.assertEqual(usb_crc.crc5(0x53a), 0x07)
+        for pkt in (SETUP, OUT, IN, DATA0, DATA0_2):
+            self.assertEqual(usb_crc.check_packet(pkt), usb_crc.CRC_GOOD, pkt)
+            self.assertEqual(usb_crc.check_packet(corrupt(pkt)), usb_crc.CRC_BAD, pkt)
+        self.assertEqual(usb_crc.check_packet(ACK), usb_crc.CRC_NONE)
+
+    def test_records(self):
+        packets = [SETUP, DATA0, ACK, corrupt(OUT), corrupt(DATA0_2), IN]
+        records = b"".join(record(pkt, i, 0x10 if i == 0 else 0) for i, pkt in enumerate(packets))
+        expect = [0x10, 0, 0, LibOV.HF_CRC_BAD, LibOV.HF_CRC_BAD, 0]
+
+        # Read-only records are copied only because some are bad
+        marked = LibOV.check_records_crc(records, len(packets))
+        self.assertEqual(flags(marked, len(packets)), expect)
+        self.assertEqual(flags(records, len(packets)), [0x10, 0, 0, 0, 0, 0])
+
+        good = records[:sum(len(p) + 8 for p in packets[:3])]
+        self.assertIs(LibOV.check_records_crc(good, 3), good)
+
+        # A bytearray is marked where it is
+        buf = bytearray(records)
+        self.assertIs(LibOV.check_records_crc(buf, len(packets)), buf)
+        self.assertEqual(flags(buf, len(packets)), expect)
+
+        buf = bytearray(records)
+        self.assertEqual(usb_crc.check_records(buf, len(packets)), 2)
+        self.assertEqual(flags(buf, len(packets)), expect)
+
+    def test_raw_unmarked(self):
+        # Raw captures keep the records as the device sent them
+        packets = [SETUP, corrupt(DATA0), ACK]
+        records = b"".join(record(pkt, i) for i, pkt in enumerate(packets))
+        marked = LibOV.check_records_crc(records, len(packets))
+        self.assertNotEqual(marked, records)
+
+        out = io.BytesIO()
+        raw = outputs.OutputRaw(out, "hs", utc_start_ns=0)
+        raw.handle_records(marked, len(packets))
+        raw.handle_records(marked, len(packets))
+        raw.flush()
+
+        self.assertEqual(out.getvalue()[outputs.RAW_HEADER_SIZE:], records * 2)
+
+    def test_errors_reported(self):
+        # A bad CRC is no device error; device errors go to stderr
+        packets = [(SETUP, 0x10), (corrupt(DATA0), 0), (ACK, LibOV.HF0_OVF),
+                   (IN, LibOV.HF0_ERR | LibOV.HF0_TRUNC), (ACK, 0x20)]
+        records = b"".join(record(pkt, i, f) for i, (pkt, f) in enumerate(packets))
+        sniff = LibOV.RXCSniff().service
+        sniff.handlers = []
+
+        out, err = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            sniff.deliver((records, len(packets)))
+            sniff.deliver((bytearray(records), len(packets)))
+
+        self.assertEqual(out.getvalue(), "")
+        self.assertEqual(err.getvalue().splitlines(),
+                         ["PERR: 0002 (Overflow)", "PERR: 0009 (Error Truncated)"] * 2)
+
+        # Past the first few in a batch, only the number is reported
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            sniff.report_errors(record(ACK, 0, LibOV.HF0_OVF) * 20, 20)
+        lines = err.getvalue().splitlines()
+        self.assertEqual(lines[-1], "PERR: 4 more in this batch")
+        self.assertEqual(len(lines), 17)
+
+
+if __name__ == "__main__":
+    unittest.main()
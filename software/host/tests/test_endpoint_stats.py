@@ -0,0 +1,123 @@
+#
+# Per-endpoint statistics: packets are counted against the endpoint of
+# their token, in 100 ms slots of capture time that roll over
+#
+
+import json
+import unittest
+
+import LibOV
+import endpoint_stats
+import outputs
+
+from tests.test_stream import record
+
+IN_3_1 = b"\x69\x83\x00"
+IN_5_2 = b"\x69\x05\x01"
+DATA = b"\xc3\x00\x01\x02\x03\xef\x7a"
+ACK = b"\xd2"
+NAK = b"\x5a"
+STALL = b"\x1e"
+SOF = b"\xa5\x00\x00"
+
+SLOT = endpoint_stats.SLOT_CLKS
+
+
+class _Feed:
+    # Hands (clks, pkt[, flags]) to EndpointStats as PacketBatches, with
+    # the clock carried on from batch to batch
+    def __init__(self, stats):
+        self.stats = stats
+        self.last_ts = 0
+        self.ts_base = 0
+
+    def __call__(self, packets):
+        records = b"".join(record(p[1], p[0] & (outputs.TS_WRAP - 1), p[2] if len(p) > 2 else 0)
+                           for p in packets)
+        batch = LibOV.PacketBatch(records, len(packets), self.last_ts, self.ts_base)
+        self.last_ts, self.ts_base = batch.last_ts, batch.ts_base
+        self.stats.handle_batch(batch)
+
+
+def window(snapshot, addr, endp, seconds):
+    for w in snapshot:
+        if (w.addr, w.endp, w.window) == (addr, endp, seconds):
+            return w
+
+
+class EndpointStatsTest(unittest.TestCase):
+    def test_slots(self):
+        stats = endpoint_stats.EndpointStats()
+        feed = _Feed(stats)
+
+        # 3 s of traffic, one batch per 100 ms slot: a bulk IN with data on
+        # 3.1, and a NAKed poll of 5.2 in every other slot. The clock wraps
+        # every 280 ms or so.
+        for s in range(30):
+            t = s * SLOT + 1000
+            packets = [(t, SOF), (t + 10, IN_3_1), (t + 20, DATA), (t + 30, ACK)]
+            if s % 2:
+                packets += [(t + 50, IN_5_2), (t + 60, NAK)]
+            feed(packets)
+
+        snap = stats.snapshot()
+        # The slot being filled is left out
+        w = window(snap, 3, 1, 1)
+        self.assertEqual((w.seconds, w.transactions, w.packets, w.bytes, w.acks, w.naks),
+                         (1.0, 10, 30, 40, 10, 0))
+        w = window(snap, 3, 1, 10)
+        self.assertEqual((w.seconds, w.transactions, w.bytes), (2.9, 29, 29 * 4))
+        w = window(snap, 5, 2, 1)
+        self.assertEqual((w.transactions, w.packets, w.naks, w.acks), (5, 10, 5, 0))
+
+        r = endpoint_stats.rates(window(snap, 5, 2, 10))
+        self.assertEqual(r["nak_ratio"], 1.0)
+        self.assertAlmostEqual(r["transactions_per_s"], 14 / 2.9)
+
+        self.assertEqual([line.split()[0] for line in endpoint_stats.format_stats(snap)],
+                         ["3.1", "5.2"])
+        self.assertEqual([e["addr"] for e in json.loads(endpoint_stats.stats_json(snap))["endpoints"]],
+                         [3, 5])
+
+    def test_rollover(self):
+        # Slots older than the ring are cleared, not counted again
+        stats = endpoint_stats.EndpointStats()
+        feed = _Feed(stats)
+        for s in range(20):
+            t = s * SLOT
+            feed([(t, IN_3_1), (t + 10, STALL)])
+
+        # A quiet 70 s (as SOFs, so that every wrap is seen), then one more
+        # transaction and the slot after it
+        t = 20 * SLOT
+        for i in range(700):
+            t += SLOT
+            feed([(t, SOF)])
+        feed([(t + 10, IN_3_1), (t + 20, ACK)])
+        feed([(t + SLOT, SOF)])
+
+        snap = stats.snapshot()
+        for seconds in endpoint_stats.WINDOWS:
+            w = window(snap, 3, 1, seconds)
+            self.assertEqual((w.transactions, w.stalls, w.acks), (1, 0, 1))
+        self.assertEqual(window(snap, 3, 1, 60).seconds, 60.0)
+
+    def test_attribution(self):
+        stats = endpoint_stats.EndpointStats(max_endpoints=1)
+        feed = _Feed(stats)
+        feed([(0, IN_3_1), (10, DATA, LibOV.HF_CRC_BAD), (20, ACK),
+              # A damaged token: what follows belongs to nobody
+              (30, IN_3_1, LibOV.HF0_ERR), (40, DATA), (50, ACK),
+              # Over the limit: counted as untracked
+              (60, IN_5_2), (70, NAK),
+              (SLOT, SOF)])
+
+        snap = stats.snapshot()
+        self.assertEqual(len(snap), len(endpoint_stats.WINDOWS))
+        w = window(snap, 3, 1, 1)
+        self.assertEqual((w.transactions, w.packets, w.errors, w.bytes, w.acks), (1, 3, 1, 4, 1))
+        self.assertEqual(stats.untracked, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#
+# FanOut: every output sees every batch in capture order, a slow output
+# does not hold up the others, and finishing waits for all of them
+#
+
+import threading
+import unittest
+
+import outputs
+
+from tests.test_stream import record
+
+
+class _RecordOutput:
+    def __init__(self, gate=None):
+        self.gate = gate
+        self.batches = []
+        self.done = []
+
+    def handle_records(self, records, count):
+        if self.gate is not None:
+            self.gate.wait()
+        self.batches.append((records, count))
+
+    def flush(self):
+        self.done.append("flush")
+
+    def finish(self):
+        self.done.append("finish")
+
+
+class _PacketOutput:
+    def __init__(self):
+        self.packets = []
+        self.done = []
+
+    def handle_usb(self, ts, pkt, flags):
+        self.packets.append((ts, bytes(pkt), flags))
+
+    def flush(self):
+        self.done.append("flush")
+
+
+def batch(i):
+    return record(bytes([0xc3, i & 0xFF]), 2 * i, 0) + record(b"\xd2", 2 * i + 1, 0x10), 2
+
+
+class FanOutTest(unittest.TestCase):
+    def test_order(self):
+        a, b, c = _RecordOutput(), _PacketOutput(), _RecordOutput()
+        fan = outputs.FanOut([a, b, c], names=["a", "b", "c"], maxsize=4)
+        batches = [batch(i) for i in range(200)]
+        for records, count in batches:
+            fan.handle_records(records, count)
+        fan.finish()
+
+        self.assertEqual(a.batches, batches)
+        self.assertEqual(c.batches, batches)
+        self.assertEqual(b.packets, [p for i in range(200) for p in
+                                     [(2 * i, bytes([0xc3, i & 0xFF]), 0), (2 * i + 1, b"\xd2", 0x10)]])
+        # finish() where the output has it, else flush()
+        self.assertEqual((a.done, b.done, c.done), (["finish"], ["flush"], ["finish"]))
+        self.assertEqual([s.name for s in fan.stats()], ["a", "b", "c"])
+
+    def test_slow_output(self):
+        # Until its queue is full, a stalled output holds up nobody
+        gate = threading.Event()
+        slow, fast = _RecordOutput(gate), _RecordOutput()
+        fan = outputs.FanOut([slow, fast], maxsize=8)
+        for i in range(8):
+            fan.handle_records(*batch(i))
+        fan.stages[1].drain()
+        self.assertEqual(len(fast.batches), 8)
+        self.assertEqual(slow.batches, [])
+
+        # Past that, the producer waits for it
+        threading.Timer(0.05, gate.set).start()
+        for i in range(8, 20):
+            fan.handle_records(*batch(i))
+        fan.flush()
+
+        self.assertEqual(slow.batches, [batch(i) for i in range(20)])
+        self.assertEqual(fast.batches, slow.batches)
+        self.assertGreater(fan.stats()[0].stalls, 0)
+        self.assertEqual(fan.stats()[1].stalls, 0)
+        self.assertEqual(slow.done, ["flush"])
+        fan.finish()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+#
+# The batched FTDI stream reader, built against a scripted libusb
+# (tests/fakeusb) so that errors and stops can be injected
+#
+
+import ctypes
+import os
+import shutil
+import subprocess
+import sysconfig
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HOST = os.path.dirname(HERE)
+
+StreamCallback = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                  ctypes.c_void_p, ctypes.c_void_p)
+
+class FTDIDevice(ctypes.Structure):
+    _fields_ = [("libusb", ctypes.c_void_p), ("handle", ctypes.c_void_p)]
+
+def counting(start, n):
+    return bytes((start + i) & 0xFF for i in range(n))
+
+PAYLOAD = 512 - 2
+
+
+def _compiler():
+    cc = (sysconfig.get_config_var("CC") or "cc").split()
+    return cc if shutil.which(cc[0]) else None
+
+
+@unittest.skipIf(os.name == "nt" or _compiler() is None, "needs a C compiler")
+class FTDIStreamTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(cls.dir.name, "libftdistream.so")
+        subprocess.check_call(_compiler() + [
+            "-shared", "-fPIC", "-std=gnu99", "-w",
+            "-I", os.path.join(HERE, "fakeusb"), "-I", HOST, "-o", path,
+            os.path.join(HOST, "fastftdi.c"), os.path.join(HERE, "fakeusb", "libusb.c")])
+        cls.lib = lib = ctypes.CDLL(path)
+
+        lib.FTDIStream_New.restype = ctypes.c_void_p
+        lib.FTDIStream_New.argtypes = [ctypes.c_void_p, ctypes.c_int, StreamCallback,
+                                       ctypes.c_void_p] + [ctypes.c_int] * 4
+        lib.FTDIStream_Run.argtypes = [ctypes.c_void_p]
+        lib.FTDIStream_Free.argtypes = [ctypes.c_void_p]
+        lib.FTDIStream_Reset.argtypes = [ctypes.c_void_p]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dir.cleanup()
+
+    def fake(self, name):
+        return ctypes.c_int.in_dll(self.lib, "fake_" + name)
+
+    def setUp(self):
+        self.fake("calls").value = 0
+        self.fake("fail_at").value = -1
+        self.fake("stop_at").value = -1
+        self.fake("cancel_length").value = 0
+        ctypes.c_ubyte.in_dll(self.lib, "fake_counter").value = 0
+
+        self.received = []
+        self.end = 0
+
+        def callback(buf, length, progress, user):
+            if buf:
+                self.received.append(ctypes.string_at(buf, length))
+                return self.end
+            return 0
+
+        self.callback = StreamCallback(callback)
+        self.dev = FTDIDevice()
+        # Two one-packet transfers; batches of up to 16 packets, 20 ms
+        self.stream = self.lib.FTDIStream_New(ctypes.byref(self.dev), 1, self.callback,
+                                              None, 1, 2, 16 * 512, 20)
+        self.assertTrue(self.stream)
+        ctypes.c_void_p.in_dll(self.lib, "fake_stream").value = self.stream
+
+    def tearDown(self):
+        self.lib.FTDIStream_Free(self.stream)
+
+    def test_batch_kept_after_error(self):
+        # Both transfers bring in a packet, then the next poll fails
+        self.fake("data_first").value = 0
+        self.fake("data_last").value = 1
+        self.fake("fail_at").value = 1
+
+        self.assertEqual(self.lib.FTDIStream_Run(self.stream), -1)
+        self.assertEqual(self.received, [])
+
+        # The next run hands the batch over once it is old enough
+        self.fake("data_last").value = 0
+        self.end = 1
+        self.assertEqual(self.lib.FTDIStream_Run(self.stream), 1)
+        self.assertEqual(self.received, [counting(0, 2 * PAYLOAD)])
+
+    def test_stop_delivers_cancelled_data(self):
+        # The transfers resubmitted after the first poll are cancelled by
+        # the stop, and come back with a packet each
+        self.fake("data_first").value = 0
+        self.fake("data_last").value = 1
+        self.fake("stop_at").value = 1
+        self.fake("cancel_length").value = 512
+
+        self.assertEqual(self.lib.FTDIStream_Run(self.stream), 0)
+        self.assertEqual(b"".join(self.received), counting(0, 4 * PAYLOAD))
+
+        # Stopped until reset
+        self.fake("data_last").value = 1000
+        self.assertEqual(self.lib.FTDIStream_Run(self.stream), 0)
+        self.assertEqual(b"".join(self.received), counting(0, 4 * PAYLOAD))
+
+    def test_stop_before_run(self):
+        self.lib.FTDIStream_Stop(ctypes.c_void_p(self.stream))
+        self.assertEqual(self.lib.FTDIStream_Run(self.stream), 0)
+        self.assertEqual(self.fake("calls").value, 0)
+
+        self.lib.FTDIStream_Reset(self.stream)
+        self.fake("data_last").value = 1
+        self.fake("stop_at").value = 2
+        self.assertEqual(self.lib.FTDIStream_Run(self.stream), 0)
+        self.assertEqual(b"".join(self.received), counting(0, 2 * PAYLOAD))
+
+
+if __name__ == "__main__":
+    unittest.main()
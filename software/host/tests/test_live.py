@@ -0,0 +1,123 @@
+#
+# LiveFlush: when output reaches the pipe, by packet count, by interval
+# while packets keep coming and once the bus goes idle, on a fake clock
+#
+
+import time
+import unittest
+from unittest import mock
+
+import outputs
+
+from tests.test_stream import record
+
+RECORDS = record(b"\xd2", 0) * 10
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class _Output:
+    def __init__(self):
+        self.count = 0
+        self.flushes = 0
+        self.finished = False
+
+    def handle_records(self, records, count):
+        self.count += count
+
+    def flush(self):
+        self.flushes += 1
+
+    def finish(self):
+        self.finished = True
+
+
+class _File:
+    def __init__(self):
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+
+class LiveFlushTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        patcher = mock.patch.object(outputs.time, "monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.output = _Output()
+        self.file = _File()
+
+    def live(self, **kw):
+        live = outputs.LiveFlush(self.output, self.file, **kw)
+        self.addCleanup(live.finish)
+        return live
+
+    def settle(self, flushes):
+        # Give the timer thread (ticking in real time) its chances, and wait
+        # for the expected number of flushes
+        deadline = time.perf_counter() + 2
+        while self.file.flushes != flushes and time.perf_counter() < deadline:
+            time.sleep(0.005)
+        time.sleep(0.03)
+        self.assertEqual(self.file.flushes, flushes)
+
+    def test_packets(self):
+        live = self.live(packets=25)
+        # The header goes out straight away
+        self.assertEqual((self.output.flushes, self.file.flushes), (1, 1))
+
+        live.handle_records(RECORDS, 10)
+        live.handle_records(RECORDS, 10)
+        self.assertEqual(self.file.flushes, 1)
+        live.handle_records(RECORDS, 10)
+        self.assertEqual((self.output.flushes, self.file.flushes), (2, 2))
+        self.assertEqual(self.output.count, 30)
+
+        live.finish()
+        self.assertTrue(self.output.finished)
+        self.assertEqual(self.file.flushes, 3)
+
+    def test_idle(self):
+        live = self.live(idle=0.01)
+        live.handle_records(RECORDS, 10)
+        # Time stands still: no flush however long the timer runs
+        self.settle(1)
+
+        self.clock.now += 0.005
+        self.settle(1)
+        self.clock.now += 0.006
+        self.settle(2)
+
+        # Nothing new: no more flushes
+        self.clock.now += 1
+        self.settle(2)
+
+    def test_interval(self):
+        live = self.live(interval=0.04, idle=0.01)
+        # Packets every 5 ms, so the bus never goes idle: flushed once 40 ms
+        # have passed since the last flush
+        for i in range(7):
+            self.clock.now += 0.005
+            live.handle_records(RECORDS, 10)
+            self.settle(1)
+        self.clock.now += 0.0055
+        live.handle_records(RECORDS, 10)
+        self.settle(2)
+
+        # Then quiet: the idle limit flushes what came since
+        live.handle_records(RECORDS, 10)
+        self.clock.now += 0.011
+        self.settle(3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,253 @@
+#
+# Capture files: what is written as raw, pcap or pcapng must read back as
+# the same packets at the same times
+#
+
+import contextlib
+import io
+import os
+import struct
+import tempfile
+import unittest
+
+import outputs
+import parallel_decode
+
+from tests.test_stream import record
+
+UTC_START = 1700000000
+
+# SOF, IN token, DATA0 with a good CRC, ACK
+PACKETS = [b"\xa5\x34\x12", b"\x69\x81\x58", b"\xc3\x00\x01\x02\x03\xef\x7a", b"\xd2"]
+
+def session(count, step=60000):
+    """'count' records 'step' clocks apart, and their (clks, payload)."""
+    records = bytearray()
+    packets = []
+    for i in range(count):
+        clks = i * step
+        pkt = PACKETS[i % len(PACKETS)]
+        flags = 0x10 if i == 0 else 0x20 if i == count - 1 else 0
+        records += record(pkt, clks & (outputs.TS_WRAP - 1), flags)
+        packets.append((clks, pkt))
+    return bytes(records), packets
+
+def pcap_packets(data):
+    """(clks, payload) of every record in pcap file contents 'data'."""
+    magic, = struct.unpack_from("=I", data)
+    assert magic == 0xa1b23c4d
+    utc_start = struct.unpack_from("=I", data, 24)[0]
+
+    packets = []
+    pos = 24
+    while pos < len(data):
+        sec, ns, incl, orig = struct.unpack_from("=IIII", data, pos)
+        clks = (sec - utc_start) * outputs.CLOCK_HZ + (ns * 3 + 25) // 50
+        packets.append((clks, data[pos + 16:pos + 16 + incl]))
+        pos += 16 + incl
+    return packets
+
+def pcapng_packets(data):
+    """(ns, payload, comments) of every Enhanced Packet Block in pcapng
+    file contents 'data'."""
+    packets = []
+    pos = 0
+    while pos < len(data):
+        block_type, length = struct.unpack_from("=II", data, pos)
+        assert struct.unpack_from("=I", data, pos + length - 4)[0] == length
+        if block_type == outputs.OutputPcapng.BT_EPB:
+            iface, hi, lo, incl, orig = struct.unpack_from("=IIIII", data, pos + 8)
+            body = pos + 28
+            pkt = data[body:body + incl]
+
+            comments = []
+            opt = body + incl + (-incl % 4)
+            while opt < pos + length - 4:
+                code, n = struct.unpack_from("=HH", data, opt)
+                if code == 0:
+                    break
+                if code == outputs.OutputPcapng.OPT_COMMENT:
+                    comments.append(data[opt + 4:opt + 4 + n])
+                opt += 4 + n + (-n % 4)
+
+            packets.append((hi << 32 | lo, pkt, comments))
+        pos += length
+    return packets
+
+
+class CaptureFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def decode(self, cap, format, **kw):
+        out = io.BytesIO()
+        parallel_decode.decode_file(cap, format, out, "hs", 1, **kw)
+        return out.getvalue()
+
+    def test_raw(self):
+        records, packets = session(300)
+        with open(self.path("c.ov"), "wb") as f:
+            raw = outputs.OutputRaw(f, "hs", utc_start_ns=UTC_START * 1000000000)
+            raw.handle_records(records, len(packets))
+            raw.flush()
+
+        cap = parallel_decode.open_capture(self.path("c.ov"))
+        self.assertEqual((cap.kind, cap.speed, cap.utc_start), ("raw", "hs", UTC_START))
+        with open(cap.path, "rb") as f:
+            self.assertEqual(f.read()[cap.data_offset:], records)
+
+        # Decoded in several chunks, the times still count the wraps
+        self.assertEqual(pcap_packets(self.decode(cap, "pcap", chunk_size=512)), packets)
+
+    def test_damaged_raw(self):
+        # Junk between records, and a record that lost its header, are
+        # skipped
+        records, packets = session(300)
+        junk = sum(len(p) + 8 for c, p in packets[:100])
+        cut = sum(len(p) + 8 for c, p in packets[:200])
+        damaged = records[:junk] + b"\x00\x11\xa0\x33\x44" + records[junk:cut] + records[cut + 4:]
+        with open(self.path("c.ov"), "wb") as f:
+            # The header only
+            outputs.OutputRaw(f, "hs", utc_start_ns=UTC_START * 1000000000)
+            f.write(damaged)
+
+        cap = parallel_decode.open_capture(self.path("c.ov"))
+        with open(cap.path, "rb") as f:
+            buf = f.read()
+        scanner = parallel_decode.record_scan
+        try:
+            for parallel_decode.record_scan in (scanner, None):
+                with contextlib.redirect_stderr(io.StringIO()):
+                    stop, count, gaps = parallel_decode._walk(cap, buf, cap.data_offset, len(buf))
+                self.assertEqual((stop, count), (len(buf), 299))
+                self.assertEqual([(pos - cap.data_offset, n) for pos, n in gaps],
+                                 [(junk, 5), (cut + 5, len(packets[200][1]) + 4)])
+        finally:
+            parallel_decode.record_scan = scanner
+
+        expect = packets[:200] + packets[201:]
+        for chunk_size in (32 << 20, 512):
+            self.assertEqual(pcap_packets(self.decode(cap, "pcap", chunk_size=chunk_size)), expect)
+
+    def test_pcap(self):
+        # Gaps of several wraps, which the 24-bit timestamps cannot show
+        packets = [(0, PACKETS[0]), (1000, PACKETS[1]), (1000 + 3 * outputs.CLOCK_HZ, PACKETS[2]),
+                   (1000 + 3 * outputs.CLOCK_HZ + 2 * outputs.TS_WRAP + 5, PACKETS[3])]
+        packets += [(packets[-1][0] + i * 60000, PACKETS[i % 4]) for i in range(1, 200)]
+
+        with open(self.path("c.pcap"), "wb") as f:
+            pcap = outputs.OutputPcap(f, UTC_START)
+            for clks, pkt in packets:
+                pcap.handle_packet(clks, pkt)
+            pcap.flush()
+        with open(self.path("c.pcap"), "rb") as f:
+            data = f.read()
+        self.assertEqual(pcap_packets(data), packets)
+
+        cap = parallel_decode.open_capture(self.path("c.pcap"))
+        self.assertEqual((cap.kind, cap.utc_start), ("pcap", UTC_START))
+        for chunk_size in (32 << 20, 100):
+            self.assertEqual(self.decode(cap, "pcap", chunk_size=chunk_size), data)
+
+    def test_pcapng(self):
+        records, packets = session(300)
+        records = bytearray(records)
+        records[9 * 8 + sum(len(p) for c, p in packets[:9]) + 1] |= 0x01
+
+        out = io.BytesIO()
+        pcapng = outputs.OutputPcapng(out, UTC_START)
+        pcapng.handle_records(bytes(records), len(packets))
+        pcapng.finish()
+
+        got = pcapng_packets(out.getvalue())
+        self.assertEqual([(ns, pkt) for ns, pkt, comments in got],
+                         [(UTC_START * 1000000000 + clks * 50 // 3, pkt) for clks, pkt in packets])
+        self.assertEqual(got[0][2], [b"ov_flags=0x0010 First"])
+        self.assertEqual(got[9][2], [b"ov_flags=0x0001 Error"])
+        self.assertEqual(got[1][2], [])
+
+
+class ITI1480ATest(unittest.TestCase):
+    def test_records_match_packets(self):
+        # Data packets across timestamp wraps, then a quiet stretch of SOFs
+        # longer than one time record holds, then data again
+        records = bytearray()
+        clks = 0
+        steps = [(1000, PACKETS[1]), (50, PACKETS[2]), (8000000, PACKETS[3]),
+                 (9000000, PACKETS[1]), (40, PACKETS[2])]
+        steps += [(8000000, PACKETS[0])] * 80
+        steps += [(3000, PACKETS[1]), (0, b""), (45, PACKETS[2]), (60, PACKETS[3])]
+        for delta, pkt in steps:
+            clks += delta
+            records += record(pkt, clks & (outputs.TS_WRAP - 1))
+        self.assertGreater(clks, 2 * outputs.OutputITI1480A.MAX_DELTA)
+        count = len(steps)
+
+        expect = io.BytesIO()
+        iti = outputs.OutputITI1480A(expect, "hs")
+        pos = 0
+        for i in range(count):
+            size = (records[pos + 4] << 8 | records[pos + 3]) + 8
+            ts = records[pos + 5] | records[pos + 6] << 8 | records[pos + 7] << 16
+            iti.handle_usb(ts, bytes(records[pos + 8:pos + size]), 0)
+            pos += size
+
+        # In one go, and split in the middle of the quiet stretch
+        split = sum(len(p) + 8 for d, p in steps[:20])
+        for parts in ([(bytes(records), count)],
+                      [(bytes(records[:split]), 20), (bytes(records[split:]), count - 20)]):
+            out = io.BytesIO()
+            iti = outputs.OutputITI1480A(out, "hs")
+            for part in parts:
+                iti.handle_records(*part)
+            self.assertEqual(out.getvalue(), expect.getvalue())
+
+
+class CustomTemplateTest(unittest.TestCase):
+    def render(self, template, clks=90000000, pkt=PACKETS[1]):
+        return outputs.compile_template(template, "hs")(clks, clks & (outputs.TS_WRAP - 1), 0, pkt)
+
+    def test_styles(self):
+        self.assertEqual(self.render(outputs.DEFAULT_TEMPLATE),
+                         "data=69 81 58 speed=HS time=1.500000\n")
+        # Old style: three % fields, and no str.format ones
+        self.assertEqual(self.render("%s|%s|%.1f\n"),
+                         "69 81 58|HS|1.5\n")
+        # A % in a new style template, and a template with no fields at all
+        self.assertEqual(self.render("{len} 100%\n"), "3 100%\n")
+        self.assertEqual(self.render("{{SOF}}\n"), "{SOF}\n")
+        # Fields nested in format specs
+        self.assertEqual(self.render("{pidname:>{len}}|{addr}.{endp}|{data!r:.{len}}"),
+                         " IN|1.1|'69")
+
+    def test_errors(self):
+        # Caught when compiled, not on every packet
+        for template in ["{data:{width}}\n", "{nope}\n", "{data\n", "{time:q}\n",
+                         "%s %s\n", "%d %s %f\n"]:
+            with self.subTest(template=template):
+                with self.assertRaises(ValueError):
+                    outputs.compile_template(template, "hs")
+
+    def test_load(self):
+        # A template is the first line of its file, named or the default one
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "template_custom.txt")
+            with open(path, "w") as f:
+                f.write("{pidname} {data}\nnot part of it\n")
+            self.assertEqual(outputs.load_template(path), "{pidname} {data}\n")
+
+            self.addCleanup(os.chdir, os.getcwd())
+            os.chdir(d)
+            self.assertEqual(outputs.load_template(), "{pidname} {data}\n")
+            os.remove(path)
+            self.assertEqual(outputs.load_template(), outputs.DEFAULT_TEMPLATE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+#
+# PacketBatch: the packets of a batch of records as parallel arrays, with
+# the timestamp wraps undone across batches
+#
+
+import unittest
+
+import LibOV
+import outputs
+
+from tests.test_stream import record
+
+PACKETS = [b"\xa5\x34\x12", b"\x69\x81\x58", b"", b"\xc3\x00\x01\x02\x03\xef\x7a", b"\xd2"]
+
+
+class PacketBatchTest(unittest.TestCase):
+    def test_batch(self):
+        clks = [10, 2000, outputs.TS_WRAP - 5, outputs.TS_WRAP + 3, 3 * outputs.TS_WRAP // 2]
+        records = b"".join(record(pkt, c & (outputs.TS_WRAP - 1), i)
+                           for i, (pkt, c) in enumerate(zip(PACKETS, clks)))
+
+        batch = LibOV.PacketBatch(records, len(PACKETS))
+        self.assertEqual(len(batch), 5)
+        self.assertEqual(list(batch.ts), clks)
+        self.assertEqual(list(batch.flags), [0, 1, 2, 3, 4])
+        self.assertEqual(list(batch.lengths), [len(p) for p in PACKETS])
+        self.assertEqual([p.data for p in batch], PACKETS)
+        self.assertEqual((batch.last_ts, batch.ts_base),
+                         (clks[-1] & (outputs.TS_WRAP - 1), outputs.TS_WRAP))
+
+        # Payloads are views of the records, not copies
+        self.assertIs(batch.payload(3).obj, records)
+
+        pkt = batch[-2]
+        self.assertEqual((pkt.ts, pkt.flags, len(pkt), bytes(pkt.payload)),
+                         (clks[3], 3, 7, PACKETS[3]))
+        self.assertEqual(repr(batch[1]), "<Packet ts=2000 flags=0001 len=3>")
+        with self.assertRaises(IndexError):
+            batch[5]
+        with self.assertRaises(IndexError):
+            batch[-6]
+
+    def test_continued(self):
+        # The next batch carries on from where the one before left off
+        first = LibOV.PacketBatch(record(PACKETS[1], outputs.TS_WRAP - 10), 1, 500, 0)
+        self.assertEqual(list(first.ts), [outputs.TS_WRAP - 10])
+
+        second = LibOV.PacketBatch(record(PACKETS[4], 20), 1, first.last_ts, first.ts_base)
+        self.assertEqual(list(second.ts), [outputs.TS_WRAP + 20])
+
+        empty = LibOV.PacketBatch(b"", 0, second.last_ts, second.ts_base)
+        self.assertEqual((len(empty), list(empty)), (0, []))
+        self.assertEqual((empty.last_ts, empty.ts_base), (second.last_ts, second.ts_base))
+
+    def test_from_sniff(self):
+        # RXCSniff hands its batch handlers one PacketBatch per batch, with
+        # the clock carried over between them
+        sniff = LibOV.RXCSniff().service
+        sniff.handlers = []
+        batches = []
+        sniff.batch_handlers.append(batches.append)
+
+        sniff.deliver((record(PACKETS[1], outputs.TS_WRAP - 1, 0x10), 1))
+        sniff.deliver((record(PACKETS[4], 1), 1))
+        self.assertEqual([list(b.ts) for b in batches], [[outputs.TS_WRAP - 1], [outputs.TS_WRAP + 1]])
+
+
+class IterRecordsTest(unittest.TestCase):
+    def test_iter_records(self):
+        records = b"".join(record(pkt, 0xABCDEF - i, 0x8000 | i) for i, pkt in enumerate(PACKETS))
+        # Only 'count' records are walked, from any buffer
+        for buf in (records, bytearray(records), memoryview(records)):
+            got = list(LibOV.iter_records(buf, 4))
+            self.assertEqual(got, [(0, 0x8000, 3, 0xABCDEF), (11, 0x8001, 3, 0xABCDEE),
+                                   (22, 0x8002, 0, 0xABCDED), (30, 0x8003, 7, 0xABCDEC)])
+        self.assertEqual(list(LibOV.iter_records(records, 1, 30)), [(30, 0x8003, 7, 0xABCDEC)])
+        self.assertEqual(list(LibOV.iter_records(records, 0)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
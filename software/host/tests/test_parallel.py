@@ -0,0 +1,79 @@
+#
+# Decoding on a pool of workers must come out the same as decoding the
+# whole capture in one go
+#
+
+import io
+import unittest
+from unittest import mock
+
+import outputs
+import parallel_decode
+
+from tests.test_stream import record
+
+UTC_START = 1700000000
+
+def sof(frame):
+    return bytes([0xa5, frame & 0xFF, frame >> 8 & 0x7])
+
+def bus(frames, per_frame=6):
+    """High speed microframes: a SOF every 7500 clocks, with IN/DATA/ACK
+    polls between them; past several timestamp wraps. Returns the
+    records of each microframe."""
+    batches = []
+    clks = 0
+    for i in range(frames * 8):
+        records = bytearray(record(sof(i // 8), clks & (outputs.TS_WRAP - 1),
+                                   0x10 if i == 0 else 0))
+        for j in range(per_frame):
+            t = clks + 500 + j * 1000
+            for k, pkt in enumerate((b"\x69\x81\x58", b"\xc3\x00\x01\x02\x03\xef\x7a",
+                                     b"\xd2")):
+                records += record(pkt, (t + k * 40) & (outputs.TS_WRAP - 1))
+        batches.append((bytes(records), per_frame * 3 + 1))
+        clks += 7500
+    return batches
+
+
+class ParallelDecoderTest(unittest.TestCase):
+    def decode(self, format, batches, **kwargs):
+        out = io.BytesIO()
+        with mock.patch("parallel_decode.time.time", return_value=UTC_START):
+            decoder = parallel_decode.ParallelDecoder(format, out, "hs", 2,
+                    latency=60, **kwargs)
+        for records, count in batches:
+            decoder.handle_records(records, count)
+        decoder.close()
+        return out.getvalue()
+
+    def expected(self, format, batches):
+        header = io.BytesIO()
+        outputs.make_output(format, header, "hs", UTC_START)
+        records = b"".join(r for r, n in batches)
+        count = sum(n for r, n in batches)
+        return header.getvalue() + parallel_decode.decode_records(records, count,
+                format, "hs", UTC_START, outputs.INITIAL_STATE,
+                outputs.DEFAULT_TEMPLATE)
+
+    def test_formats(self):
+        # Chunks of a few microframes, some SOF tracking long enough to
+        # be summarised and some not
+        batches = bus(80)
+        # (Transfers are regrouped at chunk boundaries, so that format is not
+        # the same)
+        for format in ("verbose", "custom", "pcap", "pcapng", "iti1480a"):
+            with self.subTest(format=format):
+                self.assertEqual(self.decode(format, batches, chunk_size=20000,
+                                             template=outputs.DEFAULT_TEMPLATE),
+                                 self.expected(format, batches))
+
+    def test_ring_reuse(self):
+        # Far more data than the ring holds
+        batches = bus(40)
+        self.assertEqual(self.decode("pcap", batches, chunk_size=4096, ring_size=16384),
+                         self.expected("pcap", batches))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+#
+# Pipeline stages: items are handled in order on the stage's thread, a
+# full queue pushes back on the producer, and a failed stage never blocks it
+#
+
+import contextlib
+import io
+import threading
+import unittest
+
+import LibOV
+
+
+class StageQueueTest(unittest.TestCase):
+    def test_stats(self):
+        q = LibOV.StageQueue("q", 2)
+        q.put(1)
+        q.put(2)
+        self.assertEqual(q.depth(), 2)
+
+        # The third put has to wait for a get
+        t = threading.Timer(0.05, q.get)
+        t.start()
+        q.put(3)
+        t.join()
+
+        stats = q.stats()
+        self.assertEqual((stats.name, stats.maxsize, stats.max_depth, stats.puts, stats.stalls),
+                         ("q", 2, 2, 3, 1))
+        self.assertGreater(stats.stall_time, 0.01)
+        self.assertEqual([q.get(), q.get()], [2, 3])
+
+
+class StageTest(unittest.TestCase):
+    def test_order_and_drain(self):
+        seen = []
+        stage = LibOV.Stage("s", seen.append, 4)
+        stage.start()
+        for i in range(100):
+            stage.queue.put(i)
+        stage.drain()
+        self.assertEqual(seen, list(range(100)))
+        stage.stop()
+
+        self.assertEqual(stage.queue.stats().puts, 101)
+        self.assertLessEqual(stage.queue.stats().max_depth, 4)
+        self.assertIsNone(stage.exc)
+
+    def test_backpressure(self):
+        release = threading.Event()
+        seen = []
+
+        def handler(item):
+            release.wait()
+            seen.append(item)
+
+        stage = LibOV.Stage("s", handler, 2)
+        stage.start()
+        threading.Timer(0.05, release.set).start()
+        for i in range(5):
+            stage.queue.put(i)
+        stage.stop()
+
+        self.assertEqual(seen, list(range(5)))
+        self.assertGreaterEqual(stage.queue.stats().stalls, 1)
+
+    def test_failure(self):
+        def handler(item):
+            if item == 3:
+                raise ValueError(item)
+            seen.append(item)
+
+        seen = []
+        stage = LibOV.Stage("s", handler, 1)
+        stage.start()
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            # Far more than the queue holds: the rest are discarded
+            for i in range(50):
+                stage.queue.put(i)
+            stage.stop()
+
+        self.assertEqual(seen, [0, 1, 2])
+        self.assertIsInstance(stage.exc, ValueError)
+        self.assertIn("Pipeline stage s failed", err.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+#
+# The vectorized record scanner must find the same records, fields and
+# clock counts as walking the records one by one
+#
+
+import unittest
+
+import outputs
+
+from tests.test_stream import capture, record
+
+try:
+    import numpy as np
+    import record_scan
+except ImportError:
+    record_scan = None
+
+def walk(records):
+    """(offset, length, flags, ts) of each record, one by one."""
+    out = []
+    pos = 0
+    while pos + 8 <= len(records) and records[pos] == 0xA0:
+        length = records[pos + 3] | records[pos + 4] << 8
+        if pos + 8 + length > len(records):
+            break
+        out.append((pos, length, records[pos + 1] | records[pos + 2] << 8,
+                    records[pos + 5] | records[pos + 6] << 8 | records[pos + 7] << 16))
+        pos += 8 + length
+    return out, pos
+
+
+@unittest.skipIf(record_scan is None, "needs NumPy")
+class RecordScanTest(unittest.TestCase):
+    def check(self, scan, expect, used, base=0):
+        self.assertEqual(list(zip(scan.offset.tolist(), scan.length.tolist(),
+                                  scan.flags.tolist(), scan.ts.tolist())),
+                         [(pos + base, n, f, ts) for pos, n, f, ts in expect])
+        self.assertEqual(scan.used, used)
+
+    def test_fields(self):
+        inner, records = capture(3000)
+        expect, used = walk(records)
+        # Small steps, so the scan is done in several calls
+        self.check(record_scan.scan_records(records, step=64), expect, used)
+        self.check(record_scan.scan_records(bytearray(records)), expect, used)
+
+    def test_limits(self):
+        inner, records = capture(500)
+        expect, used = walk(records)
+        start = expect[10][0]
+        end = expect[400][0]
+
+        scan = record_scan.scan_records(records, start, end)
+        self.check(scan, expect[10:400], end - start)
+
+        scan = record_scan.scan_records(records, start, max_records=7, step=3)
+        self.check(scan, expect[10:17], expect[17][0] - start)
+
+    def test_stops_at_damage(self):
+        good = record(b"\x69\x81\x58", 1) + record(b"\xd2", 2)
+        for tail in (b"\x00" + record(b"\xd2", 3), record(b"\xd2\x00", 3)[:-1]):
+            scan = record_scan.scan_records(good + tail)
+            self.assertEqual(scan.offset.tolist(), [0, 11])
+            self.assertEqual(scan.used, len(good))
+
+        scan = record_scan.scan_records(b"")
+        self.assertEqual((len(scan.offset), scan.used), (0, 0))
+
+    def test_unwrap(self):
+        clks = [0, 5, outputs.TS_WRAP - 1, outputs.TS_WRAP + 2, 2 * outputs.TS_WRAP,
+                2 * outputs.TS_WRAP + 7, 5 * outputs.TS_WRAP // 2]
+        ts = np.array([c & (outputs.TS_WRAP - 1) for c in clks], dtype=np.uint32)
+        self.assertEqual(record_scan.unwrap_ts(ts).tolist(), clks)
+
+        # Continuing a stream: the first timestamp is below the last one seen
+        base = 7 * outputs.TS_WRAP
+        self.assertEqual(record_scan.unwrap_ts(ts[1:], 100, base).tolist(),
+                         [base + outputs.TS_WRAP + c for c in clks[1:]])
+
+        clock = outputs.StreamClock(100, base)
+        self.assertEqual([clock(int(t)) for t in ts[1:]],
+                         record_scan.unwrap_ts(ts[1:], 100, base).tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
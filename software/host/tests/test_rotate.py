@@ -0,0 +1,134 @@
+#
+# Rotating capture files: rollover by size and by time, pruning of old
+# files, and timestamps that carry on from one file to the next
+#
+
+import glob
+import io
+import os
+import struct
+import tempfile
+import time
+import unittest
+
+import outputs
+
+from tests.test_outputs import UTC_START, session
+
+def batches(records, count, n):
+    """Split 'count' records into batches of 'n' records."""
+    pos = 0
+    for i in range(0, count, n):
+        k = min(n, count - i)
+        start = pos
+        for j in range(k):
+            pos += (records[pos + 4] << 8 | records[pos + 3]) + 8
+        yield records[start:pos], k
+
+def pcap_times(data):
+    """(absolute ns, payload) of every record in pcap file contents 'data'."""
+    packets = []
+    pos = 24
+    while pos < len(data):
+        sec, ns, incl, orig = struct.unpack_from("=IIII", data, pos)
+        packets.append((sec * 1000000000 + ns, data[pos + 16:pos + 16 + incl]))
+        pos += 16 + incl
+    return packets
+
+
+class RotatingOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def files(self, pattern="cap-*"):
+        return sorted(glob.glob(os.path.join(self.dir.name, pattern)))
+
+    def rotating(self, name, format, **kw):
+        out = outputs.RotatingOutput(os.path.join(self.dir.name, name), format, "hs", **kw)
+        out.utc_start_ns = UTC_START * 1000000000
+        return out
+
+    def test_size(self):
+        # Step of a quarter wrap: the wraps go on across the files
+        records, packets = session(400, outputs.TS_WRAP // 4)
+        out = self.rotating("cap.ov", "raw", max_bytes=1000)
+        for batch in batches(records, len(packets), 25):
+            out.handle_records(*batch)
+        out.finish()
+
+        files = self.files()
+        self.assertEqual([os.path.basename(f) for f in files[:2]], ["cap-00001.ov", "cap-00002.ov"])
+        self.assertGreater(len(files), 3)
+
+        data = b""
+        clks = []
+        for path in files:
+            with open(path, "rb") as f:
+                contents = f.read()
+            hdr = outputs.read_raw_header(contents)
+            body = contents[hdr.size:]
+            # Rolled over at the first batch past the limit
+            self.assertLess(len(body), 1000 + 25 * 16)
+            self.assertEqual(hdr.utc_start_ns, UTC_START * 1000000000)
+
+            # Each file's base gives the absolute time of its first record
+            clks.append(hdr.ts_base + (body[5] | body[6] << 8 | body[7] << 16))
+            data += body
+
+        self.assertEqual(data, records)
+        starts = [c for c, p in packets[::25]]
+        self.assertEqual(clks[0], 0)
+        self.assertTrue(all(c in starts for c in clks))
+        self.assertEqual(clks, sorted(set(clks)))
+
+    def test_time(self):
+        records, packets = session(60)
+        out = self.rotating("cap.pcap", "pcap", max_seconds=0.2)
+        parts = list(batches(records, len(packets), 20))
+
+        out.handle_records(*parts[0])
+        out.handle_records(*parts[1])
+        out.flush()
+        time.sleep(0.3)
+        out.handle_records(*parts[2])
+        out.finish()
+
+        files = self.files()
+        self.assertEqual(os.path.basename(files[0]), "cap-00001.pcap")
+        self.assertEqual(len(files), 2)
+
+        expect = io.BytesIO()
+        pcap = outputs.OutputPcap(expect, UTC_START)
+        pcap.handle_records(records, len(packets))
+        pcap.flush()
+
+        got = []
+        for path in files:
+            with open(path, "rb") as f:
+                got.append(pcap_times(f.read()))
+        self.assertEqual([len(g) for g in got], [40, 20])
+        self.assertEqual(got[0] + got[1], pcap_times(expect.getvalue()))
+
+    def test_keep(self):
+        records, packets = session(300)
+        out = self.rotating("cap.ov", "raw", max_bytes=500, keep=2)
+        for batch in batches(records, len(packets), 10):
+            out.handle_records(*batch)
+        out.finish()
+
+        files = self.files()
+        self.assertEqual(len(files), 2)
+        self.assertEqual([os.path.basename(f) for f in files],
+                         ["cap-%05d.ov" % n for n in (out.seq - 1, out.seq)])
+        self.assertGreater(out.seq, 2)
+
+    def test_formats(self):
+        with self.assertRaises(ValueError):
+            outputs.RotatingOutput(os.path.join(self.dir.name, "cap.txt"), "verbose", "hs")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+#
+# Framing of the device stream: the Python demultiplexer and the native
+# parser must deliver the same capture records from the same bytes
+#
+
+import contextlib
+import io
+import random
+import struct
+import unittest
+
+import LibOV
+
+def record(payload, ts, flags=0):
+    return struct.pack("<BHHBH", 0xA0, flags, len(payload), ts & 0xFF, ts >> 8 & 0xFFFF) + payload
+
+def capture(count, seed=1):
+    """A session of 'count' records (plus status frames) as the SDRAM inner
+    stream, and the records alone."""
+    rng = random.Random(seed)
+    inner = bytearray()
+    records = bytearray()
+    for i in range(count):
+        length = rng.choice([0, 1, 3, 3, 5, 66, 515])
+        flags = 0x10 if i == 0 else 0x20 if i == count - 1 else 0
+        r = record(bytes(rng.randrange(256) for _ in range(length)), i * 1000, flags)
+        inner += r
+        records += r
+        if rng.random() < 0.05:
+            inner += b"\xac\x01"
+    if len(inner) % 2:
+        # Ends the session with an odd-sized record, padded by a stray byte
+        inner += b"\x00"
+    return bytes(inner), bytes(records)
+
+def sdram_bursts(inner, burst=512):
+    out = bytearray()
+    for pos in range(0, len(inner), burst):
+        chunk = inner[pos:pos + burst]
+        out += bytes([0xD0, len(chunk) // 2 - 1]) + chunk
+    return bytes(out)
+
+def io_reply(addr, value):
+    msg = bytes([0x55, addr >> 8, addr & 0xFF, value])
+    return msg + bytes([sum(msg) & 0xFF])
+
+def chunks(data, seed=2):
+    rng = random.Random(seed)
+    pos = 0
+    while pos < len(data):
+        n = rng.choice([1, 2, 7, 64, 510, 4096])
+        yield data[pos:pos + n]
+        pos += n
+
+
+class _Collect:
+    def __init__(self):
+        self.items = []
+
+    def put(self, item):
+        self.items.append(item)
+
+
+def python_records(stream):
+    sniff = LibOV.RXCSniff().service
+    sniff.sink = _Collect()
+    sdram = LibOV.SDRAMRead(False, [sniff]).service
+    table = LibOV.ServiceTable([sdram, LibOV.IO().service])
+    ring = LibOV._RxRing()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for chunk in chunks(stream):
+            LibOV._demux(ring, table, chunk)
+            sniff.flush()
+
+    items = sniff.sink.items
+    return b"".join(bytes(r) for r, n in items), sum(n for r, n in items)
+
+def native_records(stream):
+    batches = []
+    frames = []
+    parser = LibOV.StreamParser(lambda buf, count: batches.append((buf, count)),
+                                frames.append, batch_count=64, batch_size=8192)
+    for chunk in chunks(stream):
+        assert parser.feed(chunk) == 0
+    parser.flush()
+
+    return (b"".join(r for r, n in batches), sum(n for r, n in batches),
+            frames, parser.stats())
+
+
+class StreamFramingTest(unittest.TestCase):
+    def test_records(self):
+        inner, records = capture(2000)
+        stream = sdram_bursts(inner) + io_reply(0x1234, 0x56)
+
+        py, py_count = python_records(stream)
+        native, native_count, frames, stats = native_records(stream)
+
+        self.assertEqual(py, records)
+        self.assertEqual(py_count, 2000)
+        self.assertEqual(native, records)
+        self.assertEqual(native_count, 2000)
+        self.assertEqual(frames, [io_reply(0x1234, 0x56)])
+
+    def test_resync_after_junk(self):
+        # A stray byte ahead of a record leaves its header at an odd offset
+        good = record(b"\x69\x81\x58", 100, 0x10) + record(b"\xd2", 200)
+        inner = b"\x42" + good + b"\x00"
+        stream = sdram_bursts(inner)
+
+        py, py_count = python_records(stream)
+        native, native_count, frames, stats = native_records(stream)
+
+        self.assertEqual(py, good)
+        self.assertEqual(native, good)
+        self.assertEqual(stats.discarded, 2)
+
+    def test_gating(self):
+        # Records outside a FIRST..LAST session are dropped by both
+        before = record(b"\xa5\x00\x00", 1)
+        session = record(b"\xa5\x01\x00", 2, 0x10) + record(b"\xa5\x02\x00", 3, 0x20)
+        after = record(b"\xa5\x03\x00", 4)
+        stream = sdram_bursts(before + session + after)
+
+        self.assertEqual(python_records(stream)[0], session)
+        self.assertEqual(native_records(stream)[0], session)
+
+
+if __name__ == "__main__":
+    unittest.main()
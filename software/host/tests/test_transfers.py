@@ -0,0 +1,100 @@
+#
+# Transaction and transfer reassembly
+#
+
+import unittest
+
+from usb_transfers import TransferTracker, PID_OUT, PID_IN, PID_SETUP, PID_ACK, PID_NAK
+
+def pid(p):
+    return bytes([p | (p ^ 0xF) << 4])
+
+def token(p, addr, endp):
+    # CRC5 is not looked at by the tracker
+    return pid(p) + bytes([addr | (endp & 1) << 7, endp >> 1])
+
+def data(toggle, payload):
+    return pid(0xB if toggle else 0x3) + bytes(payload) + b"\x00\x00"
+
+# Configuration descriptor with one interface and a bulk IN endpoint 1
+# of 64 bytes
+CONFIG = (bytes([9, 2, 25, 0, 1, 1, 0, 0x80, 50]) +
+          bytes([9, 4, 0, 0, 1, 0xFF, 0, 0, 0]) +
+          bytes([7, 5, 0x81, 0x02, 64, 0, 0]))
+
+
+class TransferTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.transfers = []
+        self.transactions = []
+        self.tracker = TransferTracker(self.transfers.append, "hs",
+                                       self.transactions.append)
+        self.clks = 0
+
+    def send(self, *packets):
+        for pkt in packets:
+            self.clks += 100
+            self.tracker.packet(self.clks, pkt)
+
+    def control(self, addr, setup, data_in=None):
+        self.send(token(PID_SETUP, addr, 0), data(0, setup), pid(PID_ACK))
+        if data_in is not None:
+            self.send(token(PID_IN, addr, 0), pid(PID_NAK))
+            self.send(token(PID_IN, addr, 0), data(1, data_in), pid(PID_ACK))
+            self.send(token(PID_OUT, addr, 0), data(1, b""), pid(PID_ACK))
+        else:
+            self.send(token(PID_IN, addr, 0), data(1, b""), pid(PID_ACK))
+
+    def test_control(self):
+        self.control(5, b"\x80\x06\x00\x02\x00\x00\x19\x00", CONFIG)
+        self.control(5, b"\x00\x09\x01\x00\x00\x00\x00\x00")
+        # Device-to-host request type, but nothing to transfer
+        self.control(5, b"\x80\x00\x00\x00\x00\x00\x00\x00")
+
+        get, set_config, empty = self.transfers
+        self.assertEqual((get.kind, get.addr, get.endp, get.direction, get.status),
+                         ("control", 5, 0, "IN", "ok"))
+        self.assertEqual((get.data, get.length, get.transactions, get.naks),
+                         (CONFIG, 25, 3, 1))
+        self.assertEqual(get.setup, b"\x80\x06\x00\x02\x00\x00\x19\x00")
+
+        self.assertEqual((set_config.direction, set_config.data, set_config.status,
+                          set_config.transactions), ("OUT", b"", "ok", 2))
+        self.assertEqual((empty.direction, empty.status), ("OUT", "ok"))
+
+        self.assertEqual([t.token for t in self.transactions[:5]],
+                         ["SETUP", "IN", "IN", "OUT", "SETUP"])
+        self.assertEqual(self.transactions[1].handshake, "NAK")
+
+    def test_bulk(self):
+        # The endpoint's packet size comes from the configuration descriptor
+        self.control(5, b"\x80\x06\x00\x02\x00\x00\x19\x00", CONFIG)
+        del self.transfers[:]
+
+        first = bytes(range(64))
+        self.send(token(PID_IN, 5, 1), data(0, first), pid(PID_ACK))
+        self.send(token(PID_IN, 5, 1), pid(PID_NAK))
+        # Its ACK was lost, so the device sends the same packet again
+        self.send(token(PID_IN, 5, 1), data(0, first), pid(PID_ACK))
+        self.assertEqual(self.transfers, [])
+
+        self.send(token(PID_IN, 5, 1), data(1, b"tail"), pid(PID_ACK))
+
+        xfer, = self.transfers
+        self.assertEqual((xfer.kind, xfer.addr, xfer.endp, xfer.direction, xfer.status),
+                         ("bulk", 5, 1, "IN", "ok"))
+        self.assertEqual((xfer.data, xfer.length, xfer.transactions, xfer.naks),
+                         (first + b"tail", 68, 2, 1))
+        self.assertIsNone(xfer.setup)
+
+    def test_incomplete(self):
+        self.send(token(PID_OUT, 3, 2), data(0, bytes(512)), pid(PID_ACK))
+        self.tracker.finish()
+
+        xfer, = self.transfers
+        self.assertEqual((xfer.kind, xfer.direction, xfer.length, xfer.status),
+                         ("data", "OUT", 512, "incomplete"))
+
+
+if __name__ == "__main__":
+    unittest.main()
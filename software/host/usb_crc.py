@@ -0,0 +1,60 @@
+#
+# USB packet CRCs
+#
+# CRC5 covers the 11-bit address/endpoint or frame number field of tokens
+# and SOFs, CRC16 the payload of DATA packets. Both are table-driven: the
+# CRC16 table lives in libov, which also checks whole batches of records
+# (OVRecords_CheckCRC) and marks the bad ones with HF_CRC_BAD in their
+# flags. The CRC5 table is small enough to look up from Python directly.
+#
+
+import ctypes
+
+import LibOV
+from LibOV import HF_CRC_BAD
+
+CRC_NONE = 0
+CRC_GOOD = 1
+CRC_BAD = 2
+
+def _crc5_entry(field):
+    crc = 0x1F
+    for bit in range(11):
+        crc = (crc >> 1) ^ 0x14 if (crc ^ field >> bit) & 1 else crc >> 1
+    return crc ^ 0x1F
+
+CRC5_TABLE = bytes(_crc5_entry(i) for i in range(2048))
+
+TOKEN_PIDS = (0x1, 0x9, 0xD, 0x4, 0x5)      # OUT, IN, SETUP, PING, SOF
+DATA_PIDS = (0x3, 0xB, 0x7, 0xF)
+
+def crc16(data):
+    """CRC16 of a DATA payload (without PID), as sent on the bus."""
+    data = bytes(data)
+    return LibOV.OVCrc16(data, len(data))
+
+def crc5(field):
+    """CRC5 of the 11-bit field of a token or SOF."""
+    return CRC5_TABLE[field & 0x7FF]
+
+def check_packet(pkt):
+    """CRC_GOOD or CRC_BAD for a packet with a CRC (tokens, SOF, DATA),
+    else CRC_NONE."""
+    if not pkt:
+        return CRC_NONE
+
+    pid = pkt[0] & 0xF
+    if pid in TOKEN_PIDS and len(pkt) == 3:
+        ok = CRC5_TABLE[pkt[1] | (pkt[2] & 0x7) << 8] == pkt[2] >> 3
+    elif pid in DATA_PIDS and len(pkt) >= 3:
+        ok = crc16(pkt[1:-2]) == pkt[-2] | pkt[-1] << 8
+    else:
+        return CRC_NONE
+
+    return CRC_GOOD if ok else CRC_BAD
+
+def check_records(records, count):
+    """Set HF_CRC_BAD in the flags of those of the 'count' 0xA0 records in
+    bytearray 'records' whose CRC is wrong. Returns their number."""
+    buf = (ctypes.c_uint8 * len(records)).from_buffer(records)
+    return LibOV.OVRecords_CheckCRC(buf, len(records), count, 1)
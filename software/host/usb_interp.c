@@ -1,6 +1,11 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <pthread.h>
+#endif
 #include "fastftdi.h"
 #include "usb_interp.h"
 
@@ -240,87 +245,519 @@ void ChandlePacket(unsigned long long ts, unsigned int flags, unsigned char *buf
   //  hexdump(buf, len);
 }
 
-unsigned char got_start = 0;
+/*
+ * Native stream parser.
+ *
+ * Frames the raw byte stream coming off FTDI interface A without going
+ * through Python for every byte. 0xD0 SDRAM-read bursts are unwrapped into
+ * a second buffer and the 0xA0 capture records inside them are collected
+ * into a batch, which is handed to 'packetCb' in one go. Every other frame
+ * (IO replies, LFSR test data, ...) is passed to 'frameCb' individually.
+ *
+ * All state lives in the OVStreamParser, so several devices can be parsed
+ * at once.
+ */
+
+#define OV_STREAM_BUF_SIZE   4096
+#define OV_RECORD_HDR_SIZE   8
+#define OV_RECORD_MAX_SIZE   2048   // Anything larger means we lost sync
+
+struct OVStreamParser {
+  OVPacketBatchCallback *packetCb;
+  OVFrameCallback *frameCb;
+  void *userdata;
+
+  // Outer (device) stream and unwrapped SDRAM stream
+  uint8_t outer[OV_STREAM_BUF_SIZE];
+  int outerLen;
+  uint8_t inner[OV_STREAM_BUF_SIZE];
+  int innerLen;
+
+  bool gotStart;
+
+  uint8_t *batch;
+  int batchSize;
+  int batchLen;
+  int batchCount;
+  int batchMaxCount;
+
+  volatile int stop;
+  int result;
+
+  OVStreamStats stats;
+};
+
+OVStreamParser *
+OVStreamParser_New(OVPacketBatchCallback *packetCb, OVFrameCallback *frameCb,
+                   void *userdata, int batchMaxCount, int batchSize)
+{
+  OVStreamParser *p;
+
+  if (batchSize < OV_RECORD_MAX_SIZE)
+    batchSize = OV_RECORD_MAX_SIZE;
+  if (batchMaxCount < 1)
+    batchMaxCount = 1;
+
+  p = calloc(1, sizeof *p);
+  if (!p)
+    return NULL;
+
+  p->batch = malloc(batchSize);
+  if (!p->batch) {
+    free(p);
+    return NULL;
+  }
+
+  p->packetCb = packetCb;
+  p->frameCb = frameCb;
+  p->userdata = userdata;
+  p->batchSize = batchSize;
+  p->batchMaxCount = batchMaxCount;
+
+  return p;
+}
+
+void
+OVStreamParser_Free(OVStreamParser *p)
+{
+  if (p) {
+    free(p->batch);
+    free(p);
+  }
+}
+
+void
+OVStreamParser_Stop(OVStreamParser *p)
+{
+  p->stop = 1;
+}
+
+void
+OVStreamParser_GetStats(OVStreamParser *p, OVStreamStats *stats)
+{
+  *stats = p->stats;
+}
+
+int
+OVStreamParser_Flush(OVStreamParser *p)
+{
+  int err = 0;
+
+  if (p->batchCount) {
+    p->stats.batches++;
+    err = p->packetCb(p->batch, p->batchLen, p->batchCount, p->userdata);
+    p->batchLen = 0;
+    p->batchCount = 0;
+  }
+
+  return err;
+}
+
+/*
+ * Frame one capture record (or one of its 2-byte status frames) at the
+ * start of 'buf'. Returns the number of bytes consumed, 0 if more data is
+ * needed, or a negative error from a callback.
+ */
+
+static int
+ParseCapture(OVStreamParser *p, uint8_t *buf, int len)
+{
+  int flags, size;
+  int err;
+
+  if (buf[0] == 0xAC || buf[0] == 0xAD)
+    return len >= 2 ? 2 : 0;
 
-int CStreamCallback (uint8_t *buffer, int length,
-			FTDIProgressInfo *progress, void *userdata) {
-  unsigned char *p;
-  FTDIStreamCallback *cb;
-  if (!buffer ||  !length) 
+  if (buf[0] != 0xA0) {
+    p->stats.discarded++;
+    return 1;
+  }
+
+  if (len < 5)
     return 0;
-  //    printf("CStreamCallback(%p, %d, %p, %p)\n", buffer, length, progress, userdata);
-  //  hexdump(buffer, length);
-  cb = (FTDIStreamCallback *)userdata;
-
-  //  printf("packet_buf=%p, packet_buf_len=%d\n", packet_buf, packet_buf_len);
-  memcpy(packet_buf + packet_buf_len, buffer, length);
-  packet_buf_len += length;
-  p = packet_buf;
-  if (packet_buf_len > sizeof packet_buf) {
-    printf("ERROR: buffer overflow\n");
-    exit(0);
+
+  size = (buf[3] | (buf[4] << 8)) + OV_RECORD_HDR_SIZE;
+  if (size > OV_RECORD_MAX_SIZE) {
+    p->stats.discarded++;
+    return 1;
   }
-  
-  //  printf("now, packet_buf=%p, packet_buf_len=%d\n", packet_buf, packet_buf_len);
-  while(packet_buf_len > 0) {
-    switch(p[0]) {
-    case 0x55:
-      if (packet_buf_len < 5) {
-	printf("IO packet error -- too short (%d < 5)\n", packet_buf_len);
-	packet_buf_len--;
-	p++;
-	break;
-      }
-      cb(p, 5, progress, NULL);
-      packet_buf_len -= 5;
-      p+=5;
-      break;
-    case 0xAA:
-      if (packet_buf_len < 2) {
-	printf("LFSR packet error -- too short (%d < 2)\n", packet_buf_len);
-	packet_buf_len--;
-	p++;
-	break;
-      }
-      cb(p, p[1]+2, progress, NULL);
-      break;
-    case 0xA0: 
-      if (packet_buf_len < 8) {
-	//	printf("packet cut off, returning\n");
-	goto done;
-      }
-      {
-	unsigned int flags = p[1] | (p[2] << 8);
-	unsigned int pktsize = p[3] | (p[4] << 8) + 8;
-	unsigned int ts = p[5] | (p[6] << 8) | (p[7] << 16);
-	if (flags !=0) {
-	  printf("PERR: %04X\n", flags);
-	}
-	//	printf("Packet flags=%04x size=%04x ts=%06x\n", flags, pktsize, ts);
-	if (packet_buf_len < pktsize) {
-	  //	  printf("packet cut off2, returning\n");
-	  goto done;
-	}
-	if (flags & HF0_FIRST)
-	  got_start = 1;
-	if (got_start) {
-	  ChandlePacket(ts, flags, p+8, pktsize-8);
-	}
-	if (flags & HF0_LAST)
-	  got_start = 0;
-	p += pktsize;
-	packet_buf_len -= pktsize;
-      }
+
+  if (len < size)
+    return 0;
+
+  flags = buf[1] | (buf[2] << 8);
+
+  if (flags & HF0_FIRST)
+    p->gotStart = true;
+
+  if (p->gotStart) {
+    if (p->batchLen + size > p->batchSize) {
+      err = OVStreamParser_Flush(p);
+      if (err)
+        return err < 0 ? err : -err;
+    }
+
+    memcpy(p->batch + p->batchLen, buf, size);
+    p->batchLen += size;
+    p->batchCount++;
+    p->stats.packets++;
+
+    if (p->batchCount >= p->batchMaxCount) {
+      err = OVStreamParser_Flush(p);
+      if (err)
+        return err < 0 ? err : -err;
+    }
+  }
+
+  if (flags & HF0_LAST)
+    p->gotStart = false;
+
+  return size;
+}
+
+static int ParseInner(OVStreamParser *p, uint8_t *data, int length);
+
+/*
+ * Frame one message from the device stream at the start of 'buf'.
+ * Same return convention as ParseCapture.
+ */
+
+static int
+ParseOuter(OVStreamParser *p, uint8_t *buf, int len)
+{
+  int size, err;
+
+  switch (buf[0]) {
+  case 0xD0:  // SDRAM read burst
+    if (len < 2)
+      return 0;
+    size = (buf[1] + 1) * 2 + 2;
+    if (len < size)
+      return 0;
+    err = ParseInner(p, buf + 2, size - 2);
+    return err ? err : size;
+
+  case 0xA0:
+  case 0xAC:
+  case 0xAD:
+    return ParseCapture(p, buf, len);
+
+  case 0x55:  // IO reply
+    size = 5;
+    break;
+
+  case 0xAA:  // LFSR test
+    if (len < 2)
+      return 0;
+    size = buf[1] + 2;
+    break;
+
+  case 0xE0:  // Dummy source
+  case 0xE8:
+    size = 3;
+    break;
+
+  default:
+    p->stats.discarded++;
+    return 1;
+  }
+
+  if (len < size)
+    return 0;
+
+  p->stats.frames++;
+  err = p->frameCb(buf, size, p->userdata);
+  if (err)
+    return err < 0 ? err : -err;
+
+  return size;
+}
+
+/*
+ * Append 'length' bytes to a parse buffer and frame as much of it as
+ * possible. Leftover bytes of a partial frame are kept for the next call.
+ */
+
+static int
+ParseBuffer(OVStreamParser *p, uint8_t *buf, int *bufLen,
+            uint8_t *data, int length,
+            int (*parse)(OVStreamParser *, uint8_t *, int))
+{
+  int pos = 0, n = 0;
+
+  while (length > 0) {
+    int chunk = OV_STREAM_BUF_SIZE - *bufLen;
+    if (chunk > length)
+      chunk = length;
+
+    memcpy(buf + *bufLen, data, chunk);
+    *bufLen += chunk;
+    data += chunk;
+    length -= chunk;
+
+    pos = 0;
+    while (pos < *bufLen) {
+      n = parse(p, buf + pos, *bufLen - pos);
+      if (n <= 0)
+        break;
+      pos += n;
+    }
+
+    memmove(buf, buf + pos, *bufLen - pos);
+    *bufLen -= pos;
+
+    if (n < 0)
+      return n;
+  }
+
+  return 0;
+}
+
+static int
+ParseInner(OVStreamParser *p, uint8_t *data, int length)
+{
+  return ParseBuffer(p, p->inner, &p->innerLen, data, length, ParseCapture);
+}
+
+int
+OVStreamParser_Feed(OVStreamParser *p, uint8_t *data, int length)
+{
+  return ParseBuffer(p, p->outer, &p->outerLen, data, length, ParseOuter);
+}
+
+/*
+ * FTDIStreamCallback adapter; pass the parser as userdata to
+ * FTDIDevice_ReadStream. Pending packets are flushed on every progress
+ * update, which bounds the batching latency to the progress interval.
+ */
+
+int
+OVStreamParser_Callback(uint8_t *buffer, int length,
+                        FTDIProgressInfo *progress, void *userdata)
+{
+  OVStreamParser *p = userdata;
+
+  if (p->result)
+    return p->result;
+
+  if (length)
+    p->result = OVStreamParser_Feed(p, buffer, length);
+  else
+    p->result = OVStreamParser_Flush(p);
+
+  if (p->result)
+    return p->result;
+
+  return p->stop;
+}
+
+/*
+ * Capture buffer scanner
+ *
+ * Walks a buffer of back-to-back 0xA0 capture records, as stored in raw
+ * capture files, and stores the offset of each record in 'offsets' (at
+ * most 'maxCount' of them). Stops at the first incomplete record or byte
+ * that is not a record header. Returns the number of records found and
+ * sets '*used' to the number of bytes they cover.
+ */
+
+int
+OVRecords_Scan(const uint8_t *buf, size_t length, int64_t *offsets,
+               int maxCount, size_t *used)
+{
+  size_t pos = 0;
+  int count = 0;
+
+  while (count < maxCount && pos + OV_RECORD_HDR_SIZE <= length) {
+    size_t size = OV_RECORD_HDR_SIZE + (buf[pos + 3] | (buf[pos + 4] << 8));
+
+    if (buf[pos] != 0xA0 || pos + size > length)
       break;
-    default:
-      printf("Unknown packet byte %02x, discarding\n", p[0]);
-      p++;
-      packet_buf_len--;
+
+    offsets[count++] = pos;
+    pos += size;
+  }
+
+  *used = pos;
+  return count;
+}
+
+/*
+ * CRC checking
+ *
+ * Table-driven CRC5 (tokens, SOF) and CRC16 (DATA payloads), as the USB
+ * spec defines them. The tables are filled in once, on first use, by
+ * whichever thread gets there first; the others wait for it.
+ */
+
+static uint16_t crc16_table[256];
+static uint8_t crc5_table[2048];
+
+static void
+crc_init_tables(void)
+{
+  int i, bit;
+
+  for (i = 0; i < 256; i++) {
+    uint16_t crc = i;
+    for (bit = 0; bit < 8; bit++)
+      crc = (crc & 1) ? (crc >> 1) ^ 0xA001 : crc >> 1;
+    crc16_table[i] = crc;
+  }
+
+  /* CRC5 of every possible 11-bit token field, LSB first */
+  for (i = 0; i < 2048; i++) {
+    uint8_t crc = 0x1F;
+    for (bit = 0; bit < 11; bit++)
+      crc = ((crc ^ (i >> bit)) & 1) ? (crc >> 1) ^ 0x14 : crc >> 1;
+    crc5_table[i] = crc ^ 0x1F;
+  }
+}
+
+#ifdef _WIN32
+static INIT_ONCE crc_tables_once = INIT_ONCE_STATIC_INIT;
+
+static BOOL CALLBACK
+crc_init_tables_once(PINIT_ONCE once, PVOID param, PVOID *context)
+{
+  crc_init_tables();
+  return TRUE;
+}
+
+static void
+crc_tables(void)
+{
+  InitOnceExecuteOnce(&crc_tables_once, crc_init_tables_once, NULL, NULL);
+}
+#else
+static pthread_once_t crc_tables_once = PTHREAD_ONCE_INIT;
+
+static void
+crc_tables(void)
+{
+  pthread_once(&crc_tables_once, crc_init_tables);
+}
+#endif
+
+uint16_t
+OVCrc16(const uint8_t *buf, size_t length)
+{
+  uint16_t crc = 0xFFFF;
+
+  crc_tables();
+
+  while (length--)
+    crc = (crc >> 8) ^ crc16_table[(crc ^ *buf++) & 0xFF];
+
+  return crc ^ 0xFFFF;
+}
+
+/*
+ * Returns 1 if the packet has a CRC and it is wrong. Packets without a
+ * CRC (handshakes, SPLIT, runts) are never bad.
+ */
+static int
+crc_bad(const uint8_t *pkt, size_t length)
+{
+  uint8_t pid;
+
+  if (length == 0)
+    return 0;
+
+  pid = pkt[0] & 0xF;
+  switch (pid) {
+  case 0x1: // OUT
+  case 0x9: // IN
+  case 0xD: // SETUP
+  case 0x4: // PING
+  case 0x5: // SOF
+    if (length != 3)
+      return 0;
+    return crc5_table[pkt[1] | (pkt[2] & 0x7) << 8] != pkt[2] >> 3;
+
+  case 0x3: // DATA0
+  case 0xB: // DATA1
+  case 0x7: // DATA2
+  case 0xF: // MDATA
+    if (length < 3)
+      return 0;
+    return OVCrc16(pkt + 1, length - 3) != (pkt[length - 2] | pkt[length - 1] << 8);
+  }
+
+  return 0;
+}
+
+/*
+ * Checks the CRCs of 'count' back-to-back 0xA0 records in 'buf' and, if
+ * 'mark' is nonzero, sets OV_HF_CRC_BAD in the flags of the records whose
+ * CRC is wrong. Returns the number of those. With 'mark' zero, 'buf' is
+ * only read.
+ */
+
+int
+OVRecords_CheckCRC(uint8_t *buf, size_t length, int count, int mark)
+{
+  size_t pos = 0;
+  int bad = 0;
+
+  crc_tables();
+
+  while (count-- && pos + OV_RECORD_HDR_SIZE <= length) {
+    size_t size = buf[pos + 3] | (buf[pos + 4] << 8);
+
+    if (pos + OV_RECORD_HDR_SIZE + size > length)
       break;
+
+    if (crc_bad(buf + pos + OV_RECORD_HDR_SIZE, size)) {
+      if (mark)
+        buf[pos + 2] |= OV_HF_CRC_BAD >> 8;
+      bad++;
     }
+    pos += OV_RECORD_HDR_SIZE + size;
   }
- done:
-  //  printf("p offset = %d, len = %d\n", p - packet_buf, packet_buf_len);
-  memmove(packet_buf, p, packet_buf_len);
-  return 0;
+
+  return bad;
+}
+
+/*
+ * Clears the flag bits in 'mask' in 'count' back-to-back 0xA0 records in
+ * 'buf', such as OV_HF_CRC_BAD before records are stored as they came
+ * from the device.
+ */
+
+void
+OVRecords_ClearFlags(uint8_t *buf, size_t length, int count, uint16_t mask)
+{
+  size_t pos = 0;
+
+  while (count-- && pos + OV_RECORD_HDR_SIZE <= length) {
+    buf[pos + 1] &= ~mask;
+    buf[pos + 2] &= ~(mask >> 8);
+    pos += OV_RECORD_HDR_SIZE + (buf[pos + 3] | (buf[pos + 4] << 8));
+  }
+}
+
+/*
+ * Finds the records among 'count' back-to-back 0xA0 records in 'buf'
+ * with any of the flag bits in 'mask' set, and stores the offsets of the
+ * first 'maxCount' of them in 'offsets'. Returns how many there are.
+ */
+
+int
+OVRecords_FindFlags(const uint8_t *buf, size_t length, int count, uint16_t mask,
+                    int64_t *offsets, int maxCount)
+{
+  size_t pos = 0;
+  int found = 0;
+
+  while (count-- && pos + OV_RECORD_HDR_SIZE <= length) {
+    if ((buf[pos + 1] | (buf[pos + 2] << 8)) & mask) {
+      if (found < maxCount)
+        offsets[found] = pos;
+      found++;
+    }
+    pos += OV_RECORD_HDR_SIZE + (buf[pos + 3] | (buf[pos + 4] << 8));
+  }
+
+  return found;
 }
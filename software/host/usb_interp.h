@@ -43,4 +43,53 @@
 
 OV_API void ChandlePacket(unsigned long long ts, unsigned int flags, unsigned char *buf, unsigned int len);
 
+/*
+ * Native stream parser
+ */
+
+typedef int (OVPacketBatchCallback)(uint8_t *records, int length, int count,
+                                    void *userdata);
+typedef int (OVFrameCallback)(uint8_t *frame, int length, void *userdata);
+
+typedef struct OVStreamParser OVStreamParser;
+
+typedef struct {
+  uint64_t packets;
+  uint64_t batches;
+  uint64_t frames;
+  uint64_t discarded;
+} OVStreamStats;
+
+OV_API OVStreamParser *OVStreamParser_New(OVPacketBatchCallback *packetCb,
+                                          OVFrameCallback *frameCb,
+                                          void *userdata,
+                                          int batchMaxCount, int batchSize);
+OV_API void OVStreamParser_Free(OVStreamParser *p);
+OV_API void OVStreamParser_Stop(OVStreamParser *p);
+OV_API void OVStreamParser_GetStats(OVStreamParser *p, OVStreamStats *stats);
+OV_API int OVStreamParser_Feed(OVStreamParser *p, uint8_t *data, int length);
+OV_API int OVStreamParser_Flush(OVStreamParser *p);
+OV_API int OVStreamParser_Callback(uint8_t *buffer, int length,
+                                   FTDIProgressInfo *progress, void *userdata);
+
+/*
+ * Capture buffer scanner
+ */
+
+OV_API int OVRecords_Scan(const uint8_t *buf, size_t length, int64_t *offsets,
+                          int maxCount, size_t *used);
+
+/*
+ * CRC checking
+ */
+
+/* Record flag set by the host, not the device: the packet's CRC is wrong */
+#define OV_HF_CRC_BAD        0x8000
+
+OV_API uint16_t OVCrc16(const uint8_t *buf, size_t length);
+OV_API int OVRecords_CheckCRC(uint8_t *buf, size_t length, int count, int mark);
+OV_API void OVRecords_ClearFlags(uint8_t *buf, size_t length, int count, uint16_t mask);
+OV_API int OVRecords_FindFlags(const uint8_t *buf, size_t length, int count, uint16_t mask,
+                               int64_t *offsets, int maxCount);
+
 #endif /* __USB_INTERP_H */
@@ -2,10 +2,11 @@
 def hd(x):
     return " ".join("%02x" % i for i in x)
 
-class USBInterpreter(object):
-    import crcmod
-    data_crc = staticmethod(crcmod.mkCrcFun(0x18005))
+# Set on packets whose CRC is wrong (LibOV.HF_CRC_BAD; LibOV imports
+# this module, so it is repeated here)
+HF_CRC_BAD = 0x8000
 
+class USBInterpreter(object):
     def __init__(self, highspeed):
         self.frameno = None
         self.subframe = 0
@@ -19,11 +20,56 @@ class USBInterpreter(object):
         self.ts_roll_cyc = 2**24
 
     def handlePacket(self, ts, buf, flags):
-        CRC_BAD = 1
-        CRC_GOOD = 2
-        CRC_NONE = 3
-        crc_check = CRC_NONE
-        
+        line = self.formatPacket(ts, buf, flags)
+        if line is not None:
+            print(line)
+
+    def trackFrame(self, ts, frameno):
+        """Advance the frame/subframe counters for a SOF at absolute time
+        'ts'. Returns a warning message if the sequence looks wrong."""
+        msg = ""
+
+        if self.frameno == None:
+            self.subframe = None
+        else:
+            if self.subframe == None:
+                if frameno == (self.frameno + 1) & 0xFF:
+                    self.subframe = 0 if self.highspeed else None
+            else:
+                self.subframe += 1
+                if self.subframe == 8:
+                    if frameno == (self.frameno + 1)&0xFF:
+                        self.subframe = 0
+                    else:
+                        msg += "WTF Subframe %d" % self.frameno
+                        self.subframe = None
+                elif self.frameno != frameno:
+                    msg += "WTF frameno %d" % self.frameno
+                    self.subframe = None
+
+        self.frameno = frameno
+        self.last_ts_frame = ts
+        return msg
+
+    def skipPacket(self, ts, buf):
+        """Update the decoder state for a packet as formatPacket would, without
+        formatting it. Returns False for packets that would not be shown."""
+        if ts < self.last_ts_pkt:
+            self.ts_base += self.ts_roll_cyc
+        self.last_ts_pkt = ts
+
+        ts += self.ts_base
+
+        if len(buf) >= 3 and buf[0] == 0xa5:
+            self.trackFrame(ts, buf[1] | (buf[2] << 8) & 0x7)
+            return False
+
+        self.last_ts_print = ts
+        return True
+
+    def formatPacket(self, ts, buf, flags):
+        """Decode one packet and return its display line, or None if the
+        packet is not to be shown (SOFs)."""
         ts_delta_pkt = ts - self.last_ts_pkt
         self.last_ts_pkt = ts
 
@@ -47,40 +93,18 @@ class USBInterpreter(object):
                     msg += "RUNT frame"
                 else:
                     frameno = buf[1] | (buf[2] << 8) & 0x7
-                    if self.frameno == None:
-                        self.subframe = None
-                    else:
-                        if self.subframe == None:
-                            if frameno == (self.frameno + 1) & 0xFF:
-                                self.subframe = 0 if self.highspeed else None
-                        else:
-                            self.subframe += 1
-                            if self.subframe == 8:
-                                if frameno == (self.frameno + 1)&0xFF:
-                                    self.subframe = 0
-                                else:
-                                    msg += "WTF Subframe %d" % self.frameno
-                                    self.subframe = None
-                            elif self.frameno != frameno:
-                                msg += "WTF frameno %d" % self.frameno
-                                self.subframe = None
-                    
-                    self.frameno = frameno
-                                
-                    self.last_ts_frame = ts
+                    msg += self.trackFrame(ts, frameno)
                     suppress = True
                     msg += "Frame %d.%c" % (frameno, '?' if self.subframe == None else "%d" % self.subframe)
+                    if flags & HF_CRC_BAD:
+                        msg += "\tUnexpected ERR CRC5"
             elif pid in [0x3, 0xB, 0x7]:
                 n = {3:0, 0xB:1, 0x7:2}[pid]
 
                 msg += "DATA%d: %s" % (n,hd(buf[1:]))
 
-                if len(buf) > 2:
-                    calc_check = self.data_crc(buf[1:-2])^0xFFFF 
-                    pkt_check = buf[-2] | buf[-1] << 8
-
-                    if calc_check != pkt_check:
-                        msg += "\tUnexpected ERR CRC"
+                if flags & HF_CRC_BAD:
+                    msg += "\tUnexpected ERR CRC"
 
             elif pid == 0xF:
                 msg += "MDATA: %s" % hd(buf[1:])
@@ -101,6 +125,8 @@ class USBInterpreter(object):
                     endp = (buf[2] & 0x7) << 1 | buf[1] >> 7
 
                     msg += "%-5s: %d.%d" % (name, addr, endp)
+                    if flags & HF_CRC_BAD:
+                        msg += "\tUnexpected ERR CRC5"
             elif pid == 2:
                 msg += "ACK"
             elif pid == 0xA:
@@ -119,13 +145,8 @@ class USBInterpreter(object):
                 msg += "WUT"
 
         if not suppress:
-            crc_char_d = {
-                CRC_BAD: '!',
-                CRC_GOOD: 'C',
-                CRC_NONE: ' '
-            }
-
-            flag_field = "[  %s%s%s%s%s%s]" % (
+            flag_field = "[%s %s%s%s%s%s%s]" % (
+                '!' if flags & HF_CRC_BAD else ' ',
                 'L' if flags & 0x20 else ' ',
                 'F' if flags & 0x10 else ' ',
                 'T' if flags & 0x08 else ' ',
@@ -146,7 +167,7 @@ class USBInterpreter(object):
             if self.subframe != None:
                 subf_print = ".%d" % self.subframe
 
-            print ("%s %10.6f d=%10.6f [%3s%2s +%7.3f] [%3d] %s " % (
+            return "%s %10.6f d=%10.6f [%3s%2s +%7.3f] [%3d] %s " % (
                     flag_field, ts/RATE, (delta_print)/RATE,
                     frame_print, subf_print, delta_subframe/RATE * 1E6,
-                    len(buf), msg))
+                    len(buf), msg)
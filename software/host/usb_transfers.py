@@ -0,0 +1,329 @@
+#
+# Grouping USB packets into transactions and transfers
+#
+# TransferTracker is fed packets in capture order and hands back each
+# transaction (token, optional data, optional handshake) and each
+# transfer (a control transfer from SETUP to status stage, or a run of
+# bulk / interrupt / isochronous data ended by a short packet) as soon as
+# it is complete. Memory is bounded: one open transfer per endpoint, with
+# at most 'max_data' bytes of payload kept.
+#
+
+import collections
+
+PID_OUT = 0x1
+PID_IN = 0x9
+PID_SOF = 0x5
+PID_SETUP = 0xD
+PID_PING = 0x4
+PID_SPLIT = 0x8
+PID_ACK = 0x2
+PID_NAK = 0xA
+PID_STALL = 0xE
+PID_NYET = 0x6
+
+TOKENS = {PID_OUT: "OUT", PID_IN: "IN", PID_SETUP: "SETUP", PID_PING: "PING"}
+DATA_PIDS = {0x3: "DATA0", 0xB: "DATA1", 0x7: "DATA2", 0xF: "MDATA"}
+HANDSHAKES = {PID_ACK: "ACK", PID_NAK: "NAK", PID_STALL: "STALL", PID_NYET: "NYET"}
+
+# Endpoint types, as in bmAttributes of the endpoint descriptor; "data"
+# is an endpoint whose descriptor was not seen
+EP_TYPES = ["control", "isochronous", "bulk", "interrupt"]
+
+# Largest packet of an endpoint whose descriptor was not seen, by speed
+DEFAULT_MAX_PACKET = {"hs": 512, "fs": 64, "ls": 8}
+
+# Standard requests that reset the data toggles of a device's endpoints
+TOGGLE_RESETS = (0x01, 0x09, 0x0B)    # CLEAR_FEATURE, SET_CONFIGURATION, SET_INTERFACE
+
+# 'start' and 'end' are absolute clock counts of the first and last packet.
+# 'data' is the payload without CRC, or None if there was no data packet;
+# 'handshake' is None if there was no handshake (isochronous, or lost).
+Transaction = collections.namedtuple('Transaction',
+        ['start', 'end', 'token', 'addr', 'endp', 'data_pid', 'data',
+         'handshake', 'error'])
+
+# A completed transfer. 'direction' is that of the data ("IN" or "OUT";
+# for control transfers without a data stage, "OUT"). 'setup' is the
+# 8-byte SETUP packet of a control transfer, else None. 'data' holds the
+# first 'max_data' bytes and 'length' counts them all. 'status' is one of
+# "ok", "stall", "error" (some packet was received with an error flag),
+# "aborted" (a control transfer cut short by a new SETUP) or "incomplete"
+# (still open when the capture ended).
+Transfer = collections.namedtuple('Transfer',
+        ['kind', 'addr', 'endp', 'direction', 'start', 'end', 'setup', 'data',
+         'length', 'status', 'transactions', 'naks'])
+
+
+class _Open:
+    # A transfer being collected
+    __slots__ = ('kind', 'addr', 'endp', 'direction', 'start', 'end', 'setup',
+                 'data', 'length', 'error', 'transactions', 'naks', 'stage', 'expect')
+
+    def __init__(self, kind, addr, endp, direction, start, setup=None):
+        self.kind = kind
+        self.addr = addr
+        self.endp = endp
+        self.direction = direction
+        self.start = self.end = start
+        self.setup = setup
+        self.data = bytearray()
+        self.length = 0
+        self.error = False
+        self.transactions = 0
+        self.naks = 0
+        self.stage = None
+        self.expect = 0
+
+
+class _Pipe:
+    # Per (addr, endp, direction) state of a non-control endpoint
+    __slots__ = ('transfer', 'toggle')
+
+    def __init__(self):
+        self.transfer = None
+        self.toggle = None
+
+
+class TransferTracker:
+    """Streaming transaction and transfer reassembly. Feed every packet to
+    packet(); on_transaction(Transaction) and on_transfer(Transfer) are
+    called as each completes. 'speed' ("hs", "fs" or "ls") sets the packet
+    size assumed for endpoints whose descriptors were not captured.
+
+    Control transfers are followed through their stages. Other transfers
+    end with a packet shorter than the endpoint's wMaxPacketSize (taken
+    from configuration descriptors seen in the capture), or with a STALL.
+    Retransmitted data (same data toggle as the last accepted packet) is
+    only counted once.
+    """
+
+    def __init__(self, on_transfer, speed="hs", on_transaction=None,
+                 max_data=65536, max_pipes=256):
+        self.on_transfer = on_transfer
+        self.on_transaction = on_transaction
+        self.default_max_packet = DEFAULT_MAX_PACKET[speed]
+        self.max_data = max_data
+        self.max_pipes = max_pipes
+
+        # Transaction being assembled: [start, end, token, addr, endp,
+        # data_pid, data, error]
+        self.pending = None
+
+        self.control = {}                           # (addr, endp) -> _Open
+        self.pipes = collections.OrderedDict()      # (addr, endp, dir) -> _Pipe
+        self.endpoints = {}                         # (addr, endp, dir) -> (kind, max_packet)
+
+    # Packets -> transactions
+
+    def packet(self, clks, pkt, flags=0):
+        """Add a packet captured at absolute clock count 'clks'."""
+        if not pkt:
+            return
+
+        pid = pkt[0] & 0xF
+        # HF0_ERR..HF0_TRUNC from the device, HF_CRC_BAD from the host
+        error = bool(flags & 0x800F) or (pkt[0] >> 4) ^ 0xF != pid
+
+        if pid in TOKENS:
+            self.__end_transaction(None)
+            if len(pkt) >= 3:
+                self.pending = [clks, clks, pid, pkt[1] & 0x7F,
+                                (pkt[2] & 0x7) << 1 | pkt[1] >> 7, None, None, error]
+        elif pid in DATA_PIDS:
+            p = self.pending
+            if p is not None and p[5] is None and p[2] != PID_PING:
+                p[1] = clks
+                p[5] = pid
+                p[6] = bytes(pkt[1:-2])
+                p[7] = p[7] or error
+        elif pid in HANDSHAKES:
+            if self.pending is not None:
+                self.pending[1] = clks
+                self.pending[7] = self.pending[7] or error
+                self.__end_transaction(pid)
+        elif pid == PID_SOF or pid == PID_SPLIT:
+            self.__end_transaction(None)
+
+    def __end_transaction(self, handshake):
+        p = self.pending
+        if p is None:
+            return
+        self.pending = None
+
+        t = Transaction(p[0], p[1], TOKENS[p[2]], p[3], p[4],
+                        DATA_PIDS.get(p[5]), p[6],
+                        HANDSHAKES.get(handshake), p[7])
+        if self.on_transaction is not None:
+            self.on_transaction(t)
+        self.__transaction(t, p[2], p[5], handshake)
+
+    # Transactions -> transfers
+
+    def __transaction(self, t, token, data_pid, handshake):
+        if token == PID_PING:
+            return
+
+        key = (t.addr, t.endp)
+        if token == PID_SETUP:
+            if handshake == PID_ACK and t.data is not None and len(t.data) == 8:
+                self.__setup(t)
+            return
+
+        ctrl = self.control.get(key)
+        if ctrl is not None:
+            self.__control(ctrl, t, handshake)
+            return
+
+        direction = "IN" if token == PID_IN else "OUT"
+        pipe = self.__pipe((t.addr, t.endp, direction))
+        xfer = pipe.transfer
+
+        if handshake == PID_NAK:
+            if xfer is not None:
+                xfer.naks += 1
+            return
+
+        if handshake == PID_STALL:
+            if xfer is None:
+                kind = self.endpoints.get((t.addr, t.endp, direction), ("data",))[0]
+                xfer = _Open(kind, t.addr, t.endp, direction, t.start)
+            xfer.end = t.end
+            self.__emit(xfer, "stall")
+            pipe.transfer = None
+            return
+
+        if t.data is None:
+            return
+
+        kind, max_packet = self.endpoints.get((t.addr, t.endp, direction),
+                                              ("data", self.default_max_packet))
+
+        # A repeat of the last accepted packet (its handshake was lost)
+        if kind != "isochronous":
+            if data_pid in (0x3, 0xB) and data_pid == pipe.toggle:
+                return
+            pipe.toggle = data_pid
+
+        if xfer is None:
+            xfer = pipe.transfer = _Open(kind, t.addr, t.endp, direction, t.start)
+
+        self.__add_data(xfer, t)
+
+        if len(t.data) < max_packet or kind == "isochronous":
+            self.__emit(xfer, "ok")
+            pipe.transfer = None
+
+    def __pipe(self, key):
+        pipe = self.pipes.get(key)
+        if pipe is None:
+            if len(self.pipes) >= self.max_pipes:
+                old_key, old = self.pipes.popitem(last=False)
+                if old.transfer is not None:
+                    self.__emit(old.transfer, "incomplete")
+            pipe = self.pipes[key] = _Pipe()
+        else:
+            self.pipes.move_to_end(key)
+        return pipe
+
+    def __add_data(self, xfer, t):
+        room = self.max_data - len(xfer.data)
+        if room > 0:
+            xfer.data += t.data[:room]
+        xfer.length += len(t.data)
+        xfer.transactions += 1
+        xfer.error = xfer.error or t.error
+        xfer.end = t.end
+
+    def __setup(self, t):
+        key = (t.addr, t.endp)
+        old = self.control.pop(key, None)
+        if old is not None:
+            self.__emit(old, "aborted")
+
+        setup = t.data
+        expect = setup[6] | setup[7] << 8
+        direction = "IN" if expect and setup[0] & 0x80 else "OUT"
+        xfer = _Open("control", t.addr, t.endp, direction, t.start, setup)
+        xfer.transactions = 1
+        xfer.error = t.error
+        xfer.expect = expect
+        xfer.stage = "data" if expect else "status"
+        self.control[key] = xfer
+
+    def __control(self, xfer, t, handshake):
+        direction = "IN" if t.token == "IN" else "OUT"
+
+        if handshake == PID_NAK:
+            xfer.naks += 1
+            return
+        if handshake == PID_STALL:
+            xfer.end = t.end
+            self.__finish_control(xfer, "stall")
+            return
+        if t.data is None:
+            return
+
+        # Data stage in the direction of the setup, status stage the other
+        # way (IN when there is no data stage). A short data stage is
+        # ended by its status stage.
+        if xfer.expect and xfer.direction == "IN":
+            status_dir = "OUT"
+        else:
+            status_dir = "IN"
+
+        if xfer.stage == "data" and direction == xfer.direction:
+            self.__add_data(xfer, t)
+            if xfer.length >= xfer.expect:
+                xfer.stage = "status"
+        elif direction == status_dir:
+            xfer.end = t.end
+            xfer.transactions += 1
+            xfer.error = xfer.error or t.error
+            self.__finish_control(xfer, "ok")
+
+    def __finish_control(self, xfer, status):
+        del self.control[(xfer.addr, xfer.endp)]
+        self.__emit(xfer, status)
+
+        if status != "ok":
+            return
+
+        request_type, request = xfer.setup[0], xfer.setup[1]
+        if request_type == 0x80 and request == 0x06 and xfer.setup[3] == 2:
+            self.__learn_endpoints(xfer.addr, bytes(xfer.data))
+        elif request_type & 0x60 == 0 and request in TOGGLE_RESETS:
+            for key, pipe in self.pipes.items():
+                if key[0] == xfer.addr:
+                    pipe.toggle = None
+
+    def __learn_endpoints(self, addr, desc):
+        # Endpoint descriptors in a configuration descriptor
+        pos = 0
+        while pos + 2 <= len(desc):
+            length, dtype = desc[pos], desc[pos + 1]
+            if length < 2:
+                break
+            if dtype == 5 and length >= 7 and pos + 7 <= len(desc):
+                ep = desc[pos + 2]
+                kind = EP_TYPES[desc[pos + 3] & 0x3]
+                max_packet = (desc[pos + 4] | desc[pos + 5] << 8) & 0x7FF
+                self.endpoints[addr, ep & 0xF, "IN" if ep & 0x80 else "OUT"] = (kind, max_packet)
+            pos += length
+
+    def __emit(self, xfer, status):
+        if status == "ok" and xfer.error:
+            status = "error"
+        self.on_transfer(Transfer(xfer.kind, xfer.addr, xfer.endp, xfer.direction,
+                                  xfer.start, xfer.end, xfer.setup, bytes(xfer.data),
+                                  xfer.length, status, xfer.transactions, xfer.naks))
+
+    def finish(self):
+        """Hand over everything still open, as "incomplete" transfers."""
+        self.__end_transaction(None)
+        for xfer in list(self.control.values()):
+            self.__finish_control(xfer, "incomplete")
+        for pipe in self.pipes.values():
+            if pipe.transfer is not None:
+                self.__emit(pipe.transfer, "incomplete")
+                pipe.transfer = None